@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Telegram webhook updates of all bots are served before Django routing
+from bots.bot_runner.webhooks import TelegramWebhookApp  # noqa: E402
+
+application = TelegramWebhookApp(django_application)
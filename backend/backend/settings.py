@@ -123,6 +123,61 @@ CORS_ALLOW_CREDENTIALS = True
 TELEGRAM_BOT_TIMEOUT = 10
 TELEGRAM_BOT_POLLING_INTERVAL = 1.0
 
+# Режим запуска ботов: 'shared' — боты работают задачами в общем пуле event loop'ов,
+# 'thread' — отдельный поток и event loop на каждого бота
+TELEGRAM_BOT_RUNNER_MODE = os.getenv('TELEGRAM_BOT_RUNNER_MODE', 'shared')
+TELEGRAM_BOT_LOOP_POOL_SIZE = int(os.getenv('TELEGRAM_BOT_LOOP_POOL_SIZE', 1))
+# Соединения к Bot API общие для всех ботов одного event loop'а, не больше стольких одновременно
+TELEGRAM_HTTP_POOL_LIMIT = int(os.getenv('TELEGRAM_HTTP_POOL_LIMIT', 100))
+# Адрес Bot API (например, локальный telegram-bot-api), пусто — https://api.telegram.org
+TELEGRAM_BOT_API_SERVER = os.getenv('TELEGRAM_BOT_API_SERVER', '')
+
+# PRAGMA для баз ботов (bot.db), дополняют/заменяют DEFAULT_PRAGMAS из bots/bot_runner/sqlite_db.py
+# (WAL, synchronous=NORMAL, busy_timeout, cache_size, mmap_size). None убирает pragma.
+TELEGRAM_BOT_SQLITE_PRAGMAS = {}
+# Запросы ботов к своим БД идут не из event loop'а: потоки общие для всех ботов процесса.
+# Записи выполняют столько потоков-писателей (все соединения к одному файлу — в одном из них),
+# чтения — пул из стольких потоков (0 — чтения тоже в потоке-писателе).
+TELEGRAM_BOT_DB_WRITERS = int(os.getenv('TELEGRAM_BOT_DB_WRITERS', 4))
+TELEGRAM_BOT_DB_READERS = int(os.getenv('TELEGRAM_BOT_DB_READERS', 2))
+# Групповой commit потока-писателя: не позже чем через столько мс после первой записи или каждые N записей.
+# 0 — commit после каждой записи.
+TELEGRAM_BOT_DB_COMMIT_INTERVAL_MS = int(os.getenv('TELEGRAM_BOT_DB_COMMIT_INTERVAL_MS', 5))
+TELEGRAM_BOT_DB_COMMIT_BATCH = 100
+# При старте бот проверяет запросы узлов dboutput через EXPLAIN QUERY PLAN и ищет индексы для полных сканов таблиц:
+# 'propose' — только пишет их в лог, 'create' — создаёт, 'off' — не проверяет.
+TELEGRAM_BOT_INDEX_ADVISOR = os.getenv('TELEGRAM_BOT_INDEX_ADVISOR', 'propose')
+
+# Супервизор ботов (manage.py run_bot_supervisor), используется при TELEGRAM_BOT_RUNNER_MODE='supervisor'
+BOT_SUPERVISOR_ADDRESS = ('127.0.0.1', int(os.getenv('BOT_SUPERVISOR_PORT', 8765)))
+BOT_SUPERVISOR_AUTHKEY = os.getenv('BOT_SUPERVISOR_AUTHKEY', '')
+BOT_SUPERVISOR_WORKERS = int(os.getenv('BOT_SUPERVISOR_WORKERS', os.cpu_count() or 1))
+
+# Webhook вместо long polling: публичный адрес сервера (ASGI), пусто — polling.
+# Боты должны работать в ASGI-процессе, режим supervisor webhook не поддерживает.
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_PATH = '/telegram/webhook/'
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+
+# Хранилище состояний пользователей в диалогах: 'sqlite' — таблица в базе бота,
+# 'django' — модель UserBotState (общая для всех процессов), 'memory' — без сохранения.
+# В памяти держится не больше TELEGRAM_BOT_STATE_MAX_USERS пользователей на бота.
+TELEGRAM_BOT_STATE_BACKEND = os.getenv('TELEGRAM_BOT_STATE_BACKEND', 'sqlite')
+TELEGRAM_BOT_STATE_MAX_USERS = int(os.getenv('TELEGRAM_BOT_STATE_MAX_USERS', 10000))
+TELEGRAM_BOT_STATE_TTL = 24 * 3600  # секунды, как expires_at у UserBotState
+# Сколько секунд помнить, что у пользователя нет сохранённого состояния (не ходить за ним в хранилище)
+TELEGRAM_BOT_STATE_MISS_TTL = 60
+# Сколько несохранённых состояний копить, пока хранилище недоступно (самые старые отбрасываются)
+TELEGRAM_BOT_STATE_MAX_PENDING = 100000
+
+# Чат (например, закрытый канал с ботом-админом), куда при старте бота заранее
+# загружаются локальные картинки сценария, чтобы получить их file_id. Пусто — не загружать.
+TELEGRAM_MEDIA_PRELOAD_CHAT_ID = os.getenv('TELEGRAM_MEDIA_PRELOAD_CHAT_ID', '')
+
+# Каталог для записи входящих апдейтов ботов (bot_<id>.jsonl) для manage.py replay_updates.
+# Пусто — не записывать. В записи попадают сообщения пользователей целиком.
+TELEGRAM_UPDATE_RECORDING_DIR = os.getenv('TELEGRAM_UPDATE_RECORDING_DIR', '')
+
 # Настройки для Celery (если будете использовать)
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -2,5 +2,6 @@ from .bot_runner import running_bots
 from .bot_runner import BotRunner
 from .bot_generator import BotGenerator
 from .db_generator import DBGenerator
+from .build_cache import get_build_cache
 
-__all__ = ['running_bots', 'BotRunner', 'BotGenerator', 'DBGenerator']
\ No newline at end of file
+__all__ = ['running_bots', 'BotRunner', 'BotGenerator', 'DBGenerator', 'get_build_cache']
\ No newline at end of file
@@ -0,0 +1,361 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from django.conf import settings
+from . import sqlite_db
+
+logger = logging.getLogger(__name__)
+
+# Commits a database's open group and detaches it from its writer
+_STOP = object()
+
+# Sequence number of the last write submitted by the current task (handler)
+_last_write: ContextVar[int] = ContextVar('last_write', default=0)
+
+
+def fetch_all(sql: str, params=(), *, conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    return conn.execute(sql, params).fetchall()
+
+
+def fetch_one(sql: str, params=(), *, conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
+    return conn.execute(sql, params).fetchone()
+
+
+def open_reader(db_path: str) -> sqlite3.Connection:
+    conn = sqlite_db.connect(db_path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class WriterThread:
+    """
+    Thread running the write jobs of the databases assigned to it: in
+    submission order per database, each with a group commit of its own.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.databases = 0
+        self.queue: 'queue.SimpleQueue[Tuple[AsyncDatabase, Any]]' = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # Databases with uncommitted writes -> [writes, commit deadline, last sequence number]
+        groups: Dict['AsyncDatabase', List] = {}
+        while True:
+            timeout = None
+            if groups:
+                timeout = max(0.0, min(group[1] for group in groups.values()) - time.monotonic())
+            try:
+                database, job = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                database, job = None, None
+
+            try:
+                if job is _STOP:
+                    group = groups.pop(database, None)
+                    if group:
+                        database._commit(group[2])
+                    database._stopped()
+                elif job is not None:
+                    seq = database._run_job(job)
+                    if seq is not None:
+                        group = groups.get(database)
+                        if group is None:
+                            group = groups[database] = [0, time.monotonic() + database.interval, seq]
+                        group[0] += 1
+                        group[2] = seq
+                        if group[0] >= database.max_batch or not database.interval:
+                            del groups[database]
+                            database._commit(seq)
+
+                now = time.monotonic()
+                for expired in [db for db, group in groups.items() if group[1] <= now]:
+                    expired._commit(groups.pop(expired)[2])
+            except Exception as e:
+                # One broken database (e.g. its connection closed) must not stop the others' writes
+                logger.error(f"Database writer {self.name} error: {e}", exc_info=True)
+
+
+class DatabaseThreads:
+    """
+    Writer threads and reader pool shared by all bot databases of the
+    process, so hosting a bot adds no thread. Connections to one database
+    file get the same writer; others go to the least loaded one.
+    """
+
+    def __init__(self, writers: int = 4, readers: int = 2):
+        self.size = max(1, writers)
+        self._writers: List[WriterThread] = []
+        # Database path -> its writer and the number of open AsyncDatabases on it
+        self._by_path: Dict[str, List] = {}
+        self._lock = threading.Lock()
+        self.readers: Optional[ThreadPoolExecutor] = None
+        if readers:
+            self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='bot-db-reader')
+
+    def acquire(self, db_path: Optional[str]) -> WriterThread:
+        with self._lock:
+            assigned = self._by_path.get(db_path) if db_path else None
+            if assigned is not None:
+                assigned[1] += 1
+                return assigned[0]
+            if len(self._writers) < self.size:
+                self._writers.append(WriterThread(f"bot-db-writer-{len(self._writers)}"))
+            writer = min(self._writers, key=lambda w: w.databases)
+            writer.databases += 1
+            if db_path:
+                self._by_path[db_path] = [writer, 1]
+            return writer
+
+    def release(self, writer: WriterThread, db_path: Optional[str]):
+        with self._lock:
+            assigned = self._by_path.get(db_path) if db_path else None
+            if assigned is not None:
+                assigned[1] -= 1
+                if assigned[1] > 0:
+                    return
+                del self._by_path[db_path]
+            writer.databases = max(0, writer.databases - 1)
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [{'name': writer.name, 'databases': writer.databases} for writer in self._writers]
+
+
+_threads: Optional[DatabaseThreads] = None
+_threads_lock = threading.Lock()
+
+
+def get_database_threads() -> DatabaseThreads:
+    """Get process-wide database threads (created lazily)"""
+    global _threads
+    with _threads_lock:
+        if _threads is None:
+            _threads = DatabaseThreads(
+                writers=getattr(settings, 'TELEGRAM_BOT_DB_WRITERS', 4),
+                readers=getattr(settings, 'TELEGRAM_BOT_DB_READERS', 2)
+            )
+        return _threads
+
+
+class AsyncDatabase:
+    """
+    Non-blocking access to a bot database for handlers on the event loop.
+
+    A shared writer thread runs jobs on the bot's connection (`db.conn`)
+    in submission order. Their writes are committed together `interval`
+    seconds after the first one or every `max_batch` writes. Reads run on
+    the shared reader pool, with connections of their own. While writes are
+    not yet committed, reads are queued behind them on the writer instead,
+    so a handler always reads what it wrote. Like asyncio.to_thread, jobs
+    run in the context of the task that submitted them.
+    """
+
+    def __init__(self, db, readers: bool = True, interval: float = 0.005, max_batch: int = 100,
+                 threads: Optional[DatabaseThreads] = None):
+        self.db = db
+        self.interval = interval
+        self.max_batch = max(1, max_batch)
+        # Opens reader connections; the bench wraps it to time them
+        self.connect_reader: Callable[[str], sqlite3.Connection] = open_reader
+
+        self.db_path = sqlite_db.database_path(db.conn)
+        self._threads = threads or get_database_threads()
+        self._readers: Optional[ThreadPoolExecutor] = self._threads.readers if readers and self.db_path else None
+        self._reader_local = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._reader_lock = threading.Lock()
+        self._reads: Set[asyncio.Future] = set()
+
+        # Taken with the first job: a bot that never starts holds no writer
+        self._writer: Optional[WriterThread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closed: Optional[asyncio.Future] = None
+        # Sequence numbers of writes: submitted on the loop, committed by the writer
+        self._submitted = 0
+        self._committed = 0
+        self._durable: List[Tuple[int, asyncio.Future]] = []
+
+        self.commits = 0
+        self.writes = 0
+        self.pool_reads = 0
+        self.writer_reads = 0
+
+        # Writes of BotDatabase methods are committed with their group
+        db.committer = self
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The bot's connection, only to be used in jobs running on the writer"""
+        return self.db.conn
+
+    def add(self):
+        """Called by BotDatabase.commit() on the writer: the commit is left to the group"""
+        return None
+
+    def _enqueue(self, fn: Callable, args, kwargs, future: Optional[asyncio.Future], write: bool):
+        self._loop = asyncio.get_running_loop()
+        if self._writer is None:
+            self._writer = self._threads.acquire(self.db_path)
+        seq = None
+        if write:
+            self._submitted += 1
+            seq = self._submitted
+            _last_write.set(seq)
+        self._writer.queue.put((self, (contextvars.copy_context(), fn, args, kwargs, future, seq)))
+
+    def run(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Run fn(*args) on the writer, resolves to its result once it ran (not yet committed)"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(fn, args, kwargs, future, True)
+        return future
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        """Run fn(*args) on the writer without waiting for it; errors are logged"""
+        self._enqueue(fn, args, kwargs, None, True)
+
+    async def read(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn(*args, conn=connection) on a reader, or on the writer behind uncommitted writes"""
+        if self._readers is None or self._committed < self._submitted:
+            self.writer_reads += 1
+            future = asyncio.get_running_loop().create_future()
+            self._enqueue(lambda: fn(*args, conn=self.db.conn, **kwargs), (), {}, future, False)
+            return await future
+        self.pool_reads += 1
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(
+            self._readers, lambda: context.run(fn, *args, conn=self._reader_connection(), **kwargs)
+        )
+        # close() waits for reads in flight before closing their connections
+        self._reads.add(future)
+        future.add_done_callback(self._reads.discard)
+        return await future
+
+    def durable(self) -> asyncio.Future:
+        """Awaitable completed once the writes submitted by the current task are committed"""
+        future = asyncio.get_running_loop().create_future()
+        target = _last_write.get()
+        if self._committed >= target:
+            future.set_result(None)
+        else:
+            self._durable.append((target, future))
+        return future
+
+    def _reader_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._reader_local, 'conn', None)
+        if conn is None:
+            conn = self._reader_local.conn = self.connect_reader(self.db_path)
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    # The methods below run on the writer thread
+
+    def _run_job(self, job) -> Optional[int]:
+        """Run a queued job, returns its write sequence number (None for reads)"""
+        context, fn, args, kwargs, future, seq = job
+        try:
+            result, error = context.run(fn, *args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+            if future is None:
+                logger.error(f"Database write failed: {e}", exc_info=True)
+        if future is not None:
+            self._call_soon(self._resolve, future, result, error)
+        if seq is not None:
+            self.writes += 1
+        return seq
+
+    def _commit(self, seq: int):
+        error = None
+        conn = self.db.conn
+        # No open transaction: the jobs committed themselves (`with conn:`)
+        if conn.in_transaction:
+            try:
+                conn.commit()
+                self.commits += 1
+            except sqlite3.Error as e:
+                logger.error(f"Group commit failed: {e}")
+                error = e
+                conn.rollback()
+        self._call_soon(self._committed_up_to, seq, error)
+
+    def _stopped(self):
+        self._call_soon(self._resolve, self._closed, None, None)
+
+    def _call_soon(self, callback: Callable, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Loop already closed: nobody is waiting any more
+            pass
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any, error: Optional[Exception]):
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def _committed_up_to(self, seq: int, error: Optional[Exception]):
+        self._committed = max(self._committed, seq)
+        waiting = []
+        for target, future in self._durable:
+            if target > seq:
+                waiting.append((target, future))
+            elif not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+                    # Writers that do not wait for durability should not log "exception never retrieved"
+                    future.exception()
+        self._durable = waiting
+
+    async def close(self):
+        """Run and commit the queued jobs, leave the writer, close reader connections"""
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            self._loop = asyncio.get_running_loop()
+            self._closed = self._loop.create_future()
+            writer.queue.put((self, _STOP))
+            await self._closed
+            self._threads.release(writer, self.db_path)
+        if self._reads:
+            await asyncio.gather(*self._reads, return_exceptions=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'writes': self.writes,
+            'commits': self.commits,
+            'writes_per_commit': round(self.writes / self.commits, 1) if self.commits else 0.0,
+            'pending': self._submitted - self._committed,
+            'pool_reads': self.pool_reads,
+            'writer_reads': self.writer_reads,
+            'writer': self._writer.name if self._writer is not None else None,
+        }
+
+
+def create_async_database(db) -> AsyncDatabase:
+    """Facade configured by TELEGRAM_BOT_DB_* settings"""
+    return AsyncDatabase(
+        db,
+        readers=getattr(settings, 'TELEGRAM_BOT_DB_READERS', 2) > 0,
+        interval=getattr(settings, 'TELEGRAM_BOT_DB_COMMIT_INTERVAL_MS', 5) / 1000,
+        max_batch=getattr(settings, 'TELEGRAM_BOT_DB_COMMIT_BATCH', 100)
+    )
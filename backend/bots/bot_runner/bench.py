@@ -0,0 +1,310 @@
+import asyncio
+import shutil
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from aiogram.client.telegram import TelegramAPIServer
+from django.test.utils import override_settings
+from ..models import TelegramBot
+from .bot_runner import BotRunner
+from .build_cache import get_build_cache
+from .fake_api import FakeBotAPI
+
+BENCH_BOT_ID = 990001
+# Event loop lag is sampled this often while the bench runs
+LOOP_PROBE_INTERVAL = 0.001
+
+# Small flow exercising commands, reply/inline keyboards, input, conditions and DB output
+DEMO_FLOW = {
+    'commands': [{'name': '/start'}],
+    'nodes': [
+        {'id': 'start', 'type': 'startend', 'data': {'isStart': True, 'command': '/start'}},
+        {'id': 'welcome', 'type': 'text', 'data': {'text': 'Welcome'}},
+        {'id': 'choose', 'type': 'button', 'data': {'text': 'Choose', 'buttons': [{'text': 'Answer'}, {'text': 'Menu'}]}},
+        {'id': 'ask', 'type': 'input', 'data': {'prompt': 'Your answer?', 'table': 'answers', 'column': 'answer',
+                                                'successMessage': 'Saved'}},
+        {'id': 'check', 'type': 'condition', 'data': {'condition': 'user_id % 2 == 0'}},
+        {'id': 'answers', 'type': 'dboutput', 'data': {'table': 'answers', 'columns': ['answer'],
+                                                       'message': 'Your answers:'}},
+        {'id': 'odd', 'type': 'text', 'data': {'text': 'Odd user'}},
+        {'id': 'menu', 'type': 'menu', 'data': {'text': 'Menu', 'items': [{'text': 'One', 'action': 'one'},
+                                                                          {'text': 'Two', 'action': 'two'}]}},
+        {'id': 'inline', 'type': 'inline', 'data': {'text': 'Inline', 'buttons': [{'text': 'X', 'action': 'x'},
+                                                                                  {'text': 'Y', 'action': 'y'}]}},
+        {'id': 'picture', 'type': 'image', 'data': {'images': 'https://example.com/picture.png', 'caption': 'Picture'}},
+    ],
+    'edges': [
+        {'source': 'start', 'target': 'welcome'},
+        {'source': 'welcome', 'target': 'choose'},
+        {'source': 'choose', 'target': 'ask', 'data': {'buttonIndex': 0}},
+        {'source': 'choose', 'target': 'menu', 'data': {'buttonIndex': 1}},
+        {'source': 'ask', 'target': 'check'},
+        {'source': 'check', 'target': 'answers', 'label': 'True'},
+        {'source': 'check', 'target': 'odd', 'label': 'False'},
+        {'source': 'answers', 'target': 'inline'},
+        {'source': 'menu', 'target': 'inline'},
+        {'source': 'inline', 'target': 'picture', 'data': {'buttonIndex': 1}},
+    ],
+    'dbConfig': {'tables': [{'name': 'answers', 'columns': [{'name': 'answer', 'type': 'TEXT'}]}], 'schema': {}},
+}
+
+# Accumulated DB seconds of the update being handled. Database jobs run in the context of the
+# handler that submitted them, so the writer and readers add to it; group commits serve many
+# updates and are not counted.
+update_db_time: ContextVar[Optional[List[float]]] = ContextVar('update_db_time', default=None)
+
+
+def _add_db_time(seconds: float):
+    acc = update_db_time.get()
+    if acc is not None:
+        acc[0] += seconds
+
+
+class TimedCursor:
+    """sqlite3 cursor proxy adding the time of each call to the current update"""
+
+    def __init__(self, cursor, delay: float = 0.0):
+        self._cursor = cursor
+        self._delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, name, *args):
+        started = time.perf_counter()
+        try:
+            if self._delay and name.startswith('execute'):
+                time.sleep(self._delay)
+            return getattr(self._cursor, name)(*args)
+        finally:
+            _add_db_time(time.perf_counter() - started)
+
+    def execute(self, *args):
+        self._timed('execute', *args)
+        return self
+
+    def executemany(self, *args):
+        self._timed('executemany', *args)
+        return self
+
+    def fetchone(self):
+        return self._timed('fetchone')
+
+    def fetchmany(self, *args):
+        return self._timed('fetchmany', *args)
+
+    def fetchall(self):
+        return self._timed('fetchall')
+
+
+class TimedConnection:
+    """
+    sqlite3 connection proxy adding the time of each call to the current
+    update; `delay` seconds per statement and commit simulate slow storage
+    """
+
+    def __init__(self, conn, delay: float = 0.0):
+        self._conn = conn
+        self._delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        started = time.perf_counter()
+        try:
+            return self._conn.__exit__(*exc)
+        finally:
+            _add_db_time(time.perf_counter() - started)
+
+    def _timed(self, name, *args):
+        started = time.perf_counter()
+        try:
+            if self._delay:
+                time.sleep(self._delay)
+            return getattr(self._conn, name)(*args)
+        finally:
+            _add_db_time(time.perf_counter() - started)
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor(), self._delay)
+
+    def execute(self, *args):
+        return TimedCursor(self._timed('execute', *args))
+
+    def executemany(self, *args):
+        return TimedCursor(self._timed('executemany', *args))
+
+    def executescript(self, *args):
+        return self._timed('executescript', *args)
+
+    def commit(self):
+        return self._timed('commit')
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def message_update(user_id: int, text: str) -> Dict[str, Any]:
+    message = {
+        'message_id': int(time.monotonic() * 1000) % 2 ** 31,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def callback_update(user_id: int, data: str, bot_id: int, message_id: int = 1) -> Dict[str, Any]:
+    return {'callback_query': {
+        'id': f"{user_id}-{time.monotonic_ns()}",
+        'chat_instance': str(user_id),
+        'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"},
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': bot_id, 'is_bot': True, 'first_name': 'Bot'},
+            'text': '',
+        },
+    }}
+
+
+class BenchBot:
+    """
+    Bot generated from a flow config and run against a FakeBotAPI, polling
+    like in production. Handler time and DB time are measured per update.
+    It is built in a temporary directory, never in telegram_bots: its id
+    may be the one of a real bot.
+    """
+
+    def __init__(self, api: FakeBotAPI, config: Dict[str, Any], bot_id: int = BENCH_BOT_ID,
+                 keep_rate_limits: bool = False, db_latency: float = 0.0):
+        self.api = api
+        self.keep_rate_limits = keep_rate_limits
+        self.db_latency = db_latency
+        self.bot = TelegramBot(id=bot_id, name=f"bench_{bot_id}", token=f"{bot_id}:BENCH", config=config)
+        self.base_dir: Optional[str] = None
+        self.module = None
+        self.flow_bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._probe: Optional[asyncio.Task] = None
+
+        self.handler_times: List[float] = []
+        # Accumulators of handled updates: writes they queued without waiting may finish later
+        self.db_times: List[List[float]] = []
+        self.loop_lags: List[float] = []
+
+    @property
+    def token(self) -> str:
+        return self.bot.token
+
+    def build(self):
+        """Generate and load the bot, then point it at the fake API"""
+        if self.base_dir is None:
+            self.base_dir = tempfile.mkdtemp(prefix='bench_bot_')
+        # BASE_DIR only locates the bot directory; once loaded, the bot uses paths of its own files
+        with override_settings(BASE_DIR=self.base_dir):
+            get_build_cache().ensure(self.bot)
+            self.module = BotRunner(self.bot).load_bot_module()
+        self.flow_bot = self.module.flow_bot
+
+        self.flow_bot.http.api = TelegramAPIServer.from_base(self.api.base_url)
+        if not self.keep_rate_limits:
+            # Measure the runtime, not Telegram's limits
+            self.flow_bot.http.middleware.unregister(self.flow_bot.outbound)
+        self.flow_bot.db.conn = TimedConnection(self.flow_bot.db.conn, self.db_latency)
+        open_reader = self.flow_bot.database.connect_reader
+        self.flow_bot.database.connect_reader = lambda path: TimedConnection(open_reader(path), self.db_latency)
+        self.flow_bot.dp.update.outer_middleware(self.measure)
+
+    async def measure(self, handler, event, data):
+        acc = [0.0]
+        token = update_db_time.set(acc)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            update_db_time.reset(token)
+            self.handler_times.append(elapsed)
+            self.db_times.append(acc)
+            waiter = self._waiting.pop(event.update_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(elapsed)
+
+    async def watch_loop(self):
+        """How late the event loop wakes up a sleeper: time other updates wait behind blocking calls"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_PROBE_INTERVAL)
+            self.loop_lags.append(max(0.0, time.perf_counter() - started - LOOP_PROBE_INTERVAL))
+
+    async def start(self):
+        if self.module is None:
+            self.build()
+        fake = self.api.get_bot(self.token)
+        self._task = asyncio.create_task(self.flow_bot.main(handle_signals=False))
+        while not fake.calls['getupdates']:
+            if self._task.done():
+                raise RuntimeError('Bot stopped before polling started')
+            await asyncio.sleep(0.01)
+        self._probe = asyncio.create_task(self.watch_loop())
+
+    def send(self, update: Dict[str, Any]) -> asyncio.Future:
+        """Push update to the fake API, the future resolves to its handler time"""
+        update_id = self.api.push_update(self.token, update)
+        waiter = self._waiting[update_id] = asyncio.get_running_loop().create_future()
+        return waiter
+
+    async def stop(self, cleanup: bool = True):
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+        if self._task is not None:
+            try:
+                await self.flow_bot.dp.stop_polling()
+            except RuntimeError:
+                pass
+            # Answer the pending long poll now instead of at its timeout
+            self.api.get_bot(self.token).new_updates.set()
+            await self._task
+            self._task = None
+        if cleanup:
+            for name in list(sys.modules):
+                if name.startswith(f"bot_{self.bot.id}."):
+                    del sys.modules[name]
+            if self.base_dir is not None:
+                shutil.rmtree(self.base_dir, ignore_errors=True)
+                self.base_dir = None
+
+    def stats(self) -> Dict[str, Any]:
+        handled = len(self.handler_times)
+        db_times = [acc[0] for acc in self.db_times]
+        return {
+            'updates': handled,
+            'handler_p50_ms': round(percentile(self.handler_times, 0.5) * 1000, 2),
+            'handler_p99_ms': round(percentile(self.handler_times, 0.99) * 1000, 2),
+            'db_ms_per_update': round(sum(db_times) / handled * 1000, 3) if handled else 0.0,
+            'db_p99_ms': round(percentile(db_times, 0.99) * 1000, 3),
+            'loop_lag_p50_ms': round(percentile(self.loop_lags, 0.5) * 1000, 2),
+            'loop_lag_p99_ms': round(percentile(self.loop_lags, 0.99) * 1000, 2),
+            'loop_lag_max_ms': round(max(self.loop_lags, default=0.0) * 1000, 2),
+        }
@@ -1,11 +1,19 @@
 import asyncio
 import threading
+import concurrent.futures
 import importlib.util
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from ..bot_worker import STOP_TIMEOUT
 from ..models import TelegramBot
+from .loop_pool import get_loop_pool
+from .supervisor import SupervisorClient
+from .bot_generator import BotGenerator
+from .build_cache import get_build_cache
+from . import webhooks
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +33,8 @@ class BotRunner:
     def load_bot_module(self):
         """Dynamically load bot module"""
         bot_dir = self.get_bot_directory()
+        cache = get_build_cache()
+        build_hash = cache.current_hash(self.bot)
         
         import sys
         sys.path.insert(0, str(bot_dir.parent))
@@ -37,7 +47,7 @@ class BotRunner:
             )
             db_module = importlib.util.module_from_spec(db_spec)
             sys.modules[f"bot_{self.bot.id}.bot_database"] = db_module
-            db_spec.loader.exec_module(db_module)
+            exec(cache.get_code(bot_dir / 'bot_database.py', build_hash), db_module.__dict__)
             
             # Then load main bot module
             spec = importlib.util.spec_from_file_location(
@@ -46,7 +56,7 @@ class BotRunner:
             )
             module = importlib.util.module_from_spec(spec)
             sys.modules[f"bot_{self.bot.id}.bot"] = module
-            spec.loader.exec_module(module)
+            exec(cache.get_code(bot_dir / 'bot.py', build_hash), module.__dict__)
             
             module.db = db_module.db
             
@@ -54,54 +64,213 @@ class BotRunner:
         finally:
             sys.path.remove(str(bot_dir.parent))
     
-    async def run_bot_async(self):
-        """Async bot runner"""
+    def _mark_stopped(self):
+        """Drop bot from running registry and persist inactive status"""
+        running_bots.pop(self.bot.token, None)
+        self.bot.is_active = False
+        self.bot.save()
+
+    async def run_bot_async(self, bot_module=None, finished: Optional[threading.Event] = None):
+        """Async bot runner, sets `finished` once the bot has shut down"""
         try:
-            bot_module = self.load_bot_module()
-            await bot_module.main()
+            if bot_module is None:
+                bot_module = self.load_bot_module()
+            if self.bot.token in running_bots:
+                running_bots[self.bot.token]['module'] = bot_module
+            
+            webhook_url = webhooks.get_webhook_url(self.bot.token)
+            if webhook_url:
+                webhooks.register_bot(self.bot.token, bot_module.bot, bot_module.dp)
+                try:
+                    _, secret_token = webhooks.get_webhook_secrets(self.bot.token)
+                    await bot_module.main(
+                        handle_signals=False,
+                        webhook_url=webhook_url,
+                        webhook_secret=secret_token
+                    )
+                finally:
+                    webhooks.unregister_bot(self.bot.token)
+            else:
+                await bot_module.main(handle_signals=False)
         except Exception as e:
             logger.error(f"Error in bot {self.bot.id}: {str(e)}", exc_info=True)
-            if self.bot.token in running_bots:
+            await sync_to_async(self._mark_stopped)()
+        finally:
+            if finished is not None:
+                finished.set()
+    
+    def start(self):
+        """Start bot using runner mode from settings"""
+        mode = getattr(settings, 'TELEGRAM_BOT_RUNNER_MODE', 'shared')
+        if mode == 'supervisor':
+            response = SupervisorClient().request('start', self.bot.id)
+            if not response.get('ok'):
+                raise RuntimeError(response.get('error', 'Bot supervisor has no live workers'))
+        elif mode == 'thread':
+            thread = threading.Thread(target=self.run_bot, daemon=True)
+            thread.start()
+        else:
+            self.run_bot_shared()
+    
+    def run_bot_shared(self):
+        """Run bot as a task on a loop from the shared loop pool"""
+        # Import in the calling thread so module setup does not block other bots on the loop
+        bot_module = self.load_bot_module()
+        
+        pool = get_loop_pool()
+        # Webhook updates arrive on the ASGI server loop, host the bot there when possible
+        loop_thread = pool.acquire(prefer_adopted=webhooks.webhook_enabled())
+        bot_info = {
+            'loop': loop_thread.loop,
+            'loop_thread': loop_thread,
+            'finished': threading.Event()
+        }
+        # Register before scheduling so a fast failure can't leave a stale entry
+        running_bots[self.bot.token] = bot_info
+        task = loop_thread.submit(self.run_bot_async(bot_module, bot_info['finished']))
+        bot_info['task'] = task
+        
+        def on_done(_):
+            pool.release(loop_thread)
+            if running_bots.get(self.bot.token) is bot_info:
                 del running_bots[self.bot.token]
-            self.bot.is_active = False
-            self.bot.save()
+            logger.info(f"Bot {self.bot.id} task finished")
+        
+        task.add_done_callback(on_done)
+        logger.info(f"Starting bot {self.bot.id} on {loop_thread.name}")
+        return task
     
     def run_bot(self):
         """Run bot in a separate thread"""
+        loop = asyncio.new_event_loop()
         try:
-            loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             
+            finished = threading.Event()
+            task = loop.create_task(self.run_bot_async(finished=finished))
             running_bots[self.bot.token] = {
                 'loop': loop,
-                'thread': threading.current_thread()
+                'thread': threading.current_thread(),
+                'task': task,
+                'finished': finished
             }
             
             logger.info(f"Starting bot {self.bot.id}")
-            loop.run_until_complete(self.run_bot_async())
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            logger.info(f"Bot {self.bot.id} stopped")
         except Exception as e:
             logger.error(f"Error starting bot {self.bot.id}: {str(e)}", exc_info=True)
-            if self.bot.token in running_bots:
-                del running_bots[self.bot.token]
-            self.bot.is_active = False
-            self.bot.save()
+            self._mark_stopped()
+        finally:
+            loop.close()
+    
+    def reload_flow(self, timeout: float = 5.0):
+        """
+        Atomically replace flow of the running bot without restarting it.
+        Returns reload stats, or None if the bot is not running here or
+        the change touches generated code (commands, broadcasts, dbConfig).
+        """
+        if getattr(settings, 'TELEGRAM_BOT_RUNNER_MODE', 'shared') == 'supervisor':
+            # Stats of the worker's swap, None when it needs a restart
+            response = SupervisorClient().request('reload', self.bot.id)
+            if not response.get('ok'):
+                logger.warning(f"Bot {self.bot.id} reload in supervisor failed: {response.get('error')}")
+                return None
+            return response.get('stats')
+        
+        bot_info = running_bots.get(self.bot.token)
+        if not bot_info or 'module' not in bot_info:
+            return None
+        
+        module = bot_info['module']
+        new_config = self.bot.config
+        if BotGenerator.get_code_signature(module.flow_bot.config) != BotGenerator.get_code_signature(new_config):
+            logger.info(f"Bot {self.bot.id} flow change needs restart")
+            return None
+        
+        result = concurrent.futures.Future()
+        
+        def swap():
+            try:
+                result.set_result(module.reload_config(new_config))
+            except Exception as e:
+                result.set_exception(e)
+        
+        # Run on the bot's loop so no handler sees a half-swapped flow
+        bot_info['loop'].call_soon_threadsafe(swap)
+        stats = result.result(timeout=timeout)
+        
+        # Keep generated files in sync for the next cold start
+        get_build_cache().ensure(self.bot)
+        return stats
+    
+    def restart(self):
+        """Stop the bot, wait until it has shut down, then start it with regenerated files"""
+        # Polling twice with one token (TelegramConflictError) or sharing state tables is avoided
+        self.stop_bot(mark_inactive=False, timeout=STOP_TIMEOUT)
+        get_build_cache().ensure(self.bot)
+        self.start()
     
-    def stop_bot(self):
-        """Stop running bot"""
+    def get_runtime_stats(self):
+        """Dispatch counters of a bot running in this process, None otherwise"""
+        bot_info = running_bots.get(self.bot.token)
+        if not bot_info or 'module' not in bot_info:
+            return None
+        return bot_info['module'].flow_bot.stats()
+    
+    @staticmethod
+    def _request_stop(bot_info: Dict):
+        """On the bot's loop: let main() return and shut down, or cancel it while it starts"""
+        module = bot_info.get('module')
+        task = bot_info['task']
+        if module is None:
+            task.cancel()
+            return
+        
+        async def stop():
+            if not await module.flow_bot.stop():
+                task.cancel()
+        
+        asyncio.ensure_future(stop())
+    
+    def is_running(self) -> bool:
+        """Check whether bot is running in this process or under the supervisor"""
+        if getattr(settings, 'TELEGRAM_BOT_RUNNER_MODE', 'shared') == 'supervisor':
+            return SupervisorClient().request('is_running', self.bot.id).get('running', False)
+        return self.bot.token in running_bots
+    
+    def stop_bot(self, mark_inactive: bool = True, timeout: Optional[float] = None):
+        """
+        Stop running bot. With `timeout`, wait up to that many seconds for
+        its shutdown (state flush, database writer, session) to finish.
+        """
+        if getattr(settings, 'TELEGRAM_BOT_RUNNER_MODE', 'shared') == 'supervisor':
+            # The supervisor always waits for the worker to shut the bot down
+            if not SupervisorClient().request('stop', self.bot.id, mark_inactive=mark_inactive).get('ok'):
+                return False
+            if mark_inactive:
+                self.bot.is_active = False
+                self.bot.save()
+            return True
+        
         if self.bot.token not in running_bots:
             return False
         
         try:
             bot_info = running_bots[self.bot.token]
-            loop = bot_info['loop']
             
-            # Stop event loop
-            loop.call_soon_threadsafe(loop.stop)
+            # Only this bot's task ends, a shared loop keeps running
+            bot_info['loop'].call_soon_threadsafe(self._request_stop, bot_info)
             
-            del running_bots[self.bot.token]
-            self.bot.is_active = False
-            self.bot.save()
+            running_bots.pop(self.bot.token, None)
+            if mark_inactive:
+                self.bot.is_active = False
+                self.bot.save()
             
+            finished = bot_info.get('finished')
+            if timeout is not None and finished is not None and not finished.wait(timeout):
+                logger.warning(f"Bot {self.bot.id} did not shut down within {timeout}s")
             return True
         except Exception as e:
             logger.error(f"Error stopping bot: {str(e)}", exc_info=True)
@@ -0,0 +1,263 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from .async_db import fetch_all, fetch_one
+from .outbound import outbound_lane
+
+# Recipients read from the users table per query
+BATCH_SIZE = 500
+# Sends in flight at once
+CONCURRENCY = 20
+MAX_RETRIES = 3
+# Delivered recipients are checkpointed every this many sends
+FLUSH_EVERY = 50
+
+TARGET_FILTERS = {
+    'all': '1 = 1',
+    'active': "last_active > datetime('now', '-7 days')",
+    'inactive': "last_active <= datetime('now', '-7 days')",
+}
+
+Sender = Callable[[int], Awaitable]
+
+
+class BroadcastEngine:
+    """
+    Sends broadcast nodes to their audience: payload rendered once,
+    recipients streamed in user_id order, bounded concurrency in the
+    outbound scheduler's bulk lane. Progress is checkpointed in the bot database,
+    so a run interrupted by a restart resumes where it stopped. Recipients are
+    read on the database reader pool, checkpoints are queued to its writer.
+    """
+
+    def __init__(self, flow_bot, concurrency: int = CONCURRENCY, batch_size: int = BATCH_SIZE):
+        self.flow_bot = flow_bot
+        self.database = flow_bot.database
+        # Tables are created before the writer takes jobs, later writes run on it
+        self.conn = flow_bot.db.conn
+        self.logger = flow_bot.logger
+        self.batch_size = batch_size
+
+        self.active: Dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+        self.create_tables()
+
+    def create_tables(self):
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS bot_broadcast_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            node_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            checkpoint INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''')
+        # Recipients past the checkpoint already handled (at most one batch per run)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS bot_broadcast_deliveries (
+            run_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            ok INTEGER NOT NULL,
+            PRIMARY KEY (run_id, user_id)
+        )''')
+        self.conn.commit()
+
+    def render_payload(self, node: Dict) -> Optional[Sender]:
+        """Resolve the message node once and return a send function per recipient"""
+        graph = self.flow_bot.graph
+        bot = self.flow_bot.bot
+
+        next_edge = graph.next_edge(node['id'])
+        next_node = graph.get_node(next_edge['target']) if next_edge else None
+        if not next_node:
+            return None
+
+        node_type = next_node.get('type')
+        node_data = next_node.get('data', {})
+
+        if node_type == 'text':
+            text = node_data.get('text', '')
+            if not text:
+                return None
+            return lambda chat_id: bot.send_message(chat_id=chat_id, text=text)
+
+        if node_type == 'image':
+            image_url = node_data.get('images', '')
+            caption = node_data.get('content', '') or node_data.get('caption', '')
+            if image_url.startswith(('http://', 'https://')):
+                return lambda chat_id: bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption)
+            if image_url and os.path.exists(image_url):
+                # Uploaded once, then every recipient gets the file_id
+                return lambda chat_id: self.flow_bot.media.send_photo(
+                    lambda photo: bot.send_photo(chat_id=chat_id, photo=photo, caption=caption),
+                    image_url
+                )
+            return lambda chat_id: bot.send_message(chat_id=chat_id, text="Image not found")
+
+        return None
+
+    async def run(self, node_id: str, run_id: Optional[int] = None):
+        running = self.active.get(node_id)
+        if running is not None and not running.done():
+            self.logger.warning(f"⚠️ Broadcast {node_id} is still running, skipped")
+            return
+
+        self.active[node_id] = asyncio.current_task()
+        try:
+            await self._run(node_id, run_id)
+        finally:
+            self.active.pop(node_id, None)
+
+    async def _run(self, node_id: str, run_id: Optional[int]):
+        self.logger.info(f"⏰ Starting broadcast task for node {node_id}")
+        # Rate limits are applied by the outbound scheduler, replies go first
+        outbound_lane.set('bulk')
+
+        node = self.flow_bot.graph.get_node(node_id)
+        send = self.render_payload(node) if node else None
+        if send is None:
+            self.logger.error(f"❌ Broadcast node {node_id} not found or has no message to send")
+            if run_id is not None:
+                self._finish(run_id, 'cancelled')
+            return
+
+        target = node.get('data', {}).get('target', 'all')
+        where = TARGET_FILTERS.get(target)
+        if where is None:
+            self.logger.error(f"❌ Broadcast node {node_id} has unknown target {target!r}")
+            if run_id is not None:
+                self._finish(run_id, 'cancelled')
+            return
+
+        if run_id is None:
+            run_id = await self.database.run(self._start_run, node_id)
+            checkpoint, sent, failed = 0, 0, 0
+        else:
+            progress = await self.database.read(
+                fetch_one, 'SELECT checkpoint, sent, failed FROM bot_broadcast_runs WHERE id = ?', (run_id,)
+            )
+            if progress is None:
+                self.logger.error(f"❌ Broadcast run {run_id} not found, not resumed")
+                return
+            checkpoint, sent, failed = progress
+            self.logger.info(f"🔁 Resuming broadcast run {run_id} after user {checkpoint}")
+
+        handled: Set[int] = {
+            row[0] for row in await self.database.read(
+                fetch_all, 'SELECT user_id FROM bot_broadcast_deliveries WHERE run_id = ?', (run_id,)
+            )
+        }
+        pending: List[Tuple[int, int, int]] = []
+        counters = {'sent': sent, 'failed': failed}
+
+        async def deliver(user_id: int):
+            ok = await self.deliver(send, user_id)
+            counters['sent' if ok else 'failed'] += 1
+            pending.append((run_id, user_id, int(ok)))
+            if len(pending) >= FLUSH_EVERY:
+                self._checkpoint(run_id, None, counters, pending)
+
+        try:
+            while True:
+                # Keyset pagination: memory stays flat whatever the audience size
+                rows = await self.database.read(
+                    fetch_all,
+                    f"SELECT user_id FROM users WHERE user_id > ? AND {where} ORDER BY user_id LIMIT ?",
+                    (checkpoint, self.batch_size)
+                )
+                if not rows:
+                    break
+
+                await asyncio.gather(*(deliver(row[0]) for row in rows if row[0] not in handled))
+                checkpoint = rows[-1][0]
+                handled.clear()
+                self._checkpoint(run_id, checkpoint, counters, pending)
+        except asyncio.CancelledError:
+            # Bot stopped: record finished sends so resume does not repeat them
+            self._checkpoint(run_id, None, counters, pending)
+            raise
+
+        self._finish(run_id, 'done')
+        self.logger.info(
+            f"✅ Broadcast completed. Success: {counters['sent']}, Failed: {counters['failed']}"
+        )
+
+    async def deliver(self, send: Sender, user_id: int) -> bool:
+        async with self._semaphore:
+            for _ in range(MAX_RETRIES + 1):
+                try:
+                    await send(user_id)
+                    return True
+                except TelegramRetryAfter as e:
+                    # The scheduler holds every send until the pause is over
+                    self.logger.warning(f"⏳ Flood control, broadcast paused for {e.retry_after}s")
+                except (TelegramForbiddenError, TelegramBadRequest):
+                    # Blocked the bot or chat is gone: retrying will not help
+                    return False
+                except Exception as e:
+                    self.logger.debug(f"Broadcast to {user_id} failed: {e}")
+                    return False
+            return False
+
+    def _checkpoint(self, run_id: int, checkpoint: Optional[int], counters: Dict[str, int],
+                    pending: List[Tuple[int, int, int]]):
+        """Queue progress to the database writer, committed with its next group"""
+        self.database.submit(self._save_checkpoint, run_id, checkpoint, dict(counters), list(pending))
+        pending.clear()
+
+    def _finish(self, run_id: int, status: str):
+        self.database.submit(self._save_finish, run_id, status)
+
+    # The methods below run on the database writer
+
+    def _start_run(self, node_id: str) -> int:
+        # Committed with the writer's current group, like the checkpoints
+        return self.conn.execute('INSERT INTO bot_broadcast_runs (node_id) VALUES (?)', (node_id,)).lastrowid
+
+    def _save_checkpoint(self, run_id: int, checkpoint: Optional[int], counters: Dict[str, int],
+                         delivered: List[Tuple[int, int, int]]):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO bot_broadcast_deliveries (run_id, user_id, ok) VALUES (?, ?, ?)',
+            delivered
+        )
+        if checkpoint is None:
+            self.conn.execute(
+                'UPDATE bot_broadcast_runs SET sent = ?, failed = ? WHERE id = ?',
+                (counters['sent'], counters['failed'], run_id)
+            )
+        else:
+            self.conn.execute(
+                'UPDATE bot_broadcast_runs SET checkpoint = ?, sent = ?, failed = ? WHERE id = ?',
+                (checkpoint, counters['sent'], counters['failed'], run_id)
+            )
+            self.conn.execute(
+                'DELETE FROM bot_broadcast_deliveries WHERE run_id = ? AND user_id <= ?',
+                (run_id, checkpoint)
+            )
+
+    def _save_finish(self, run_id: int, status: str):
+        self.conn.execute(
+            'UPDATE bot_broadcast_runs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (status, run_id)
+        )
+        self.conn.execute('DELETE FROM bot_broadcast_deliveries WHERE run_id = ?', (run_id,))
+
+    async def resume(self):
+        """Continue runs interrupted by a restart, must be called on the bot's loop"""
+        for run_id, node_id in await self.database.read(
+            fetch_all, "SELECT id, node_id FROM bot_broadcast_runs WHERE status = 'running'"
+        ):
+            asyncio.create_task(self.run(node_id, run_id))
+
+    async def cancel_all(self):
+        """Stop sending; runs stay 'running' and resume at next start"""
+        tasks = list(self.active.values())
+        for task in tasks:
+            task.cancel()
+        # Their last checkpoints have to be queued before the database writer stops
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {'running': sorted(self.active)}
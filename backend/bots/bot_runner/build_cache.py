@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from types import CodeType
+from typing import Dict, Optional, Tuple
+from ..models import TelegramBot
+from .bot_generator import BotGenerator
+from .db_generator import DBGenerator
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'build.json'
+GENERATED_FILES = ('bot.py', 'bot_database.py')
+
+
+def _generator_version() -> str:
+    """Hash of generator sources, so a new template invalidates old builds"""
+    digest = hashlib.sha256()
+    for module_file in sorted(Path(__file__).parent.glob('*_generator.py')):
+        digest.update(module_file.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class BuildCache:
+    """
+    Content-hash cache of generated bot files and their compiled code.
+    Files are regenerated only when the hash of config (plus token and
+    generator version) differs from the one recorded in the manifest.
+    """
+
+    def __init__(self, max_code_entries: int = 512):
+        self.max_code_entries = max_code_entries
+        self.hits = 0
+        self.misses = 0
+        self.generator_version = _generator_version()
+        self._code: 'OrderedDict[Tuple[str, str, int], CodeType]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def config_hash(self, bot: TelegramBot) -> str:
+        payload = json.dumps(
+            {'config': bot.config, 'token': bot.token, 'generator': self.generator_version},
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def read_manifest(self, bot_dir: Path) -> Dict:
+        try:
+            return json.loads((bot_dir / MANIFEST_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+    def ensure(self, bot: TelegramBot) -> Tuple[str, bool]:
+        """Make sure generated files match current config, returns (hash, cache hit)"""
+        build_hash = self.config_hash(bot)
+        bot_dir = BotGenerator(bot).get_bot_directory()
+
+        manifest = self.read_manifest(bot_dir)
+        files_exist = all((bot_dir / name).exists() for name in GENERATED_FILES + ('bot.db',))
+        if manifest.get('hash') == build_hash and files_exist:
+            with self._lock:
+                self.hits += 1
+            return build_hash, True
+
+        with self._lock:
+            self.misses += 1
+        BotGenerator(bot).create_bot_file()
+        DBGenerator(bot).create_db_file()
+        # Compile right away: syntax errors surface here, bytecode is ready for start
+        for name in GENERATED_FILES:
+            self.get_code(bot_dir / name, build_hash)
+        (bot_dir / MANIFEST_NAME).write_text(
+            json.dumps({'hash': build_hash, 'generator': self.generator_version}),
+            encoding='utf-8'
+        )
+        logger.info(f"Generated bot {bot.id} files for build {build_hash[:12]}")
+        return build_hash, False
+
+    def current_hash(self, bot: TelegramBot) -> Optional[str]:
+        return self.read_manifest(BotGenerator(bot).get_bot_directory()).get('hash')
+
+    def get_code(self, path: Path, build_hash: Optional[str]) -> CodeType:
+        """Compiled code of a generated file, shared by every load of the same build"""
+        if build_hash is None:
+            return compile(path.read_bytes(), str(path), 'exec')
+
+        # mtime guards against files rewritten outside the cache (e.g. DB import)
+        key = (str(path), build_hash, path.stat().st_mtime_ns)
+        with self._lock:
+            code = self._code.get(key)
+            if code is not None:
+                self._code.move_to_end(key)
+                return code
+
+        code = compile(path.read_bytes(), str(path), 'exec')
+        with self._lock:
+            self._code[key] = code
+            while len(self._code) > self.max_code_entries:
+                self._code.popitem(last=False)
+        return code
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'compiled_entries': len(self._code),
+                'generator_version': self.generator_version
+            }
+
+
+_cache: Optional[BuildCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_build_cache() -> BuildCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = BuildCache()
+        return _cache
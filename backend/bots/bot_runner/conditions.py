@@ -0,0 +1,99 @@
+import ast
+from typing import Any, Dict, FrozenSet, Optional, Union
+
+# Functions a condition may call
+SAFE_FUNCTIONS = {
+    'len': len,
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'abs': abs,
+    'min': min,
+    'max': max,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.IfExp, ast.Name, ast.Load, ast.Constant,
+    ast.Tuple, ast.List, ast.Set, ast.Call,
+)
+# Repeating a sequence can build a result of any size from a short expression
+SEQUENCE_TYPES = (str, bytes, list, tuple)
+
+
+def _multiply(left: Any, right: Any) -> Any:
+    """`left * right` of a condition, numbers only"""
+    if isinstance(left, SEQUENCE_TYPES) or isinstance(right, SEQUENCE_TYPES):
+        raise ConditionError("Sequences cannot be multiplied in conditions")
+    return left * right
+
+
+def _is_sequence_literal(node: ast.AST) -> bool:
+    return (isinstance(node, (ast.Tuple, ast.List, ast.Set))
+            or isinstance(node, ast.Constant) and isinstance(node.value, SEQUENCE_TYPES)
+            or isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'str')
+
+
+class _CheckedMultiply(ast.NodeTransformer):
+    """Multiplications go through _multiply: variables may hold strings"""
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Mult):
+            return node
+        call = ast.Call(func=ast.Name(id='_multiply', ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+        return ast.copy_location(call, node)
+
+
+class ConditionError(ValueError):
+    """Condition expression is not valid or not allowed"""
+
+
+class CompiledCondition:
+    """Condition validated and compiled once, evaluated per user"""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ConditionError(f"Invalid condition {expression!r}: {e.msg}") from e
+
+        names = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ConditionError(f"{type(node).__name__} is not allowed in condition {expression!r}")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in SAFE_FUNCTIONS or node.keywords:
+                    raise ConditionError(f"Only {', '.join(SAFE_FUNCTIONS)} can be called in condition {expression!r}")
+            elif isinstance(node, ast.Name) and node.id not in SAFE_FUNCTIONS:
+                names.add(node.id)
+            elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult) and (
+                    _is_sequence_literal(node.left) or _is_sequence_literal(node.right)):
+                raise ConditionError(f"Sequences cannot be multiplied in condition {expression!r}")
+
+        # Variables the context must provide
+        self.names: FrozenSet[str] = frozenset(names)
+        tree = ast.fix_missing_locations(_CheckedMultiply().visit(tree))
+        self._code = compile(tree, '<condition>', 'eval')
+
+    @property
+    def needs_profile(self) -> bool:
+        return bool(self.names - {'user_id'})
+
+    def evaluate(self, context: Dict[str, Any]) -> Any:
+        # Unknown variables raise NameError, like the plain eval() used to
+        return eval(self._code, {'__builtins__': SAFE_FUNCTIONS, '_multiply': _multiply}, context)
+
+
+def try_compile_condition(expression: Optional[str]) -> Union[CompiledCondition, ConditionError]:
+    """CompiledCondition or the ConditionError explaining why it was rejected"""
+    try:
+        return CompiledCondition(expression or '')
+    except ConditionError as e:
+        return e
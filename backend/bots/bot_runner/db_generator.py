@@ -1,14 +1,20 @@
+import hashlib
 import json
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import sqlite3
 import logging
 
 from django.conf import settings
 from ..models import TelegramBot
+from .schema_catalog import forget_catalog
+from .sqlite_db import replace_database
 
 logger = logging.getLogger(__name__)
 
+# Seed rows of dbConfig.schema, loaded by the generated BotDatabase
+SEED_FILE = 'seed.jsonl'
+
 class DBGenerator:
     def __init__(self, bot: TelegramBot):
         self.bot = bot
@@ -23,6 +29,7 @@ class DBGenerator:
         db_file = bot_dir / 'bot_database.py'
         
         db_config = self.bot.config.get('dbConfig', {'tables': [], 'schema': {}})
+        seed_version = self.write_seed_file(bot_dir, db_config.get('schema', {}))
         
         db_code = f"""
 import sqlite3
@@ -32,9 +39,15 @@ from typing import Optional, Dict, Any, List, Union
 import json
 import os
 from datetime import datetime
+from bots.bot_runner.schema_catalog import get_catalog
+from bots.bot_runner.sqlite_db import connect
 null=None
 logger = logging.getLogger(__name__)
 DB_PATH = Path(__file__).parent / 'bot.db'
+SEED_PATH = Path(__file__).parent / '{SEED_FILE}'
+# Hash of the seed file; a database records the versions it has loaded
+SEED_VERSION = {json.dumps(seed_version)}
+SEED_BATCH_SIZE = 1000
 
 # SQLite type mapping
 SQLITE_TYPE_MAP = {{
@@ -49,9 +62,15 @@ SQLITE_TYPE_MAP = {{
 }}
 
 class BotDatabase:
+    # Set by the bot runtime: its database writer commits the writes of all handlers together
+    committer = None
+
     def __init__(self):
-        self.conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+        # WAL, busy timeout and cache settings shared with the admin API
+        self.conn = connect(DB_PATH, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        # Column metadata and INSERT/UPDATE text per table, reloaded on schema changes
+        self.schema = get_catalog(DB_PATH)
         self.create_tables()
         self.initialize_data()
     
@@ -135,6 +154,16 @@ class BotDatabase:
                 cursor.execute(f'CREATE TABLE IF NOT EXISTS {{table_name}} ({{columns_sql}})')
                 logger.info(f"Created table {{table_name}}")
             
+            # Indexes for the per-user reads, also added to tables created before them or imported:
+            # get_user_data and dboutput (newest first), update_last_record (highest id; entries
+            # of a one-column index are ordered by rowid, i.e. id, within each user)
+            for table in tables:
+                if table.get('name'):
+                    self.create_index(cursor, table['name'], ('user_id', 'created_at'))
+                    self.create_index(cursor, table['name'], ('user_id',))
+            # Admin users page: ORDER BY last_active DESC
+            self.create_index(cursor, 'users', ('last_active',))
+            
             self.conn.commit()
             logger.info("Tables created successfully")
         except Exception as e:
@@ -142,62 +171,99 @@ class BotDatabase:
             self.conn.rollback()
             raise
     
+    def create_index(self, cursor, table_name: str, columns: tuple):
+        \"\"\"CREATE INDEX IF NOT EXISTS, skipped when the table lacks one of the columns\"\"\"
+        table = self.schema.table(self.conn, table_name)
+        if table is None or not set(columns) <= set(table.names):
+            return
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{{table_name}}_{{'_'.join(columns)}} "
+            f"ON {{table_name}} ({{', '.join(columns)}})"
+        )
+    
     def initialize_data(self):
-        \"\"\"Initialize base data with proper type conversion\"\"\"
+        \"\"\"Load seed rows once per seed version, skipping rows or keys the tables already hold\"\"\"
+        if SEED_VERSION is None:
+            return
         cursor = self.conn.cursor()
         try:
-            schema = {json.dumps(db_config.get('schema', {}), indent=4, ensure_ascii=False)}
-            
-            for table_name, rows in schema.items():
-                if not isinstance(rows, list):
-                    continue
-                
-                cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-                if not cursor.fetchone():
-                    continue
-                
-                # Get column types for this table
-                cursor.execute(f"PRAGMA table_info({{table_name}})")
-                columns_info = cursor.fetchall()
-                column_types = {{col[1]: col[2].upper() for col in columns_info}}
-                
-                for row in rows:
-                    if not isinstance(row, dict):
-                        continue
-                    
-                    processed_row = {{}}
-                    for col_name, value in row.items():
-                        if col_name.lower() == 'id':
-                            continue
-                            
-                        col_type = column_types.get(col_name)
-                        if col_type:
-                            # Convert values according to type
-                            if col_type == 'INTEGER' and isinstance(value, bool):
-                                processed_row[col_name] = int(value)
-                            elif col_type in ('DATE', 'DATETIME') and isinstance(value, str):
-                                # Just store as-is, validation should happen elsewhere
-                                processed_row[col_name] = value
-                            else:
-                                processed_row[col_name] = value
-                        else:
-                            processed_row[col_name] = value
-                    
-                    if not processed_row:
-                        continue
-                    
-                    columns = list(processed_row.keys())
-                    query = f'''
-                        INSERT INTO {{table_name}} ({{", ".join(columns)}}) 
-                        VALUES ({{", ".join(["?"] * len(columns))}})
-                    '''
-                    cursor.execute(query, list(processed_row.values()))
-            
+            cursor.execute('''CREATE TABLE IF NOT EXISTS bot_seed (
+                version TEXT PRIMARY KEY,
+                inserted INTEGER NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute("SELECT 1 FROM bot_seed WHERE version = ?", (SEED_VERSION,))
+            if cursor.fetchone():
+                self.conn.commit()
+                return
+            if not SEED_PATH.exists():
+                logger.warning(f"Seed file {{SEED_PATH}} is missing, no seed data loaded")
+                self.conn.commit()
+                return
+
+            # Rows are staged per table and column set, then copied except those already present:
+            # identical rows in tables without a key, rows whose primary or unique key exists otherwise
+            staged = {{}}
+            for table, columns, values in self.read_seed():
+                key = (table.name, columns)
+                if key not in staged:
+                    temp_table = f"seed_{{len(staged)}}"
+                    cursor.execute(
+                        f"CREATE TEMP TABLE {{temp_table}} AS SELECT {{', '.join(columns)}} FROM {{table.name}} WHERE 0"
+                    )
+                    staged[key] = (temp_table, [])
+                temp_table, batch = staged[key]
+                batch.append(values)
+                if len(batch) >= SEED_BATCH_SIZE:
+                    cursor.executemany(f"INSERT INTO {{temp_table}} VALUES ({{', '.join('?' * len(columns))}})", batch)
+                    batch.clear()
+
+            inserted = 0
+            for (table_name, columns), (temp_table, batch) in staged.items():
+                if batch:
+                    cursor.executemany(f"INSERT INTO {{temp_table}} VALUES ({{', '.join('?' * len(columns))}})", batch)
+                columns_sql = ', '.join(columns)
+                cursor.execute(
+                    f"INSERT OR IGNORE INTO {{table_name}} ({{columns_sql}}) "
+                    f"SELECT {{columns_sql}} FROM {{temp_table}} EXCEPT SELECT {{columns_sql}} FROM {{table_name}}"
+                )
+                inserted += cursor.rowcount
+                cursor.execute(f"DROP TABLE {{temp_table}}")
+
+            cursor.execute("INSERT INTO bot_seed (version, inserted) VALUES (?, ?)", (SEED_VERSION, inserted))
             self.conn.commit()
+            logger.info(f"Seed {{SEED_VERSION[:12]}} applied: {{inserted}} new rows")
         except Exception as e:
             logger.error(f"Error initializing data: {{e}}")
             self.conn.rollback()
+
+    def read_seed(self):
+        \"\"\"(table, columns, values) of each seed row of an existing table, streamed from seed.jsonl\"\"\"
+        with open(SEED_PATH, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                table = self.schema.table(self.conn, record['table'])
+                if table is None:
+                    continue
+                row = record['row']
+                # Ids are assigned by this database
+                columns = tuple(col for col in table.names if col in row and col.lower() != 'id')
+                if columns:
+                    yield table, columns, [row[col] for col in columns]
     
+    def commit(self):
+        \"\"\"Commit now, or leave the write to the group commit of the bot's database writer\"\"\"
+        if self.committer is not None:
+            return self.committer.add()
+        self.conn.commit()
+
+    def rollback(self):
+        \"\"\"Undo a failed write\"\"\"
+        # With group commit the open transaction holds other handlers' writes;
+        # SQLite has already undone the failed statement, so it is kept
+        if self.committer is None:
+            self.conn.rollback()
+
     def save_user_data(self, user_id: int, table_name: str, data: dict) -> bool:
         \"\"\"Save user data to database with proper error handling\"\"\"
         try:
@@ -252,14 +318,13 @@ class BotDatabase:
                         is_bot
                     ))
                 
-                self.conn.commit()
+                self.commit()
                 logger.debug("User data saved successfully")
                 return True
             
             # For other tables
-            cursor.execute(f"PRAGMA table_info({{table_name}})")
-            columns_info = cursor.fetchall()
-            if not columns_info:
+            table = self.schema.table(self.conn, table_name)
+            if table is None:
                 logger.error(f"Table {{table_name}} not found")
                 return False
             
@@ -268,8 +333,8 @@ class BotDatabase:
             data_to_save['user_id'] = user_id
             
             # Get column names and types
-            columns = [col[1] for col in columns_info if col[1].lower() != 'id']
-            column_types = {{col[1]: col[2].upper() for col in columns_info}}
+            columns = tuple(col for col in table.names if col.lower() != 'id')
+            column_types = table.types
             
             # Prepare values with proper type conversion
             values = []
@@ -289,31 +354,23 @@ class BotDatabase:
                 else:
                     values.append(value)
             
-            # Build and execute query
-            columns_str = ', '.join(columns)
-            placeholders = ', '.join(['?'] * len(columns))
-            
-            query = f'''
-                INSERT INTO {{table_name}} ({{columns_str}})
-                VALUES ({{placeholders}})
-            '''
-            
-            cursor.execute(query, values)
-            self.conn.commit()
+            cursor.execute(table.insert_sql(columns), values)
+            self.commit()
             return True
             
         except sqlite3.Error as e:
             logger.error(f"Database error in save_user_data: {{e}}")
-            self.conn.rollback()
+            self.rollback()
             return False
         except Exception as e:
             logger.error(f"Unexpected error in save_user_data: {{e}}")
-            self.conn.rollback()
+            self.rollback()
             return False
     
-    def get_user_data(self, user_id: int, table_name: str, limit: int = None) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
-        \"\"\"Get user data from database\"\"\"
-        cursor = self.conn.cursor()
+    def get_user_data(self, user_id: int, table_name: str, limit: int = None,
+                      conn: sqlite3.Connection = None) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        \"\"\"Get user data from database, on `conn` if given (a reader connection)\"\"\"
+        cursor = (conn or self.conn).cursor()
         if table_name == 'users':
             query = f"SELECT * FROM {{table_name}} WHERE user_id = ?"
             params = (user_id,)
@@ -335,24 +392,21 @@ class BotDatabase:
     def update_record(self, table_name: str, record_id: int, data: dict) -> bool:
         try:
             cursor = self.conn.cursor()
+            table = self.schema.table(self.conn, table_name)
+            if table is None:
+                logger.error(f"Table {{table_name}} not found")
+                return False
             
-            set_clause = ', '.join([f"{{k}} = ?" for k in data.keys()])
             values = list(data.values())
             values.append(record_id)
             
-            query = f\"\"\"
-                UPDATE {{table_name}} 
-                SET {{set_clause}}, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            \"\"\"
-            
-            cursor.execute(query, values)
-            self.conn.commit()
+            cursor.execute(table.update_sql(tuple(data), set_extra='updated_at = CURRENT_TIMESTAMP'), values)
+            self.commit()
             return cursor.rowcount > 0
             
         except sqlite3.Error as e:
             logger.error(f"Database error in update_record: {{e}}")
-            self.conn.rollback()
+            self.rollback()
             return False
 
     def update_last_record(self, user_id: int, table_name: str, data: dict) -> bool:
@@ -372,17 +426,12 @@ class BotDatabase:
             
             if last_record:
                 record_id = last_record['id']
-                set_clause = ', '.join([f"{{k}} = ?" for k in data.keys()])
                 values = list(data.values())
                 values.append(record_id)
                 
-                query = f\"\"\"
-                    UPDATE {{table_name}} 
-                    SET {{set_clause}}, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                \"\"\"
-                cursor.execute(query, values)
-                self.conn.commit()
+                table = self.schema.table(self.conn, table_name)
+                cursor.execute(table.update_sql(tuple(data), set_extra='updated_at = CURRENT_TIMESTAMP'), values)
+                self.commit()
                 return cursor.rowcount > 0
             else:
                 # If no record exists, create new one
@@ -391,7 +440,7 @@ class BotDatabase:
             
         except sqlite3.Error as e:
             logger.error(f"Database error in update_last_record: {{e}}")
-            self.conn.rollback()
+            self.rollback()
             return False
 
     def delete_record(self, table_name: str, record_id: int) -> bool:
@@ -402,11 +451,11 @@ class BotDatabase:
                 f"DELETE FROM {{table_name}} WHERE id = ?",
                 (record_id,)
             )
-            self.conn.commit()
+            self.commit()
             return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"DB error deleting record: {{e}}")
-            self.conn.rollback()
+            self.rollback()
             return False
     
     def close(self):
@@ -420,14 +469,12 @@ db = BotDatabase()
         
         # Handle imported database file
         if imported_db_path:
+            # Cached table metadata belongs to the file being replaced
+            forget_catalog(bot_dir / 'bot.db')
             db_path = bot_dir / 'bot.db'
-            if Path(imported_db_path).exists():
-                # Replace existing database with imported one
-                with open(imported_db_path, 'rb') as src, open(db_path, 'wb') as dst:
-                    dst.write(src.read())
-            else:
-                # Create new database if imported file doesn't exist
-                open(db_path, 'w').close()
+            # Replace existing database with imported one (empty if the file doesn't exist);
+            # the bot must be stopped, its -wal/-shm files are removed with the old database
+            replace_database(db_path, imported_db_path if Path(imported_db_path).exists() else None)
         else:
             # Create new database file if no import
             db_path = bot_dir / 'bot.db'
@@ -439,6 +486,23 @@ db = BotDatabase()
         
         return db_file
 
+    def write_seed_file(self, bot_dir: Path, schema: Dict) -> Optional[str]:
+        """Rows of dbConfig.schema as JSON lines next to bot.db, returns their hash (None: no rows)"""
+        seed_file = bot_dir / SEED_FILE
+        lines = [
+            json.dumps({'table': table_name, 'row': row}, ensure_ascii=False, sort_keys=True, default=str)
+            for table_name, rows in schema.items() if isinstance(rows, list)
+            for row in rows if isinstance(row, dict)
+        ]
+        if not lines:
+            seed_file.unlink(missing_ok=True)
+            return None
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        bot_dir.mkdir(parents=True, exist_ok=True)
+        seed_file.write_bytes(data)
+        return hashlib.sha256(data).hexdigest()
+
     def import_database(self, db_file_path: str) -> dict:
         try:
             # Connect to the imported database
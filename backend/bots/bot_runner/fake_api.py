@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """Send refused, answered with 429"""
+
+
+class FakeChatBot:
+    """What the fake server knows about one bot token"""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.bot_id = int(token.split(':', 1)[0]) if token.split(':', 1)[0].isdigit() else 1
+        self.updates: Deque[Dict] = deque()
+        self.new_updates = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.next_file_id = 1
+        # Outgoing messages in order, and the last one per chat
+        self.sent: List[Dict] = []
+        self.last_message: Dict[int, Dict] = {}
+        self.calls: Counter = Counter()
+        self.window_start = 0.0
+        self.window_count = 0
+
+
+class FakeBotAPI:
+    """
+    Local stand-in for the Telegram Bot API, enough for generated bots to
+    poll and reply. Updates are pushed by the caller; messages sent by bots
+    are recorded instead of delivered. With rate_limit set, sends over that
+    many per second and bot are answered with 429 like Telegram does.
+    """
+
+    def __init__(self, rate_limit: Optional[float] = None, retry_after: int = 1):
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.bots: Dict[str, FakeChatBot] = {}
+        self.rate_limited = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ''
+
+        self.methods = {
+            'getme': self.get_me,
+            'getupdates': self.get_updates,
+            'deletewebhook': self.ok,
+            'setwebhook': self.ok,
+            'answercallbackquery': self.ok,
+            'deletemessage': self.ok,
+            'sendmessage': self.send_message,
+            'sendphoto': self.send_photo,
+        }
+
+    def get_bot(self, token: str) -> FakeChatBot:
+        bot = self.bots.get(token)
+        if bot is None:
+            bot = self.bots[token] = FakeChatBot(token)
+        return bot
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_update(self, token: str, update: Dict[str, Any]) -> int:
+        """Queue an update for the bot, update_id is assigned here"""
+        bot = self.get_bot(token)
+        update = {**update, 'update_id': bot.next_update_id}
+        bot.next_update_id += 1
+        bot.updates.append(update)
+        bot.new_updates.set()
+        return update['update_id']
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = self.get_bot(request.match_info['token'])
+        method = request.match_info['method'].lower()
+        params = await self.read_params(request)
+        bot.calls[method] += 1
+
+        handler = self.methods.get(method)
+        if handler is None:
+            logger.debug(f"Fake Bot API: {method} is not implemented, answering True")
+            handler = self.ok
+        try:
+            result = await handler(bot, params)
+        except RateLimited:
+            self.rate_limited += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }, status=429)
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    async def read_params(request: web.Request) -> Dict[str, Any]:
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, web.FileField):
+                params[key] = value
+                continue
+            # aiogram sends nested objects (reply_markup, ...) as JSON, scalars as is
+            params[key] = json.loads(value) if value[:1] in ('{', '[') else value
+        return params
+
+    def check_rate(self, bot: FakeChatBot):
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        if now - bot.window_start >= 1:
+            bot.window_start, bot.window_count = now, 0
+        bot.window_count += 1
+        if bot.window_count > self.rate_limit:
+            raise RateLimited()
+
+    def message(self, bot: FakeChatBot, params: Dict[str, Any], **content) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': bot.next_message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': {'id': bot.bot_id, 'is_bot': True, 'first_name': 'Bot'},
+            **content
+        }
+        bot.next_message_id += 1
+        record = {'chat_id': chat_id, 'reply_markup': params.get('reply_markup'), **content}
+        bot.sent.append(record)
+        bot.last_message[chat_id] = record
+        return message
+
+    async def ok(self, bot: FakeChatBot, params: Dict[str, Any]) -> bool:
+        return True
+
+    async def get_me(self, bot: FakeChatBot, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'id': bot.bot_id, 'is_bot': True, 'first_name': 'Bot', 'username': f"fake_{bot.bot_id}_bot"}
+
+    async def get_updates(self, bot: FakeChatBot, params: Dict[str, Any]) -> List[Dict]:
+        offset = int(params.get('offset') or 0)
+        while bot.updates and bot.updates[0]['update_id'] < offset:
+            bot.updates.popleft()
+        if not bot.updates:
+            bot.new_updates.clear()
+            try:
+                await asyncio.wait_for(bot.new_updates.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                return []
+        limit = int(params.get('limit') or 100)
+        return [bot.updates[i] for i in range(min(limit, len(bot.updates)))]
+
+    async def send_message(self, bot: FakeChatBot, params: Dict[str, Any]) -> Dict[str, Any]:
+        self.check_rate(bot)
+        return self.message(bot, params, text=str(params.get('text', '')))
+
+    async def send_photo(self, bot: FakeChatBot, params: Dict[str, Any]) -> Dict[str, Any]:
+        self.check_rate(bot)
+        photo = params.get('photo')
+        if isinstance(photo, web.FileField):
+            file_id = f"fake-photo-{bot.next_file_id}"
+            bot.next_file_id += 1
+        else:
+            file_id = str(photo)
+        sizes = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}]
+        content = {'photo': sizes}
+        if params.get('caption'):
+            content['caption'] = str(params['caption'])
+        return self.message(bot, params, **content)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'calls': dict(sum((bot.calls for bot in self.bots.values()), Counter())),
+            'sent': sum(len(bot.sent) for bot in self.bots.values()),
+            'rate_limited': self.rate_limited
+        }
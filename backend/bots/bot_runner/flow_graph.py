@@ -0,0 +1,166 @@
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Union
+from aiogram.types import (
+    ReplyKeyboardMarkup, KeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton
+)
+from .conditions import CompiledCondition, ConditionError, try_compile_condition
+
+logger = logging.getLogger(__name__)
+
+
+KeyboardMarkup = Union[ReplyKeyboardMarkup, InlineKeyboardMarkup]
+
+
+def build_keyboard(node: Dict[str, Any]) -> Optional[KeyboardMarkup]:
+    """Keyboard shown with a node, None if it has none"""
+    node_type = node.get('type')
+    data = node.get('data', {})
+
+    if node_type == 'inline':
+        return InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(
+                    text=btn.get('text', f'Button {idx+1}'),
+                    callback_data=btn.get('action', f'action_{idx}')
+                )]
+                for idx, btn in enumerate(data.get('buttons', []))
+            ]
+        )
+
+    if node_type == 'button':
+        texts = [btn.get('text', f'Button {idx+1}') for idx, btn in enumerate(data.get('buttons', []))]
+    elif node_type == 'menu':
+        texts = [item.get('text', f'Item {idx+1}') for idx, item in enumerate(data.get('items', []))]
+    elif node_type == 'input' and data.get('inputMode', 'text') == 'buttons' and data.get('buttons'):
+        texts = [btn.get('text', f'Button {idx+1}') for idx, btn in enumerate(data['buttons'])]
+    else:
+        return None
+
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text)] for text in texts],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+
+def build_node_state(node: Dict[str, Any], graph: 'FlowGraph') -> Dict[str, Any]:
+    """State of a user waiting at a node for their reply"""
+    node_type = node.get('type')
+    data = node.get('data', {})
+    state = {'current_node': node['id']}
+
+    if node_type in ('button', 'inline'):
+        state['buttons'] = data.get('buttons', [])
+        state['button_mapping'] = graph.button_indexes[node['id']]
+    elif node_type == 'menu':
+        state['menu_items'] = graph.menu_items[node['id']]
+    elif node_type == 'input':
+        state['awaiting_input'] = True
+        state['input_config'] = {
+            'table': data.get('table', ''),
+            'column': data.get('column', ''),
+            'success_message': data.get('successMessage', 'Data saved successfully'),
+            'input_mode': data.get('inputMode', 'text'),
+            'buttons': data.get('buttons', []),
+            'save_mode': data.get('saveMode', 'new')  # 'new' or 'update_last'
+        }
+
+    return state
+
+
+class FlowGraph:
+    """
+    Read-only index over a flow config, built once per config version.
+    Lookups keep the semantics of the former linear scans: the first
+    matching node or edge in config order wins.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        self.nodes: Dict[str, Dict] = {}
+        self.edges_from: Dict[str, List[Dict]] = {}
+        self.edges_by_button: Dict[Tuple[str, Any], Dict] = {}
+        self.edges_by_label: Dict[Tuple[str, str], Dict] = {}
+        self.start_nodes: Dict[str, Dict] = {}
+        self.broadcast_nodes: List[Dict] = []
+        # Command name without slash -> its start node (None if not configured)
+        self.commands: Dict[str, Optional[Dict]] = {}
+        # Reply text -> button index / menu item, per node
+        self.button_indexes: Dict[str, Dict[str, int]] = {}
+        self.menu_items: Dict[str, Dict[str, Dict]] = {}
+        # Condition node -> compiled expression, or the error it was rejected with
+        self.conditions: Dict[str, Union[CompiledCondition, ConditionError]] = {}
+        # Prebuilt per node, shared by all users: never mutate
+        self.keyboards: Dict[str, KeyboardMarkup] = {}
+        self.node_states: Dict[str, Dict[str, Any]] = {}
+        # Local image files used by the flow (URLs are fetched by Telegram itself)
+        self.local_media: List[str] = []
+
+        for node in config.get('nodes', []):
+            self.nodes.setdefault(node['id'], node)
+
+            data = node.get('data', {})
+            if node.get('type') == 'startend' and data.get('isStart', True):
+                self.start_nodes.setdefault(data.get('command'), node)
+            elif node.get('type') == 'broadcast':
+                self.broadcast_nodes.append(node)
+            elif node.get('type') in ('button', 'inline'):
+                self.button_indexes[node['id']] = {
+                    btn.get('text', ''): idx for idx, btn in enumerate(data.get('buttons', []))
+                }
+            elif node.get('type') == 'menu':
+                items = self.menu_items[node['id']] = {}
+                for item in data.get('items', []):
+                    items.setdefault(item.get('text', ''), item)
+            elif node.get('type') == 'image':
+                image_path = data.get('images', '')
+                if image_path and not image_path.startswith(('http://', 'https://')) \
+                        and image_path not in self.local_media:
+                    self.local_media.append(image_path)
+            elif node.get('type') == 'condition':
+                condition = self.conditions[node['id']] = try_compile_condition(data.get('condition'))
+                if isinstance(condition, ConditionError):
+                    logger.warning(f"Condition node {node['id']} is disabled: {condition}")
+
+        for node_id, node in self.nodes.items():
+            self.node_states[node_id] = build_node_state(node, self)
+            try:
+                keyboard = build_keyboard(node)
+            except ValueError as e:
+                # Invalid button data: get_keyboard raises again when the node is reached
+                logger.warning(f"Keyboard of node {node_id} is invalid: {e}")
+                continue
+            if keyboard is not None:
+                self.keyboards[node_id] = keyboard
+
+        for cmd_obj in config.get('commands', []):
+            cmd = cmd_obj.get('name', '') if isinstance(cmd_obj, dict) else cmd_obj
+            if cmd.startswith('/'):
+                self.commands.setdefault(cmd[1:].lower(), self.start_nodes.get(cmd))
+
+        for edge in config.get('edges', []):
+            source = edge['source']
+            self.edges_from.setdefault(source, []).append(edge)
+            self.edges_by_button.setdefault((source, edge.get('data', {}).get('buttonIndex')), edge)
+            self.edges_by_label.setdefault((source, (edge.get('label') or '').lower()), edge)
+
+    def get_node(self, node_id: str) -> Optional[Dict]:
+        return self.nodes.get(node_id)
+
+    def get_keyboard(self, node: Dict[str, Any]) -> Optional[KeyboardMarkup]:
+        keyboard = self.keyboards.get(node['id'])
+        return keyboard if keyboard is not None else build_keyboard(node)
+
+    def get_start_node(self, command: str) -> Optional[Dict]:
+        return self.start_nodes.get(command)
+
+    def next_edge(self, source: str, button_index: Optional[int] = None) -> Optional[Dict]:
+        """First edge leaving source, or the one bound to the given button"""
+        if button_index is None:
+            edges = self.edges_from.get(source)
+            return edges[0] if edges else None
+        return self.edges_by_button.get((source, button_index))
+
+    def labelled_edge(self, source: str, label: str) -> Optional[Dict]:
+        """Edge leaving a condition node for the given outcome label"""
+        return self.edges_by_label.get((source, label.lower()))
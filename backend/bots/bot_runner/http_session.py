@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiohttp import ClientSession
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SharedClient:
+    """aiohttp sessions of one event loop and the number of bots using them"""
+
+    def __init__(self, session: ClientSession, polling: ClientSession):
+        # Replies and other calls share TELEGRAM_HTTP_POOL_LIMIT connections
+        self.session = session
+        # getUpdates long polls hold a connection for up to the polling timeout, one per bot:
+        # they get their own unlimited pool so they never make replies wait
+        self.polling = polling
+        self.users = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed or self.polling.closed
+
+    async def close(self):
+        for session in (self.session, self.polling):
+            if not session.closed:
+                await session.close()
+
+
+# One client per event loop: aiohttp sessions cannot be used across loops
+_clients: Dict[asyncio.AbstractEventLoop, SharedClient] = {}
+# Bots starting at once on a loop wait for the one creating its client
+_client_locks: Dict[asyncio.AbstractEventLoop, asyncio.Lock] = {}
+_clients_lock = threading.Lock()
+
+# Set while the current task sends a getUpdates request
+_long_poll: ContextVar[bool] = ContextVar('long_poll', default=False)
+
+
+def get_pool_limit() -> int:
+    return getattr(settings, 'TELEGRAM_HTTP_POOL_LIMIT', 100)
+
+
+def get_api_server() -> Optional[TelegramAPIServer]:
+    """Bot API server from TELEGRAM_BOT_API_SERVER, None for api.telegram.org"""
+    base = getattr(settings, 'TELEGRAM_BOT_API_SERVER', '')
+    return TelegramAPIServer.from_base(base) if base else None
+
+
+def pool_stats() -> List[Dict]:
+    with _clients_lock:
+        return [
+            {'bots': client.users, 'closed': client.closed}
+            for client in _clients.values()
+        ]
+
+
+class SharedAiohttpSession(AiohttpSession):
+    """
+    Per-bot aiogram session sending through the connection pool shared by
+    all bots on the same event loop. Requests are still counted per bot.
+    """
+
+    def __init__(self, **kwargs):
+        api = get_api_server()
+        if api is not None:
+            kwargs.setdefault('api', api)
+        super().__init__(limit=get_pool_limit(), **kwargs)
+        self.requests: Counter = Counter()
+        self.errors = 0
+        self.request_time = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[SharedClient] = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            self._client = await self._join_client()
+            self._session = self._client.session
+        return self._client.polling if _long_poll.get() else self._client.session
+
+    async def _join_client(self) -> SharedClient:
+        loop = asyncio.get_running_loop()
+        with _clients_lock:
+            lock = _client_locks.setdefault(loop, asyncio.Lock())
+        # Without it, bots starting together would each create (and leak) a client
+        async with lock:
+            with _clients_lock:
+                client = _clients.get(loop)
+            if client is None or client.closed:
+                client = SharedClient(await self._new_session(get_pool_limit()), await self._new_session(0))
+            with _clients_lock:
+                _clients[loop] = client
+                client.users += 1
+        self._loop = loop
+        return client
+
+    async def _new_session(self, limit: int) -> ClientSession:
+        """Session with aiogram's own connector settings (TLS context, DNS cache), 0: no pool limit"""
+        self._session = None
+        self._connector_init['limit'] = limit
+        return await super().create_session()
+
+    async def close(self) -> None:
+        """Leave the shared pool, closing it when the last bot of the loop leaves"""
+        client, self._client, self._session = self._client, None, None
+        if client is None:
+            return
+        with _clients_lock:
+            if _clients.get(self._loop) is client:
+                client.users -= 1
+                if client.users > 0:
+                    return
+                del _clients[self._loop]
+                _client_locks.pop(self._loop, None)
+        if not client.closed:
+            await client.close()
+            # Let the underlying SSL connections close
+            await asyncio.sleep(0.25)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        started = time.monotonic()
+        token = _long_poll.set(isinstance(method, GetUpdates))
+        try:
+            return await super().make_request(bot, method, timeout=timeout)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            _long_poll.reset(token)
+            self.requests[method.__api_method__] += 1
+            self.request_time += time.monotonic() - started
+
+    def stats(self) -> Dict:
+        total = sum(self.requests.values())
+        return {
+            'requests': dict(self.requests),
+            'errors': self.errors,
+            'avg_ms': round(self.request_time / total * 1000, 1) if total else 0.0
+        }
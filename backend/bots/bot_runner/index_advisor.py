@@ -0,0 +1,180 @@
+import logging
+import re
+import sqlite3
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+from django.conf import settings
+from .schema_catalog import SchemaCatalog
+
+logger = logging.getLogger(__name__)
+
+# 'propose' logs the indexes, 'create' also creates them, 'off' skips the advisor
+ADVISOR_MODES = ('off', 'propose', 'create')
+
+# A table read in full: "SCAN t", "SCAN TABLE t" (SQLite < 3.36), "SCAN t AS a"; not "SCAN t USING INDEX i"
+_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+_TABLE_RE = re.compile(r'\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.I)
+_CONDITIONS_RE = re.compile(r'\b(?:WHERE|ON)\b(.*?)(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bHAVING\b|$)', re.I | re.S)
+_ORDER_RE = re.compile(r'\bORDER\s+BY\b(.*?)(?=\bLIMIT\b|$)', re.I | re.S)
+_COMPARISON_RE = re.compile(
+    r'(?:(\w+)\.)?(\w+)\s*(==|=|>=|<=|>|<|\bIS\b|\bIN\b|\bBETWEEN\b|\bLIKE\b)', re.I
+)
+# Right-hand side of a join condition: a.user_id = b.user_id
+_JOINED_RE = re.compile(r'=\s*(\w+)\.(\w+)')
+_EQUALITY = {'=', '==', 'IS', 'IN'}
+_KEYWORDS = {'WHERE', 'ON', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER', 'CROSS', 'NATURAL',
+             'GROUP', 'ORDER', 'LIMIT', 'HAVING', 'SET', 'USING', 'UNION'}
+
+
+class IndexAdvice(NamedTuple):
+    table: str
+    columns: Tuple[str, ...]
+    query: str
+
+    @property
+    def name(self) -> str:
+        return f"idx_{self.table}_{'_'.join(self.columns)}"
+
+    @property
+    def sql(self) -> str:
+        return f"CREATE INDEX IF NOT EXISTS {self.name} ON {self.table} ({', '.join(self.columns)})"
+
+
+def get_advisor_mode() -> str:
+    mode = getattr(settings, 'TELEGRAM_BOT_INDEX_ADVISOR', 'propose')
+    return mode if mode in ADVISOR_MODES else 'propose'
+
+
+def query_plan(conn: sqlite3.Connection, sql: str, params: Sequence = ()) -> List[str]:
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+def full_scans(sql: str, plan: List[str]) -> List[str]:
+    """Tables the plan reads in full, aliases resolved to table names"""
+    aliases = _aliases(sql)
+    tables = []
+    for detail in plan:
+        match = _SCAN_RE.match(detail)
+        if match:
+            name = match.group(2) or match.group(1)
+            tables.append(aliases.get(name.lower(), match.group(1)))
+    return tables
+
+
+def _aliases(sql: str) -> Dict[str, str]:
+    aliases = {}
+    for table, alias in _TABLE_RE.findall(sql):
+        aliases[table.lower()] = table
+        if alias and alias.upper() not in _KEYWORDS:
+            aliases[alias.lower()] = table
+    return aliases
+
+
+def candidate_columns(sql: str, table: str, names: List[str]) -> Tuple[str, ...]:
+    """
+    Columns of `table` an index would serve the query with: the ones
+    compared for equality, then one range column or else the ORDER BY ones
+    """
+    names_by_key = {name.lower(): name for name in names}
+    own = {alias for alias, target in _aliases(sql).items() if target.lower() == table.lower()}
+
+    def column(qualifier: Optional[str], name: str) -> Optional[str]:
+        if qualifier and qualifier.lower() not in own:
+            return None
+        return names_by_key.get(name.lower())
+
+    equality, ranges = [], []
+    for conditions in _CONDITIONS_RE.findall(sql):
+        for qualifier, name, operator in _COMPARISON_RE.findall(conditions):
+            found = column(qualifier, name)
+            if found:
+                (equality if operator.upper() in _EQUALITY else ranges).append(found)
+        for qualifier, name in _JOINED_RE.findall(conditions):
+            found = column(qualifier, name)
+            if found:
+                equality.append(found)
+
+    columns = list(dict.fromkeys(equality))
+    if ranges:
+        columns += [name for name in ranges[:1] if name not in columns]
+    else:
+        order = _ORDER_RE.search(sql)
+        terms = [re.sub(r'\s+(?:ASC|DESC)\s*$', '', term.strip(), flags=re.I) for term in order.group(1).split(',')] \
+            if order else []
+        ordered = [column(*term.split('.', 1)) if '.' in term else column(None, term) for term in terms]
+        # Only helps when the index yields the whole order
+        if ordered and all(ordered):
+            columns += [name for name in ordered if name not in columns]
+    return tuple(columns)
+
+
+def advise(conn: sqlite3.Connection, queries: Iterable[Tuple[str, Sequence]],
+           catalog: Optional[SchemaCatalog] = None) -> List[IndexAdvice]:
+    """
+    Indexes that turn full table scans of `queries` into searches. Each
+    candidate is created in a savepoint, checked with EXPLAIN QUERY PLAN
+    and rolled back; the ones the planner would use are returned.
+    """
+    catalog = catalog or SchemaCatalog()
+    advice: Dict[Tuple[str, Tuple[str, ...]], IndexAdvice] = {}
+    for sql, params in queries:
+        try:
+            scans = full_scans(sql, query_plan(conn, sql, params))
+        except sqlite3.Error as e:
+            logger.debug(f"Index advisor skipped query {sql!r}: {e}")
+            continue
+        for table_name in scans:
+            table = catalog.table(conn, table_name)
+            if table is None:
+                continue
+            columns = candidate_columns(sql, table.name, table.names)
+            key = (table.name.lower(), tuple(column.lower() for column in columns))
+            if not columns or key in advice:
+                continue
+            candidate = IndexAdvice(table.name, columns, sql)
+            if _planner_uses(conn, candidate, sql, params):
+                advice[key] = candidate
+    return list(advice.values())
+
+
+def _planner_uses(conn: sqlite3.Connection, candidate: IndexAdvice, sql: str, params: Sequence) -> bool:
+    conn.execute('SAVEPOINT index_advisor')
+    try:
+        conn.execute(candidate.sql)
+        return candidate.table.lower() not in {table.lower() for table in full_scans(sql, query_plan(conn, sql, params))}
+    except sqlite3.Error as e:
+        logger.debug(f"Index advisor could not try {candidate.sql!r}: {e}")
+        return False
+    finally:
+        conn.execute('ROLLBACK TO index_advisor')
+        conn.execute('RELEASE index_advisor')
+
+
+def dboutput_queries(nodes: Iterable[Dict]) -> List[Tuple[str, Tuple]]:
+    """The statements dboutput nodes run, with placeholders bound to NULL"""
+    queries = []
+    for node in nodes:
+        if node.get('type') != 'dboutput':
+            continue
+        data = node.get('data', {})
+        custom_query = data.get('customQuery', '')
+        if custom_query:
+            sql = custom_query.replace('{button_value}', '?')
+        elif data.get('table') and data.get('columns'):
+            sql = f"SELECT {', '.join(data['columns'])} FROM {data['table']} WHERE user_id = ?"
+        else:
+            continue
+        queries.append((sql, (None,) * sql.count('?')))
+    return queries
+
+
+def advise_flow(conn: sqlite3.Connection, nodes: Iterable[Dict], mode: str,
+                catalog: Optional[SchemaCatalog] = None) -> List[IndexAdvice]:
+    """Advice for a flow's dboutput queries, created and committed in 'create' mode"""
+    if mode == 'off':
+        return []
+    advice = advise(conn, dboutput_queries(nodes), catalog)
+    if mode == 'create' and advice:
+        for item in advice:
+            conn.execute(item.sql)
+        conn.commit()
+    return advice
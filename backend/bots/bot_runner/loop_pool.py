@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Coroutine, List, Optional
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LoopThread:
+    """Event loop running forever in a daemon thread and hosting many bots"""
+
+    def __init__(self, name: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.name = name
+        self.bot_count = 0
+        if loop is not None:
+            # Loop is run by someone else (e.g. the ASGI server)
+            self.loop = loop
+            self.thread = None
+        else:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        logger.info(f"Event loop {self.name} started")
+        self.loop.run_forever()
+
+    def start(self):
+        if self.thread is not None and not self.thread.is_alive():
+            self.thread.start()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule coroutine as a task on this loop (thread-safe)"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class LoopPool:
+    """Small fixed pool of event loops shared by all bots of the process"""
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self._loops: List[LoopThread] = []
+        self._lock = threading.Lock()
+        self.adopted: Optional[LoopThread] = None
+
+    def adopt(self, loop: asyncio.AbstractEventLoop, name: str = 'asgi') -> LoopThread:
+        """Register an externally running loop so bots can be hosted on it"""
+        with self._lock:
+            if self.adopted is None or self.adopted.loop is not loop:
+                self.adopted = LoopThread(name, loop=loop)
+            return self.adopted
+
+    def acquire(self, prefer_adopted: bool = False) -> LoopThread:
+        """Return the least loaded loop, starting a new one while below pool size"""
+        with self._lock:
+            if prefer_adopted and self.adopted is not None and self.adopted.loop.is_running():
+                self.adopted.bot_count += 1
+                return self.adopted
+            if len(self._loops) < self.size:
+                loop_thread = LoopThread(f"bot-loop-{len(self._loops)}")
+                loop_thread.start()
+                self._loops.append(loop_thread)
+            loop_thread = min(self._loops, key=lambda lt: lt.bot_count)
+            loop_thread.bot_count += 1
+            return loop_thread
+
+    def release(self, loop_thread: LoopThread):
+        with self._lock:
+            loop_thread.bot_count = max(0, loop_thread.bot_count - 1)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            loops = self._loops + ([self.adopted] if self.adopted else [])
+            return [{'name': lt.name, 'bots': lt.bot_count} for lt in loops]
+
+
+_pool: Optional[LoopPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_loop_pool() -> LoopPool:
+    """Get process-wide loop pool (created lazily)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LoopPool(getattr(settings, 'TELEGRAM_BOT_LOOP_POOL_SIZE', 1))
+        return _pool
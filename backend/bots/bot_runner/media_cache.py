@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PhotoSender = Callable[[Union[str, FSInputFile]], Awaitable[types.Message]]
+
+
+def get_preload_chat_id() -> Optional[int]:
+    """Chat local media is uploaded to at bot start, None disables pre-upload"""
+    chat_id = getattr(settings, 'TELEGRAM_MEDIA_PRELOAD_CHAT_ID', '')
+    return int(chat_id) if chat_id else None
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """
+    Telegram file_id of local files, so each file is uploaded once.
+    Keyed by path and content hash, persisted in the bot's database.
+    """
+
+    def __init__(self, database):
+        # Writes go through the bot's database writer; the table is set up before it takes jobs
+        self.database = database
+        self.conn = database.conn
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS bot_media_cache (
+            path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (path, content_hash)
+        )''')
+        self.conn.commit()
+
+        self._file_ids: Dict[Tuple[str, str], str] = {
+            (row[0], row[1]): row[2]
+            for row in self.conn.execute('SELECT path, content_hash, file_id FROM bot_media_cache')
+        }
+        # path -> (mtime_ns, size, hash): files are re-hashed only when they change
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self.uploads = 0
+        self.reused = 0
+
+    async def content_key(self, path: str) -> Tuple[str, str]:
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return path, cached[2]
+        content_hash = await asyncio.to_thread(file_sha256, path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return path, content_hash
+
+    def remember(self, key: Tuple[str, str], file_id: str):
+        self._file_ids[key] = file_id
+        self.database.submit(
+            self.database.conn.execute,
+            'INSERT OR REPLACE INTO bot_media_cache (path, content_hash, file_id) VALUES (?, ?, ?)',
+            (*key, file_id)
+        )
+
+    def forget(self, key: Tuple[str, str]):
+        self._file_ids.pop(key, None)
+        self.database.submit(
+            self.database.conn.execute, 'DELETE FROM bot_media_cache WHERE path = ? AND content_hash = ?', key
+        )
+
+    async def send_photo(self, send: PhotoSender, path: str) -> types.Message:
+        """Send local photo through send(), uploading it only if no file_id is known"""
+        key = await self.content_key(path)
+
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            try:
+                message = await send(file_id)
+                self.reused += 1
+                return message
+            except TelegramBadRequest as e:
+                # file_id no longer valid (e.g. bot token changed): upload again
+                logger.warning(f"Cached file_id of {path} rejected: {e}")
+                self.forget(key)
+
+        # Concurrent sends of the same file (broadcasts) wait for one upload
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self.reused += 1
+                return await send(file_id)
+
+            message = await send(FSInputFile(path))
+            self.uploads += 1
+            if message.photo:
+                self.remember(key, message.photo[-1].file_id)
+            return message
+
+    async def preload(self, bot, chat_id: int, paths):
+        """Upload files without a known file_id to a service chat"""
+        for path in paths:
+            try:
+                key = await self.content_key(path)
+                if key in self._file_ids:
+                    continue
+                message = await self.send_photo(lambda photo: bot.send_photo(chat_id=chat_id, photo=photo), path)
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception as e:
+                logger.error(f"Error pre-uploading {path}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {'file_ids': len(self._file_ids), 'uploads': self.uploads, 'reused': self.reused}
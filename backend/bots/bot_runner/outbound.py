@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, ForwardMessage, SendAnimation, SendAudio, SendContact, SendDocument,
+    SendLocation, SendMediaGroup, SendMessage, SendPhoto, SendSticker, SendVideo,
+    SendVideoNote, SendVoice, TelegramMethod
+)
+
+logger = logging.getLogger(__name__)
+
+# Lane of requests made from the current task; broadcasts switch to 'bulk'
+outbound_lane: ContextVar[str] = ContextVar('outbound_lane', default='interactive')
+
+# In priority order: a waiting interactive message always gets the next token
+LANES = ('interactive', 'bulk')
+
+# Methods counted against Telegram's message limits
+RATE_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendVideo, SendAnimation, SendAudio, SendVoice,
+    SendVideoNote, SendSticker, SendMediaGroup, SendLocation, SendContact,
+    CopyMessage, ForwardMessage,
+)
+
+GLOBAL_RATE = 30            # messages per second per bot
+BULK_SHARE = 0.8            # bulk never takes more, leaving room for replies
+PRIVATE_CHAT_RATE = 1       # per second, bursts of CHAT_BURST allowed
+GROUP_CHAT_RATE = 20 / 60   # groups: 20 messages per minute
+CHAT_BURST = 5
+MAX_CHAT_BUCKETS = 10000
+
+# Upper bounds of wait time histogram buckets, in milliseconds
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, float('inf'))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, or return how many seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Session middleware pacing a bot's outgoing messages: per-chat buckets,
+    then one global bucket granted to waiting requests in lane priority.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, bulk_share: float = BULK_SHARE):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.lane_buckets = {'bulk': TokenBucket(rate * bulk_share, rate * bulk_share)}
+        self.chat_buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self.queues: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in LANES}
+        self.waiting_for_chat = 0
+        # Flood control from Telegram holds every lane until this moment
+        self.paused_until = 0.0
+
+        self.wait_histograms: Dict[str, List[int]] = {lane: [0] * len(WAIT_BUCKETS_MS) for lane in LANES}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot, method: TelegramMethod):
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        lane = outbound_lane.get()
+        if lane not in self.queues:
+            lane = 'interactive'
+        started = time.monotonic()
+
+        await self._wait_for_chat(getattr(method, 'chat_id', None))
+        await self._wait_for_global(lane)
+        self._record_wait(lane, time.monotonic() - started)
+
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Flood control: outgoing messages paused for {e.retry_after}s")
+            raise
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_BURST)
+            if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_for_chat(self, chat_id):
+        if not isinstance(chat_id, int):
+            return
+        bucket = self._chat_bucket(chat_id)
+        delay = bucket.take()
+        if delay:
+            self.waiting_for_chat += 1
+            try:
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = bucket.take()
+            finally:
+                self.waiting_for_chat -= 1
+
+    async def _wait_for_global(self, lane: str):
+        future = asyncio.get_running_loop().create_future()
+        self.queues[lane].append(future)
+        self._ensure_pump()
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future in self.queues[lane]:
+                self.queues[lane].remove(future)
+            raise
+
+    def _ensure_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+
+    def _next_waiter(self) -> Optional[str]:
+        for lane in LANES:
+            queue = self.queues[lane]
+            while queue and queue[0].done():
+                queue.popleft()
+            if queue:
+                return lane
+        return None
+
+    async def _pump(self):
+        """Hand out global tokens, highest priority lane first"""
+        while True:
+            lane = self._next_waiter()
+            if lane is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                lane_bucket = self.lane_buckets.get(lane)
+                delay = lane_bucket.take() if lane_bucket else 0.0
+                if not delay:
+                    delay = self.global_bucket.take()
+                    if delay and lane_bucket:
+                        # Give back the lane token, the global one was not granted
+                        lane_bucket.tokens += 1
+            if delay > 0:
+                # Sleep, then pick again: a new interactive request may have arrived
+                await asyncio.sleep(delay)
+                continue
+
+            self.queues[lane].popleft().set_result(None)
+
+    def _record_wait(self, lane: str, seconds: float):
+        self.wait_histograms[lane][bisect_left(WAIT_BUCKETS_MS, seconds * 1000)] += 1
+
+    def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+
+    def stats(self) -> Dict:
+        return {
+            'queued': {lane: len(queue) for lane, queue in self.queues.items()},
+            'waiting_for_chat': self.waiting_for_chat,
+            'paused_for': max(0.0, round(self.paused_until - time.monotonic(), 1)),
+            'wait_ms': {
+                lane: {
+                    ('inf' if bound == float('inf') else f"<={bound:g}"): count
+                    for bound, count in zip(WAIT_BUCKETS_MS, histogram)
+                }
+                for lane, histogram in self.wait_histograms.items()
+            }
+        }
@@ -0,0 +1,71 @@
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Buffered records are written out at least this often
+FLUSH_INTERVAL = 1.0
+
+
+def get_recording_path(bot_id: Optional[int]) -> Optional[Path]:
+    """File updates of the bot are recorded to, None if recording is off"""
+    directory = getattr(settings, 'TELEGRAM_UPDATE_RECORDING_DIR', '')
+    if not directory or bot_id is None:
+        return None
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    return path / f"bot_{bot_id}.jsonl"
+
+
+def read_recording(path) -> Iterator[Dict[str, Any]]:
+    """Records of a recording file in order; a torn last line is skipped"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning(f"Skipping unreadable record in {path}")
+
+
+class UpdateRecorder:
+    """
+    Dispatcher middleware appending every incoming update to a JSON lines
+    file: arrival time, handler time in ms and the raw update.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._flushed_at = time.monotonic()
+        self.recorded = 0
+
+    async def __call__(self, handler, event, data):
+        received = time.time()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.write(received, time.perf_counter() - started, event)
+
+    def write(self, received: float, duration: float, update):
+        if self._file is None:
+            return
+        record = {
+            'ts': round(received, 3),
+            'ms': round(duration * 1000, 2),
+            'update': update.model_dump(mode='json', by_alias=True, exclude_none=True, exclude={'update_id'}),
+        }
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.recorded += 1
+        if time.monotonic() - self._flushed_at >= FLUSH_INTERVAL:
+            self._file.flush()
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
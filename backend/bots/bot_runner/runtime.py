@@ -0,0 +1,883 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from collections import Counter, OrderedDict
+from datetime import datetime, time
+from time import monotonic
+from typing import Any, Dict, List, Optional, Union
+
+import pytz
+from aiogram import Bot, Dispatcher, types
+from aiogram.filters import Command
+from aiogram.types import ReplyKeyboardRemove
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from .broadcasts import BroadcastEngine
+from .conditions import ConditionError
+from .flow_graph import FlowGraph
+from .async_db import create_async_database, fetch_all
+from .http_session import SharedAiohttpSession
+from .index_advisor import advise_flow, get_advisor_mode
+from .media_cache import MediaCache, get_preload_chat_id
+from .outbound import OutboundScheduler
+from .recorder import UpdateRecorder, get_recording_path
+from . import sqlite_db
+from .state_store import UserStateStore, create_state_store
+
+logging.getLogger('apscheduler').setLevel(logging.DEBUG)
+
+MAX_RECURSION_DEPTH = 10
+# Users rows kept in memory for condition evaluation
+PROFILE_CACHE_SIZE = 1024
+PROFILE_FIELDS = ('username', 'first_name', 'last_name', 'language_code', 'is_bot')
+# Senders whose users row is known to be current
+TRACKED_USERS_SIZE = 10000
+# last_active is bumped at most this often (seconds) while the profile is unchanged
+LAST_ACTIVE_RESOLUTION = 60
+
+USERS_UPSERT = '''
+    INSERT INTO users (user_id, username, first_name, last_name, language_code, is_bot, first_seen, last_active)
+    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        language_code = excluded.language_code,
+        is_bot = excluded.is_bot,
+        last_active = CURRENT_TIMESTAMP
+'''
+# Errors of USERS_UPSERT on a users table it does not fit (imported without a unique
+# user_id or without the profile columns); anything else is a real failure
+USERS_UPSERT_UNSUPPORTED = (
+    'does not match any PRIMARY KEY or UNIQUE constraint',
+    'no such column',
+    'has no column named',
+)
+
+
+class FlowBot:
+    """
+    Shared runtime of generated bots: interprets a bot's flow config.
+    Generated bot.py only holds the flow description and creates an instance.
+    """
+
+    def __init__(self, token: str, config: Dict[str, Any], db, bot_id: Optional[int] = None,
+                 state_store: Optional[UserStateStore] = None):
+        self.config = config
+        self.graph = FlowGraph(config)
+        self.db = db
+        self.logger = logging.getLogger(f"{__name__}.bot_{bot_id}" if bot_id else __name__)
+
+        # Connections to the Bot API are pooled with the other bots on this loop
+        self.http = SharedAiohttpSession()
+        self.bot = Bot(token=token, session=self.http)
+        # Every send of this bot goes through the rate limits and priority lanes
+        self.outbound = OutboundScheduler()
+        self.bot.session.middleware(self.outbound)
+        self.dp = Dispatcher()
+        self.scheduler = AsyncIOScheduler(timezone=pytz.UTC)
+
+        # Per-user record: current node, input flag and remembered choices
+        self.states = state_store or create_state_store(bot_id, getattr(db, 'conn', None))
+        self.profiles: 'OrderedDict[int, Dict]' = OrderedDict()
+        # user_id -> (profile fields, monotonic time of the last write)
+        self.tracked_users: 'OrderedDict[int, tuple]' = OrderedDict()
+        self._users_upsert = True
+        # Database calls run on a writer thread and a reader pool, off the event loop;
+        # writes of all handlers are committed together every few milliseconds
+        self.database = create_async_database(db)
+        self.media = MediaCache(self.database)
+        self.broadcasts = BroadcastEngine(self)
+        self._preload_task: Optional[asyncio.Task] = None
+        # 'polling' or 'webhook' once main() serves updates; stop() makes it return
+        self._serving: Optional[str] = None
+        self._stop = asyncio.Event()
+        # How often each dispatch path was taken
+        self.route_hits: Counter = Counter()
+
+        self.recorder: Optional[UpdateRecorder] = None
+        recording_path = get_recording_path(bot_id)
+        if recording_path is not None:
+            self.recorder = UpdateRecorder(recording_path)
+            self.dp.update.outer_middleware(self.recorder)
+
+        self.register_handlers()
+
+    def register_handlers(self):
+        self.dp.message.register(self.command_handler, self.match_command)
+        self.dp.callback_query.register(self.callback_handler)
+        self.dp.message.register(self.message_router)
+        self.dp.message.register(self.myinfo_handler, Command('myinfo'))
+        self.dp.message.register(self.mychoices_handler, Command('mychoices'))
+
+    async def match_command(self, message: types.Message, bot: Bot):
+        """Filter for flow commands: one table lookup whatever the number of commands"""
+        text = message.text or message.caption
+        if not text or text[0] != '/':
+            return False
+
+        name, _, mention = text.split(maxsplit=1)[0][1:].partition('@')
+        # Indexed lowercased, like the names of bot commands in Telegram
+        name = name.lower()
+        if name not in self.graph.commands:
+            return False
+        if mention:
+            me = await bot.me()
+            if not me.username or mention.lower() != me.username.lower():
+                return False
+        return {'start_node': self.graph.commands[name]}
+
+    async def command_handler(self, message: types.Message, start_node: Optional[Dict[str, Any]]):
+        """Handler for flow commands, start node is resolved by match_command"""
+        self.route_hits['command'] += 1
+        self.logger.debug(f"Command handler user data: {message.from_user}")
+        await self.save_user_info(message.from_user)
+
+        if start_node:
+            await self.process_node(message, start_node)
+        else:
+            await message.answer('Command not configured')
+
+    async def message_router(self, message: types.Message):
+        """Single entry point for other messages: reads user state once and dispatches"""
+        state = await self.get_user_state(message.from_user.id)
+
+        if 'button_mapping' in state:
+            self.route_hits['button'] += 1
+            await self.button_click_handler(message, state)
+        elif 'menu_items' in state:
+            self.route_hits['menu'] += 1
+            await self.menu_item_handler(message, state)
+        else:
+            self.route_hits['input' if state.get('awaiting_input') else 'text'] += 1
+            await self.text_handler(message, state)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'routes': dict(self.route_hits),
+            'nodes': len(self.graph.nodes),
+            'states': self.states.stats(),
+            'media': self.media.stats(),
+            'broadcasts': self.broadcasts.stats(),
+            'outbound': self.outbound.stats(),
+            'http': self.http.stats(),
+            'database': self.database.stats()
+        }
+
+    async def broadcast(self, node_id: str):
+        """Broadcast task for a broadcast node"""
+        try:
+            await self.broadcasts.run(node_id)
+        except Exception as e:
+            self.logger.error(f"🔥 Critical error in broadcast: {e}", exc_info=True)
+
+    async def setup_broadcasts(self):
+        """Setup all broadcast tasks"""
+        self.logger.info("⚙️ Initializing broadcast tasks...")
+        self.schedule_broadcasts()
+        db_path = self.database.db_path
+        if db_path:
+            # Keep the WAL short even when no single commit triggers an autocheckpoint
+            self.scheduler.add_job(
+                self.checkpoint_db, 'interval', minutes=sqlite_db.CHECKPOINT_INTERVAL_MINUTES,
+                args=[db_path], id='wal_checkpoint', replace_existing=True
+            )
+        self.scheduler.start()
+        self.logger.info(f"🚀 Scheduler started with {len(self.scheduler.get_jobs())} jobs")
+
+    async def checkpoint_db(self, db_path: str):
+        try:
+            busy, wal_pages, moved = await asyncio.to_thread(sqlite_db.checkpoint, db_path)
+            self.logger.debug(f"WAL checkpoint: {moved}/{wal_pages} pages{' (busy)' if busy else ''}")
+        except Exception as e:
+            self.logger.error(f"🔴 WAL checkpoint failed: {e}")
+
+    def schedule_broadcasts(self):
+        """(Re)create scheduler jobs for broadcast nodes of the current flow"""
+        for job in self.scheduler.get_jobs():
+            if job.id.startswith('broadcast_'):
+                job.remove()
+
+        for node in self.graph.broadcast_nodes:
+            node_id = node['id']
+            job_id = f"broadcast_{node_id.replace('-', '_')}"
+            data = node.get('data', {})
+            frequency = data.get('frequency', 'daily')
+
+            try:
+                hour, minute = map(int, data.get('broadcastTime', '09:00').split(':'))
+            except (ValueError, AttributeError):
+                hour, minute = 9, 0
+
+            self.logger.info(f"⏳ Scheduling broadcast for node {node_id} at {hour}:{minute} UTC ({frequency})")
+            if frequency == 'daily':
+                self.scheduler.add_job(
+                    self.broadcast, 'cron', args=[node_id],
+                    hour=hour, minute=minute, timezone=pytz.UTC, id=job_id
+                )
+            elif frequency == 'weekly':
+                self.scheduler.add_job(
+                    self.broadcast, 'cron', args=[node_id],
+                    day_of_week='mon', hour=hour, minute=minute, timezone=pytz.UTC, id=job_id
+                )
+            elif frequency == 'monthly':
+                self.scheduler.add_job(
+                    self.broadcast, 'cron', args=[node_id],
+                    day=1, hour=hour, minute=minute, timezone=pytz.UTC, id=job_id
+                )
+            elif frequency == 'once':
+                if datetime.now().time() < time(hour, minute):
+                    self.scheduler.add_job(
+                        self.broadcast, 'date', args=[node_id],
+                        run_date=datetime.combine(datetime.now().date(), time(hour, minute)),
+                        timezone=pytz.UTC, id=job_id
+                    )
+
+    async def save_user_info(self, user: types.User):
+        """Track the sender: one upsert, skipped when nothing changed since the last one"""
+        try:
+            fields = (
+                user.username or None,
+                user.first_name or None,
+                user.last_name or None,
+                user.language_code or None,
+                int(user.is_bot)
+            )
+            now = monotonic()
+            seen = self.tracked_users.get(user.id)
+            if seen is not None and seen[0] == fields and now - seen[1] < LAST_ACTIVE_RESOLUTION:
+                return True
+
+            # Written and committed by the database writer, the reply does not wait for it
+            self.database.submit(self.track_user, user.id, fields)
+
+            self.tracked_users[user.id] = (fields, now)
+            self.tracked_users.move_to_end(user.id)
+            if len(self.tracked_users) > TRACKED_USERS_SIZE:
+                self.tracked_users.popitem(last=False)
+            if user.id in self.profiles:
+                self.profiles[user.id] = {**self.profiles[user.id], **dict(zip(PROFILE_FIELDS, fields))}
+            return True
+        except Exception as e:
+            self.logger.error(f"🔴 Error saving user info: {e}", exc_info=True)
+            return False
+
+    def track_user(self, user_id: int, fields: tuple):
+        """Upsert the users row, runs on the database writer"""
+        if self._users_upsert:
+            try:
+                self.db.conn.execute(USERS_UPSERT, (user_id, *fields))
+                self.db.commit()
+                return
+            except sqlite3.OperationalError as e:
+                if not any(marker in str(e) for marker in USERS_UPSERT_UNSUPPORTED):
+                    raise
+                self.logger.warning(f"⚠️ Users upsert not possible ({e}), falling back to select and update")
+                self._users_upsert = False
+        if not self.db.save_user_data(user_id, 'users', {'user_id': user_id, **dict(zip(PROFILE_FIELDS, fields))}):
+            self.logger.error("🔴 Failed to save user data to database")
+
+    async def get_user_profile(self, user_id: int) -> Dict[str, Any]:
+        """Row of the users table, cached"""
+        profile = self.profiles.get(user_id)
+        if profile is not None:
+            self.profiles.move_to_end(user_id)
+            return profile
+
+        profile = await self.database.read(self.db.get_user_data, user_id, 'users', 1) or {}
+        self.profiles[user_id] = profile
+        if len(self.profiles) > PROFILE_CACHE_SIZE:
+            self.profiles.popitem(last=False)
+        return profile
+
+    async def save_user_data(self, user_id: int, table_name: str, data: dict) -> bool:
+        """Save user data to specified table"""
+        try:
+            return await self.database.run(self.db.save_user_data, user_id, table_name, data)
+        except Exception as e:
+            self.logger.error(f"🔴 Error saving data: {e}", exc_info=True)
+            return False
+
+    async def wait_durable(self) -> bool:
+        """Wait until writes made so far are committed, False if their commit failed"""
+        try:
+            await self.database.durable()
+            return True
+        except Exception as e:
+            self.logger.error(f"🔴 Error committing data: {e}")
+            return False
+
+    async def get_user_data(self, user_id: int, table_name: str,
+                            limit: int = None) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        """Get user data with optional limit"""
+        try:
+            return await self.database.read(self.db.get_user_data, user_id, table_name, limit)
+        except Exception as e:
+            self.logger.error(f"🔴 Error getting data: {e}", exc_info=True)
+            return None if limit == 1 else []
+
+    @staticmethod
+    def revalidate_state(record: Dict[str, Any], graph: FlowGraph) -> Optional[Dict[str, Any]]:
+        """Record fixed up for `graph`, None if it still fits"""
+        node_id = record.get('node')
+        if not node_id:
+            return None
+        node = graph.get_node(node_id)
+        if node is None:
+            # Node was removed: user starts over with the next command
+            return {**record, 'node': None, 'input': False, 'type': None}
+        node_type = node.get('type')
+        # Records written before node types were kept are only checked for the node
+        if record.get('type', node_type) != node_type:
+            return {**record, 'type': node_type, 'input': node_type == 'input'}
+        return None
+
+    async def load_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """User's record, fixed up if the flow changed since it was written"""
+        record = await self.states.get(user_id)
+        if record is not None:
+            fixed = self.revalidate_state(record, self.graph)
+            if fixed is not None:
+                self.states.set(user_id, fixed)
+                record = fixed
+        return record
+
+    async def get_user_state(self, user_id: int) -> Dict[str, Any]:
+        """State of the node the user is at, {} outside of a flow"""
+        record = await self.load_state(user_id)
+        node = self.graph.get_node(record.get('node')) if record else None
+        if node is None:
+            return {}
+        state = self.graph.node_states[node['id']]
+        if 'awaiting_input' in state:
+            # Shared prebuilt state: copy before setting per-user flag
+            state = {**state, 'awaiting_input': record.get('input', True)}
+        return state
+
+    async def set_user_node(self, user_id: int, node: Dict[str, Any]):
+        record = await self.load_state(user_id) or {}
+        # Records are replaced, never mutated: a flush may be serializing the old one
+        self.states.set(user_id, {
+            **record, 'node': node['id'], 'type': node.get('type'), 'input': node.get('type') == 'input'
+        })
+
+    async def finish_input(self, user_id: int):
+        record = await self.load_state(user_id)
+        if record is not None:
+            self.states.set(user_id, {**record, 'input': False})
+
+    async def get_user_context(self, user_id: int) -> Dict[str, Any]:
+        record = await self.load_state(user_id)
+        return record.get('context', {}) if record else {}
+
+    def reload_config(self, new_config: Dict[str, Any]) -> Dict[str, int]:
+        """Swap flow of the running bot, must be called on the bot's event loop"""
+        graph = FlowGraph(new_config)
+        kept = dropped = 0
+
+        # States are rebuilt from the graph on each update; only fix node references.
+        # Users whose state is not in memory are checked by load_state() when they come back.
+        for user_id, record in self.states.items():
+            if not record.get('node'):
+                continue
+            if 'type' not in record:
+                old_node = self.graph.get_node(record['node']) or {}
+                record = {**record, 'type': old_node.get('type')}
+            fixed = self.revalidate_state(record, graph)
+            if fixed is not None:
+                self.states.set(user_id, fixed)
+            if (fixed or record)['node'] is None:
+                dropped += 1
+            else:
+                kept += 1
+
+        self.config = new_config
+        self.graph = graph
+        if self.scheduler.running:
+            self.schedule_broadcasts()
+        # dboutput queries of the new flow may need indexes of their own
+        self.database.submit(self.advise_indexes)
+        self.logger.info(f"♻️ Flow reloaded: {len(graph.nodes)} nodes, kept {kept} users, reset {dropped}")
+        return {'nodes': len(graph.nodes), 'kept_users': kept, 'reset_users': dropped}
+
+    async def process_next_node(self, message: types.Message, current_node_id: str,
+                                button_index: Optional[int] = None, depth: int = 0):
+        """Process next node in flow"""
+        if depth > MAX_RECURSION_DEPTH:
+            self.logger.warning("⚠️ Maximum recursion depth reached")
+            await message.answer("Произошла ошибка обработки запроса")
+            return
+
+        self.logger.info(f"➡️ Processing next node after {current_node_id}")
+
+        next_edge = self.graph.next_edge(current_node_id, button_index)
+
+        if not next_edge:
+            self.logger.warning(f"⚠️ No edges found from node {current_node_id}")
+            return
+
+        next_node = self.graph.get_node(next_edge['target'])
+
+        if next_node:
+            await self.process_node(message, next_node, depth + 1)
+        else:
+            self.logger.error(f"🔴 Node {next_edge['target']} not found")
+
+    async def process_node(self, message: types.Message, node: Dict[str, Any], depth: int = 0):
+        """Process a single node in the flow"""
+        self.logger.debug(f"🟢 Processing node {node['id']}, user: {message.from_user}")
+        save_success = await self.save_user_info(message.from_user)
+        if not save_success:
+            self.logger.warning("⚠️ Failed to save user info in process_node")
+
+        node_type = node.get('type')
+        data = node.get('data', {})
+        user_id = message.from_user.id
+
+        self.logger.info(f"🟢 Processing node {node['id']} of type {node_type}")
+
+        try:
+            if node_type == 'startend':
+                await self.process_next_node(message, node['id'], depth=depth)
+
+            elif node_type == 'text':
+                await message.answer(data.get('text', ''))
+                await self.process_next_node(message, node['id'], depth=depth)
+
+            elif node_type in ('button', 'menu', 'inline'):
+                await self.set_user_node(user_id, node)
+                # Markup is prebuilt once per node and shared by all users
+                await message.answer(data.get('text', ''), reply_markup=self.graph.get_keyboard(node))
+
+            elif node_type == 'image':
+                image_path = data.get('images', '')
+                caption = data.get('caption', '')
+                try:
+                    if image_path.startswith(('http://', 'https://')):
+                        await message.answer_photo(image_path, caption=caption)
+                    elif os.path.exists(image_path):
+                        await self.media.send_photo(
+                            lambda photo: message.answer_photo(photo, caption=caption),
+                            image_path
+                        )
+                    else:
+                        await message.answer("Image not found")
+                    await self.process_next_node(message, node['id'], depth=depth)
+                except Exception as e:
+                    self.logger.error(f"🔴 Error sending image: {e}")
+                    await message.answer("Error sending image")
+
+            elif node_type == 'input':
+                await self.set_user_node(user_id, node)
+                keyboard = self.graph.get_keyboard(node)
+
+                if keyboard is not None:
+                    await message.answer(data.get('prompt', 'Please select an option:'), reply_markup=keyboard)
+                else:
+                    await message.answer(data.get('prompt', 'Please enter your input:'))
+
+            elif node_type == 'dboutput':
+                try:
+                    table = data.get('table', '')
+                    columns = data.get('columns', [])
+                    custom_query = data.get('customQuery', '')
+                    button_value_var = 'last_button_value'
+                    user_context = await self.get_user_context(user_id)
+                    button_value = user_context.get(button_value_var, '') if button_value_var else ''
+
+                    if custom_query:
+                        if button_value:
+                            safe_value = button_value.replace("'", "''")
+                            query = custom_query.replace('{button_value}', "'" + safe_value + "'")
+                        else:
+                            query = custom_query
+
+                        if query.lstrip()[:6].upper() == 'SELECT':
+                            results = await self.database.read(fetch_all, query)
+                        else:
+                            # Other statements may write: run them on the writer's connection
+                            results = await self.database.run(fetch_all, query, conn=self.db.conn)
+                    elif table and columns:
+                        results = await self.database.read(
+                            fetch_all,
+                            f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ?",
+                            (user_id,)
+                        )
+                    else:
+                        await message.answer("Configuration error")
+                        return
+
+                    if results:
+                        response = data.get('message', '') + "\n\n" + "\n".join(
+                            [" | ".join(str(item) for item in row) for row in results]
+                        )
+                        await message.answer(response)
+                    else:
+                        await message.answer(data.get('message', '') + "\n\nNo data found")
+
+                    await self.process_next_node(message, node['id'], depth=depth)
+                except Exception as e:
+                    self.logger.error(f"🔴 Error retrieving data: {e}")
+                    await message.answer("Error retrieving data")
+
+            elif node_type == 'condition':
+                try:
+                    condition = self.graph.conditions[node['id']]
+                    if isinstance(condition, ConditionError):
+                        raise condition
+
+                    context = {'user_id': user_id}
+                    if condition.needs_profile:
+                        context = {**await self.get_user_profile(user_id), 'user_id': user_id}
+                    condition_met = condition.evaluate(context)
+
+                    next_edge = self.graph.labelled_edge(node['id'], str(condition_met))
+
+                    if next_edge:
+                        next_node = self.graph.get_node(next_edge['target'])
+                        if next_node:
+                            await self.process_node(message, next_node, depth + 1)
+                except Exception as e:
+                    self.logger.error(f"🔴 Error evaluating condition: {e}")
+                    await message.answer("Error processing condition")
+
+        except Exception as e:
+            self.logger.error(f"🔴 Error processing node: {e}", exc_info=True)
+            await message.answer("Error processing request")
+
+    async def remember_choice(self, user_id: int, item: Dict[str, Any], value: Any):
+        """Store selected button/menu value in user context"""
+        record = await self.load_state(user_id) or {}
+        context = dict(record.get('context', {}))
+
+        value_var = item.get('value_var', '')
+        if value_var:
+            context[value_var] = value
+        context['last_button_value'] = value
+        self.states.set(user_id, {**record, 'context': context})
+
+    async def callback_handler(self, callback_query: types.CallbackQuery):
+        self.route_hits['callback'] += 1
+        try:
+            await callback_query.answer()
+            user_id = callback_query.from_user.id
+            state = await self.get_user_state(user_id)
+
+            self.logger.debug(f"🟣 Callback from user: {callback_query.from_user}")
+            save_success = await self.save_user_info(callback_query.from_user)
+            if not save_success:
+                self.logger.warning("⚠️ Failed to save user info in callback")
+
+            if 'current_node' in state and 'buttons' in state:
+                button_index = next(
+                    (idx for idx, btn in enumerate(state['buttons'])
+                     if btn.get('action', f'action_{idx}') == callback_query.data),
+                    None
+                )
+
+                if button_index is not None:
+                    button = state['buttons'][button_index]
+                    button_value = button.get('value', button.get('text', ''))
+                    await self.remember_choice(user_id, button, button_value)
+
+                    if state.get('awaiting_input'):
+                        input_config = state.get('input_config', {})
+                        table = input_config.get('table')
+                        column = input_config.get('column')
+                        save_mode = input_config.get('save_mode', 'new')
+
+                        if table and column:
+                            data = {column: button_value}
+
+                            if save_mode == 'new':
+                                success = await self.save_user_data(user_id, table, data)
+                            elif save_mode == 'update_last':
+                                success = await self.database.run(self.db.update_last_record, user_id, table, data)
+
+                            # Confirm only what is committed
+                            if success and await self.wait_durable():
+                                await callback_query.message.answer(
+                                    input_config.get('success_message', 'Данные сохранены'),
+                                    reply_markup=ReplyKeyboardRemove()
+                                )
+                            else:
+                                await callback_query.message.answer(
+                                    "Ошибка сохранения данных",
+                                    reply_markup=ReplyKeyboardRemove()
+                                )
+
+                            await self.finish_input(user_id)
+
+                            await self.process_next_node(callback_query.message, state['current_node'])
+                            return
+
+                    await callback_query.message.answer(
+                        f"Вы выбрали: {button.get('text', '')}",
+                        reply_markup=ReplyKeyboardRemove()
+                    )
+                    await self.process_next_node(callback_query.message, state['current_node'], button_index)
+
+        except Exception as e:
+            self.logger.error("🔴 Error handling callback: " + str(e))
+            await callback_query.answer("Ошибка обработки")
+
+    async def button_click_handler(self, message: types.Message, state: Dict[str, Any]):
+        try:
+            user_id = message.from_user.id
+
+            if 'current_node' in state and 'button_mapping' in state:
+                button_index = state['button_mapping'].get(message.text)
+                if button_index is None:
+                    self.route_hits['button_unmatched'] += 1
+                else:
+                    button = state['buttons'][button_index]
+                    button_value = button.get('value', button.get('text', ''))
+                    await self.remember_choice(user_id, button, button_value)
+
+                    await message.answer(
+                        f"Вы выбрали: {message.text}",
+                        reply_markup=ReplyKeyboardRemove()
+                    )
+                    await self.process_next_node(message, state['current_node'], button_index)
+
+        except Exception as e:
+            self.logger.error(f"🔴 Error handling button click: {e}")
+            await message.answer("Ошибка обработки")
+
+    async def menu_item_handler(self, message: types.Message, state: Dict[str, Any]):
+        try:
+            user_id = message.from_user.id
+
+            if 'current_node' in state and 'menu_items' in state:
+                selected_item = state['menu_items'].get(message.text)
+
+                if selected_item is None:
+                    self.route_hits['menu_unmatched'] += 1
+                else:
+                    item_value = selected_item.get('value', selected_item.get('text', ''))
+                    await self.remember_choice(user_id, selected_item, item_value)
+
+                    await message.answer(
+                        f"Вы выбрали: {message.text}",
+                        reply_markup=ReplyKeyboardRemove()
+                    )
+                    await self.process_next_node(message, state['current_node'])
+
+        except Exception as e:
+            self.logger.error(f"🔴 Error handling menu selection: {e}")
+            await message.answer("Ошибка обработки")
+
+    async def text_handler(self, message: types.Message, state: Dict[str, Any]):
+        """Input answers and plain text, `state` is the one message_router read"""
+        self.logger.info(f" Message from user: {message.from_user}")
+        save_success = await self.save_user_info(message.from_user)
+        if not save_success:
+            self.logger.error(" Failed to save user info in text_handler")
+
+        user_id = message.from_user.id
+
+        if state.get('awaiting_input'):
+            input_config = state.get('input_config', {})
+            table = input_config.get('table')
+            column = input_config.get('column')
+            success_message = input_config.get('success_message', 'Data saved successfully')
+            input_mode = input_config.get('input_mode', 'text')
+            buttons = input_config.get('buttons', [])
+            save_mode = input_config.get('save_mode', 'new')  # 'new' or 'update_last'
+
+            if table and column:
+                # Handle different input modes
+                if input_mode == 'buttons':
+                    selected_button = next(
+                        (btn for btn in buttons if btn.get('text') == message.text),
+                        None
+                    )
+                    if selected_button:
+                        data = {column: selected_button.get('value', message.text)}
+                    else:
+                        await message.answer("Неверный выбор, попробуйте еще раз")
+                        return
+                else:
+                    data = {column: message.text}
+
+                # Handle save modes
+                try:
+                    if save_mode == 'new':
+                        success = await self.save_user_data(user_id, table, data)
+                    elif save_mode == 'update_last':
+                        success = await self.database.run(self.db.update_last_record, user_id, table, data)
+
+                    # Confirm only what is committed
+                    if success and await self.wait_durable():
+                        await message.answer(success_message, reply_markup=ReplyKeyboardRemove())
+                    else:
+                        await message.answer("Ошибка сохранения данных", reply_markup=ReplyKeyboardRemove())
+                except Exception as e:
+                    self.logger.error(f"Error saving data: {e}")
+                    await message.answer("Ошибка сохранения данных", reply_markup=ReplyKeyboardRemove())
+
+            await self.finish_input(user_id)
+
+            if 'current_node' in state:
+                await self.process_next_node(message, state['current_node'])
+        else:
+            if message.text.startswith('/'):
+                await message.answer("Команда не распознана")
+            else:
+                await message.answer(f"Вы сказали: {message.text}")
+
+    async def myinfo_handler(self, message: types.Message):
+        """Command to show and verify saved user data"""
+        try:
+            user = message.from_user
+            db_data = await self.get_user_data(user.id, 'users', limit=1)
+
+            response = (
+                f"Ваши данные:\n"
+                f"ID: {user.id}\n"
+                f"Username: @{user.username}\n"
+                f"Имя: {user.first_name}\n"
+                f"Фамилия: {user.last_name}\n\n"
+                f"В базе данных:\n"
+                f"Username: {db_data.get('username') if db_data else 'N/A'}\n"
+                f"Имя: {db_data.get('first_name') if db_data else 'N/A'}"
+            )
+            await message.answer(response)
+        except Exception as e:
+            self.logger.error(f"🔴 Error in myinfo handler: {e}")
+            await message.answer("Ошибка при получении данных")
+
+    async def mychoices_handler(self, message: types.Message):
+        """Command to show user's saved choices"""
+        try:
+            user_id = message.from_user.id
+            choices = await self.get_user_data(user_id, 'user_choices')
+
+            if not choices:
+                await message.answer("У вас нет сохраненных выборов")
+                return
+
+            response = "Ваши сохраненные выборы:\n\n"
+            for choice in choices:
+                response += f"• {choice.get('key')}: {choice.get('value')}\n"
+                response += f"  ({datetime.fromisoformat(choice.get('timestamp')).strftime('%Y-%m-%d %H:%M')})\n\n"
+
+            await message.answer(response)
+        except Exception as e:
+            self.logger.error(f"🔴 Error in mychoices handler: {e}")
+            await message.answer("Ошибка при получении данных")
+
+    async def on_startup(self):
+        """Verify database connection on startup"""
+        try:
+            await self.database.run(self.prepare_database)
+
+            self.states.start()
+
+            preload_chat_id = get_preload_chat_id()
+            if preload_chat_id and self.graph.local_media:
+                self._preload_task = asyncio.create_task(
+                    self.media.preload(self.bot, preload_chat_id, list(self.graph.local_media))
+                )
+
+            self.logger.info("⚙️ Starting broadcast setup...")
+            await self.setup_broadcasts()
+            await self.broadcasts.resume()
+
+            jobs = self.scheduler.get_jobs()
+            self.logger.info(f"⏰ Scheduled {len(jobs)} jobs:")
+            for job in jobs:
+                self.logger.info(f"  - {job.id} (next run: {job.next_run_time})")
+
+            self.logger.info("🚀 Bot started successfully")
+        except Exception as e:
+            self.logger.error(f"🔴 Startup error: {e}")
+            raise
+
+    def prepare_database(self):
+        """Verify the database and create runtime tables, runs on the database writer"""
+        self.db.conn.execute("SELECT 1")
+        self.logger.info("🟢 Database connection verified")
+
+        cursor = self.db.conn.cursor()
+        cursor.execute("PRAGMA table_info(users)")
+        columns = [col[1] for col in cursor.fetchall()]
+        self.logger.info(f"📊 Users table columns: {columns}")
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_choices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_choices_user_id ON user_choices (user_id)')
+        self.db.conn.commit()
+        self.logger.info("🟢 Created user_choices table")
+        self.advise_indexes()
+
+    def advise_indexes(self):
+        """Propose or create indexes for the flow's dboutput queries, runs on the database writer"""
+        mode = get_advisor_mode()
+        for advice in advise_flow(self.db.conn, self.graph.nodes.values(), mode, getattr(self.db, 'schema', None)):
+            if mode == 'create':
+                self.logger.info(f"🗂 Created index {advice.name} for dboutput query: {advice.query}")
+            else:
+                self.logger.info(f"💡 Index advice: {advice.sql}; for dboutput query: {advice.query}")
+
+    async def shutdown(self):
+        """Properly close resources"""
+        self.logger.info("🛑 Shutting down bot...")
+        try:
+            await self.broadcasts.cancel_all()
+            if self.scheduler.running:
+                self.scheduler.shutdown()
+            if self._preload_task is not None:
+                self._preload_task.cancel()
+            self.outbound.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            # Write back pending user states before the bot goes away
+            await self.states.close()
+            # Runs and commits what handlers and broadcasts queued, then stops
+            await self.database.close()
+            self.db.conn.close()
+        except Exception as e:
+            self.logger.error(f"🔴 Error closing resources: {e}")
+        await self.bot.session.close()
+
+    async def stop(self) -> bool:
+        """
+        Make main() return so the bot shuts down, called on the bot's event loop.
+        False while main() is still starting up: the caller cancels it instead.
+        Cancelling polling itself would leave aiogram's polling tasks running.
+        """
+        self._stop.set()
+        if self._serving == 'polling':
+            await self.dp.stop_polling()
+        return self._serving is not None
+
+    async def main(self, handle_signals: bool = True, webhook_url: Optional[str] = None,
+                   webhook_secret: Optional[str] = None):
+        try:
+            if webhook_url:
+                await self.bot.set_webhook(webhook_url, secret_token=webhook_secret, drop_pending_updates=True)
+                await self.on_startup()
+                # Updates are fed to dp by the shared webhook endpoint
+                self._serving = 'webhook'
+                await self._stop.wait()
+            else:
+                await self.bot.delete_webhook(drop_pending_updates=True)
+                await self.on_startup()
+                self._serving = 'polling'
+                # Signal handlers can only be installed from the main thread
+                await self.dp.start_polling(self.bot, handle_signals=handle_signals, close_bot_session=False)
+        except Exception as e:
+            self.logger.error(f"🔴 Fatal error: {e}")
+        finally:
+            if webhook_url:
+                try:
+                    await self.bot.delete_webhook()
+                except Exception as e:
+                    self.logger.error(f"🔴 Error removing webhook: {e}")
+            await self.shutdown()
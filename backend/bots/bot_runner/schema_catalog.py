@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class Column(NamedTuple):
+    name: str
+    type: str
+    notnull: bool
+    pk: bool
+
+
+class TableSchema:
+    """Columns of one table and the statement text built for them"""
+
+    def __init__(self, name: str, columns: List[Column]):
+        self.name = name
+        self.columns = columns
+        self.names = [column.name for column in columns]
+        # Upper-cased declared types, like the generated code compares them
+        self.types = {column.name: column.type.upper() for column in columns}
+        self._statements: Dict[tuple, str] = {}
+
+    def insert_sql(self, columns: Tuple[str, ...]) -> str:
+        key = ('insert', columns)
+        sql = self._statements.get(key)
+        if sql is None:
+            sql = f"INSERT INTO {self.name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+            self._statements[key] = sql
+        return sql
+
+    def update_sql(self, columns: Tuple[str, ...], key: str = 'id', set_extra: str = '') -> str:
+        """UPDATE of `columns` by `key`; `set_extra` is appended to the SET clause as is"""
+        cache_key = ('update', columns, key, set_extra)
+        sql = self._statements.get(cache_key)
+        if sql is None:
+            assignments = [f"{column} = ?" for column in columns]
+            if set_extra:
+                assignments.append(set_extra)
+            sql = f"UPDATE {self.name} SET {', '.join(assignments)} WHERE {key} = ?"
+            self._statements[cache_key] = sql
+        return sql
+
+
+class SchemaCatalog:
+    """
+    Table metadata of one database read once instead of a PRAGMA table_info
+    per write. Everything is dropped when PRAGMA schema_version changes,
+    i.e. after any CREATE, ALTER or DROP on any connection to the file.
+    """
+
+    def __init__(self):
+        self._version: Optional[int] = None
+        self._tables: Dict[str, Optional[TableSchema]] = {}
+        self._lock = threading.Lock()
+
+    def table(self, conn: sqlite3.Connection, name: str) -> Optional[TableSchema]:
+        """Schema of `name`, None if the table does not exist"""
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._tables = {}
+                    self._version = version
+
+        tables = self._tables
+        if name in tables:
+            return tables[name]
+
+        columns = [
+            Column(row[1], row[2], bool(row[3]), bool(row[5]))
+            for row in conn.execute(f"PRAGMA table_info({name})").fetchall()
+        ]
+        schema = TableSchema(name, columns) if columns else None
+        with self._lock:
+            # Not cached if the schema changed while it was read
+            if tables is self._tables:
+                tables[name] = schema
+        return schema
+
+
+_catalogs: Dict[str, SchemaCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(db_path) -> SchemaCatalog:
+    """Catalog of a database file, shared by the bot runtime and the admin API"""
+    key = str(db_path)
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.setdefault(key, SchemaCatalog())
+    return catalog
+
+
+def forget_catalog(db_path):
+    """Drop the catalog of a database file that was replaced by another one"""
+    with _catalogs_lock:
+        _catalogs.pop(str(db_path), None)
@@ -0,0 +1,95 @@
+import logging
+import os
+import shutil
+import sqlite3
+from typing import Dict, Optional, Tuple, Union
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Applied to every connection to a bot database, in this order
+DEFAULT_PRAGMAS: Dict[str, Union[int, str]] = {
+    # Wait for a writer instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    # Readers and the writer no longer block each other
+    'journal_mode': 'WAL',
+    # Durable at checkpoints; a power loss can only drop the last commits
+    'synchronous': 'NORMAL',
+    # Negative: KiB, i.e. 8 MB of page cache per connection
+    'cache_size': -8000,
+    # Reads served from a memory map of the file instead of read() copies
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    # WAL pages folded back into the database file by the committing connection
+    'wal_autocheckpoint': 1000,
+}
+
+# How often running bots checkpoint their WAL in the background
+CHECKPOINT_INTERVAL_MINUTES = 5
+
+# Files SQLite keeps next to a database: WAL, its shared-memory index, rollback journal
+SIDECAR_SUFFIXES = ('-wal', '-shm', '-journal')
+
+# Tables the runtime keeps in a bot database for itself, not part of the bot's data
+INTERNAL_TABLES = frozenset({
+    'bot_user_states', 'bot_broadcast_runs', 'bot_broadcast_deliveries', 'bot_seed', 'bot_media_cache',
+})
+
+
+def get_pragmas() -> Dict[str, Union[int, str]]:
+    """DEFAULT_PRAGMAS with TELEGRAM_BOT_SQLITE_PRAGMAS overrides (None removes one)"""
+    pragmas = {**DEFAULT_PRAGMAS, **getattr(settings, 'TELEGRAM_BOT_SQLITE_PRAGMAS', {})}
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def configure(conn: sqlite3.Connection, pragmas: Optional[Dict[str, Union[int, str]]] = None) -> sqlite3.Connection:
+    for name, value in (get_pragmas() if pragmas is None else pragmas).items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def connect(db_path, check_same_thread: bool = True,
+            pragmas: Optional[Dict[str, Union[int, str]]] = None) -> sqlite3.Connection:
+    """Connection to a bot database, shared by the bot runtime and the admin API"""
+    busy_timeout = (get_pragmas() if pragmas is None else pragmas).get('busy_timeout', 5000)
+    conn = sqlite3.connect(str(db_path), timeout=int(busy_timeout) / 1000, check_same_thread=check_same_thread)
+    return configure(conn, pragmas)
+
+
+def checkpoint(db_path, mode: str = 'PASSIVE') -> Tuple[int, int, int]:
+    """
+    Fold the WAL back into the database file on a short-lived connection,
+    returns (busy, wal pages, checkpointed pages). PASSIVE never waits for
+    readers or writers; TRUNCATE also resets the WAL file to zero bytes.
+    """
+    conn = connect(db_path)
+    try:
+        return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+    finally:
+        conn.close()
+
+
+def replace_database(db_path, source_path=None):
+    """
+    Put a copy of source_path (None: an empty database) in place of db_path.
+    No connection to db_path may be open. Its WAL and shared-memory files
+    are removed: they hold pages of the replaced database, which SQLite
+    would otherwise apply to the new one.
+    """
+    db_path = str(db_path)
+    staged = f"{db_path}.replace"
+    if source_path is not None:
+        shutil.copyfile(source_path, staged)
+    else:
+        open(staged, 'wb').close()
+    for suffix in SIDECAR_SUFFIXES:
+        try:
+            os.remove(db_path + suffix)
+        except FileNotFoundError:
+            pass
+    os.replace(staged, db_path)
+
+
+def database_path(conn: sqlite3.Connection) -> Optional[str]:
+    """File of the connection's main database, None for in-memory ones"""
+    return conn.execute('PRAGMA database_list').fetchone()[2] or None
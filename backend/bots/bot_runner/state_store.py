@@ -0,0 +1,347 @@
+import asyncio
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from django.conf import settings
+from django.db import close_old_connections
+from . import sqlite_db
+
+logger = logging.getLogger(__name__)
+
+# (record, expires_at as unix time); None marks a pending delete
+PendingWrite = Optional[Tuple[Dict, float]]
+
+
+class SQLiteStateBackend:
+    """Durable user states in a table of the bot's own SQLite database"""
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite_db.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS bot_user_states (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )''')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_bot_user_states_expires_at ON bot_user_states(expires_at)'
+            )
+            self.conn.commit()
+
+    def load(self, user_id: int, now: float) -> Optional[Tuple[Dict, float]]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT state, expires_at FROM bot_user_states WHERE user_id = ? AND expires_at > ?',
+                (user_id, now)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def write_many(self, writes: Dict[int, PendingWrite]):
+        upserts = [
+            (user_id, json.dumps(write[0], ensure_ascii=False), write[1])
+            for user_id, write in writes.items() if write is not None
+        ]
+        deletes = [(user_id,) for user_id, write in writes.items() if write is None]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO bot_user_states (user_id, state, expires_at) VALUES (?, ?, ?)',
+                    upserts
+                )
+                self.conn.executemany('DELETE FROM bot_user_states WHERE user_id = ?', deletes)
+
+    def expire(self, now: float) -> int:
+        with self.lock:
+            with self.conn:
+                return self.conn.execute('DELETE FROM bot_user_states WHERE expires_at <= ?', (now,)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def _orm_call(method):
+    """
+    Backend methods run in asyncio.to_thread workers, outside any request:
+    their connections are closed around each call like Django does around
+    requests (close_old_connections, honouring CONN_MAX_AGE)
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+class DjangoStateBackend:
+    """Durable user states in UserBotState rows, shared by all processes"""
+
+    def __init__(self, bot_id: int):
+        self.bot_id = bot_id
+
+    @_orm_call
+    def load(self, user_id: int, now: float) -> Optional[Tuple[Dict, float]]:
+        from ..models import UserBotState
+
+        row = UserBotState.objects.filter(
+            user__bot_id=self.bot_id,
+            user__user_id=user_id,
+            expires_at__gt=datetime.fromtimestamp(now, tz=timezone.utc)
+        ).values('current_node', 'data', 'expires_at').first()
+        if row is None:
+            return None
+        return {**row['data'], 'node': row['current_node']}, row['expires_at'].timestamp()
+
+    @_orm_call
+    def write_many(self, writes: Dict[int, PendingWrite]):
+        from django.db import transaction
+        from ..models import UserBotState, UserInteraction
+
+        deletes = [user_id for user_id, write in writes.items() if write is None]
+        upserts = {user_id: write for user_id, write in writes.items() if write is not None}
+
+        with transaction.atomic():
+            if deletes:
+                UserBotState.objects.filter(user__bot_id=self.bot_id, user__user_id__in=deletes).delete()
+            if not upserts:
+                return
+
+            # get_or_create for the whole batch: one query for known users, one insert for new ones
+            interactions = UserInteraction.objects.filter(bot_id=self.bot_id, user_id__in=upserts)
+            ids = dict(interactions.values_list('user_id', 'id'))
+            missing = [user_id for user_id in upserts if user_id not in ids]
+            if missing:
+                UserInteraction.objects.bulk_create(
+                    [UserInteraction(bot_id=self.bot_id, user_id=user_id) for user_id in missing],
+                    ignore_conflicts=True
+                )
+                ids.update(interactions.filter(user_id__in=missing).values_list('user_id', 'id'))
+
+            UserBotState.objects.bulk_create(
+                [
+                    UserBotState(
+                        user_id=ids[user_id],
+                        current_node=record.get('node'),
+                        data={k: v for k, v in record.items() if k != 'node'},
+                        expires_at=datetime.fromtimestamp(expires_at, tz=timezone.utc)
+                    )
+                    for user_id, (record, expires_at) in upserts.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['current_node', 'data', 'expires_at', 'updated_at']
+            )
+
+    @_orm_call
+    def expire(self, now: float) -> int:
+        from ..models import UserBotState
+
+        deleted, _ = UserBotState.objects.filter(
+            user__bot_id=self.bot_id,
+            expires_at__lte=datetime.fromtimestamp(now, tz=timezone.utc)
+        ).delete()
+        return deleted
+
+    def close(self):
+        from django.db import connections
+
+        # Connection of the thread close() runs in; the others are closed after each call
+        connections.close_all()
+
+
+class UserStateStore:
+    """
+    Per-bot user state: bounded LRU/TTL tier in memory, written back to
+    a durable backend in batches by a background task on the bot's loop.
+    Without a backend states live in memory only (evicted users start over).
+    Users without a stored state are remembered for `miss_ttl` seconds, so
+    their messages do not query the backend each time. While the backend
+    fails, at most `max_pending` writes wait for a retry.
+    """
+
+    def __init__(self, backend=None, max_entries: int = 10000, ttl: float = 24 * 3600,
+                 flush_interval: float = 1.0, expire_interval: float = 60.0, miss_ttl: float = 60.0,
+                 max_pending: int = 100000):
+        self.backend = backend
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_pending = max(1, max_pending)
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+
+        # user_id -> [record, expires_at]; a None record: known to have no state
+        self._entries: 'OrderedDict[int, List]' = OrderedDict()
+        self._dirty: Dict[int, PendingWrite] = {}
+        self._flushing: Dict[int, PendingWrite] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dropped_writes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self) -> Iterator[Tuple[int, Dict]]:
+        """Users held in memory (states only on disk are not visited)"""
+        return ((user_id, entry[0]) for user_id, entry in list(self._entries.items()) if entry[0] is not None)
+
+    async def get(self, user_id: int) -> Optional[Dict]:
+        now = time.time()
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            del self._entries[user_id]
+            if entry[0] is not None:
+                return None
+            # A remembered miss ran out: look again, another process may have stored one
+
+        # Evicted but not yet written back
+        for pending in (self._dirty, self._flushing):
+            if user_id in pending:
+                write = pending[user_id]
+                if write is None or write[1] <= now:
+                    return None
+                self._remember(user_id, list(write))
+                return write[0]
+
+        if self.backend is None:
+            return None
+
+        self.misses += 1
+        loaded = await asyncio.to_thread(self.backend.load, user_id, now)
+        if user_id in self._entries:
+            # Changed while we were reading
+            return self._entries[user_id][0]
+        if user_id in self._dirty:
+            # Deleted while we were reading
+            return None
+        if loaded is None:
+            self._remember(user_id, [None, now + self.miss_ttl])
+            return None
+        self._remember(user_id, list(loaded))
+        return loaded[0]
+
+    def set(self, user_id: int, record: Dict):
+        expires_at = time.time() + self.ttl
+        self._remember(user_id, [record, expires_at])
+        if self.backend is not None:
+            # Re-inserted, so the dict stays ordered by last write
+            self._dirty.pop(user_id, None)
+            self._dirty[user_id] = (record, expires_at)
+
+    def delete(self, user_id: int):
+        self._entries.pop(user_id, None)
+        if self.backend is not None:
+            self._remember(user_id, [None, time.time() + self.miss_ttl])
+            self._dirty.pop(user_id, None)
+            self._dirty[user_id] = None
+
+    def _remember(self, user_id: int, entry: List):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def flush(self):
+        if not self._dirty or self.backend is None:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.write_many, self._flushing)
+        except Exception as e:
+            logger.error(f"Error writing user states: {e}", exc_info=True)
+            # Retry with the next flush, newer writes win
+            retry = {user_id: write for user_id, write in self._flushing.items() if user_id not in self._dirty}
+            retry.update(self._dirty)
+            overflow = len(retry) - self.max_pending
+            if overflow > 0:
+                for user_id in list(retry)[:overflow]:
+                    del retry[user_id]
+                self.dropped_writes += overflow
+                logger.warning(f"Dropped {overflow} oldest unwritten user states, more than {self.max_pending} pending")
+            self._dirty = retry
+        finally:
+            self._flushing = {}
+
+    async def expire(self):
+        """Drop expired states from memory and, in bulk, from the backend"""
+        now = time.time()
+        for user_id, entry in list(self._entries.items()):
+            if entry[1] <= now:
+                del self._entries[user_id]
+        if self.backend is not None:
+            removed = await asyncio.to_thread(self.backend.expire, now)
+            if removed:
+                logger.info(f"Expired {removed} user states")
+
+    async def run(self):
+        last_expire = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire >= self.expire_interval:
+                    last_expire = time.monotonic()
+                    await self.expire()
+            except Exception as e:
+                logger.error(f"Error in user state maintenance: {e}", exc_info=True)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self.backend is not None:
+            await asyncio.to_thread(self.backend.close)
+
+    def stats(self) -> Dict:
+        return {
+            'in_memory': len(self._entries),
+            'pending_writes': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'dropped_writes': self.dropped_writes
+        }
+
+
+def create_state_store(bot_id: Optional[int], db_conn: Optional[sqlite3.Connection]) -> UserStateStore:
+    """State store configured by TELEGRAM_BOT_STATE_* settings"""
+    backend_name = getattr(settings, 'TELEGRAM_BOT_STATE_BACKEND', 'sqlite')
+    backend = None
+    if backend_name == 'sqlite' and db_conn is not None:
+        # Same file as the bot's database, separate connection for the writer thread
+        db_path = sqlite_db.database_path(db_conn)
+        if db_path:
+            backend = SQLiteStateBackend(db_path)
+    elif backend_name == 'django' and bot_id is not None:
+        backend = DjangoStateBackend(bot_id)
+
+    return UserStateStore(
+        backend,
+        max_entries=getattr(settings, 'TELEGRAM_BOT_STATE_MAX_USERS', 10000),
+        ttl=getattr(settings, 'TELEGRAM_BOT_STATE_TTL', 24 * 3600),
+        miss_ttl=getattr(settings, 'TELEGRAM_BOT_STATE_MISS_TTL', 60),
+        max_pending=getattr(settings, 'TELEGRAM_BOT_STATE_MAX_PENDING', 100000)
+    )
@@ -0,0 +1,369 @@
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import math
+import multiprocessing
+import queue
+import threading
+import time
+from collections import Counter
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from ..bot_worker import STOP_TIMEOUT, worker_main
+
+logger = logging.getLogger(__name__)
+
+# A worker hosts at most this many times the average number of bots per worker
+LOAD_FACTOR = 1.25
+
+# (bot_id, worker it runs on, worker it goes to)
+Move = Tuple[int, int, int]
+
+
+def get_supervisor_address():
+    return tuple(getattr(settings, 'BOT_SUPERVISOR_ADDRESS', ('127.0.0.1', 8765)))
+
+
+def get_supervisor_authkey() -> bytes:
+    authkey = getattr(settings, 'BOT_SUPERVISOR_AUTHKEY', '') or 'bot-supervisor'
+    return authkey.encode()
+
+
+def rank_workers(bot_id: int, workers: List[int]) -> List[int]:
+    """Rendezvous hash: stable order in which a bot prefers workers"""
+    return sorted(
+        workers,
+        key=lambda idx: hashlib.blake2b(f"{bot_id}:{idx}".encode(), digest_size=8).digest(),
+        reverse=True
+    )
+
+
+def pick_worker(bot_id: int, workers: List[int], loads: Optional[Dict[int, int]] = None,
+                capacity: Optional[int] = None) -> Optional[int]:
+    """Most preferred worker with fewer than `capacity` bots (any load without one)"""
+    for index in rank_workers(bot_id, workers):
+        if loads is None or capacity is None or loads.get(index, 0) < capacity:
+            return index
+    return None
+
+
+def worker_capacity(bots: int, workers: int) -> int:
+    return max(1, math.ceil(LOAD_FACTOR * bots / max(1, workers)))
+
+
+class BotSupervisor:
+    """
+    Runs worker processes and shards bots between them by TelegramBot.id:
+    each bot goes to the worker it hashes to first that is not over
+    capacity. Placement is revised whenever a bot starts or stops or a
+    worker dies, moving as few bots as possible.
+
+    `lock` guards placement only and is never held while waiting for a
+    worker; commands to a bot's workers are serialized by its own lock,
+    always taken before `lock`.
+    """
+
+    def __init__(self, workers: int, address=None, authkey: bytes = None):
+        self.worker_count = max(1, workers)
+        self.address = address or get_supervisor_address()
+        self.authkey = authkey or get_supervisor_authkey()
+        self.context = multiprocessing.get_context('spawn')
+        self.workers: Dict[int, dict] = {}
+        # bot_id -> index of worker currently hosting it
+        self.assignments: Dict[int, int] = {}
+        self.lock = threading.Lock()
+        self.bot_locks: Dict[int, threading.Lock] = {}
+        self.stopping = threading.Event()
+
+        # Replies and bot events of all workers
+        self.events = self.context.Queue()
+        self.replies: Dict[int, concurrent.futures.Future] = {}
+        self._requests = itertools.count(1)
+        # Bot events waiting to be applied under the lock
+        self._bot_events: 'queue.SimpleQueue[dict]' = queue.SimpleQueue()
+        # A stop waits for the bot's shutdown in the worker
+        self.call_timeout = STOP_TIMEOUT + 5
+
+    def spawn_worker(self, index: int):
+        commands = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, commands, self.events),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.workers[index] = {'process': process, 'queue': commands}
+        logger.info(f"Spawned bot worker {index} (pid {process.pid})")
+
+    def start_workers(self):
+        for index in range(self.worker_count):
+            self.spawn_worker(index)
+        threading.Thread(target=self.read_events, name='bot-supervisor-events', daemon=True).start()
+        threading.Thread(target=self.monitor, name='bot-supervisor-monitor', daemon=True).start()
+
+    def alive_workers(self) -> List[int]:
+        return sorted(i for i, w in self.workers.items() if w['process'].is_alive())
+
+    def send(self, index: int, command: dict):
+        self.workers[index]['queue'].put(command)
+
+    def call(self, index: int, command: dict) -> dict:
+        """Send a command and wait for the worker's reply"""
+        request = next(self._requests)
+        future = concurrent.futures.Future()
+        self.replies[request] = future
+        try:
+            self.send(index, {**command, 'request': request})
+            return future.result(self.call_timeout)
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"Bot worker {index} did not answer {command.get('action')} in {self.call_timeout}s")
+            return {'ok': False, 'error': f"Worker {index} did not respond"}
+        finally:
+            self.replies.pop(request, None)
+
+    def read_events(self):
+        """Resolve calls waiting for worker replies, queue bot events for apply_events()"""
+        while not self.stopping.is_set():
+            try:
+                event = self.events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError, ValueError):
+                break
+            if event.get('event') == 'reply':
+                future = self.replies.get(event['request'])
+                if future is not None and not future.done():
+                    future.set_result(event['result'])
+            else:
+                self._bot_events.put(event)
+
+    def apply_events(self):
+        """Drop assignments of bots a worker failed to start or that stopped on their own; lock held"""
+        while True:
+            try:
+                event = self._bot_events.get_nowait()
+            except queue.Empty:
+                return
+            if event['event'] == 'failed' and event.get('action') != 'start':
+                continue
+            bot_id, index = event['bot_id'], event['worker']
+            if self.assignments.get(bot_id) == index:
+                del self.assignments[bot_id]
+                logger.warning(f"Bot {bot_id} is not running on worker {index}: {event.get('error', 'stopped')}")
+
+    def bot_lock(self, bot_id: int) -> threading.Lock:
+        return self.bot_locks.setdefault(bot_id, threading.Lock())
+
+    def start_bot(self, bot_id: int) -> Optional[int]:
+        with self.bot_lock(bot_id):
+            with self.lock:
+                self.apply_events()
+                if bot_id in self.assignments:
+                    return self.assignments[bot_id]
+                alive = self.alive_workers()
+                loads = Counter(self.assignments.values())
+                index = pick_worker(bot_id, alive, loads, worker_capacity(len(self.assignments) + 1, len(alive)))
+                if index is None:
+                    return None
+                self.assignments[bot_id] = index
+                self.send(index, {'action': 'start', 'bot_id': bot_id})
+                moves = self.rebalance()
+        self.move_bots(moves)
+        with self.lock:
+            return self.assignments.get(bot_id)
+
+    def stop_bot(self, bot_id: int, mark_inactive: bool = True) -> bool:
+        with self.bot_lock(bot_id):
+            with self.lock:
+                self.apply_events()
+                index = self.assignments.pop(bot_id, None)
+                if index is None:
+                    return False
+                alive = index in self.alive_workers()
+                moves = self.rebalance()
+            if alive:
+                self.call(index, {'action': 'stop', 'bot_id': bot_id, 'mark_inactive': mark_inactive})
+        self.move_bots(moves)
+        return True
+
+    def reload_bot(self, bot_id: int) -> dict:
+        """Worker's reply: {'ok': True, 'stats': swap stats or None if a restart is needed}"""
+        with self.bot_lock(bot_id):
+            with self.lock:
+                self.apply_events()
+                index = self.assignments.get(bot_id)
+            if index is None:
+                return {'ok': False, 'error': f"Bot {bot_id} is not running"}
+            return self.call(index, {'action': 'reload', 'bot_id': bot_id})
+
+    def is_running(self, bot_id: int) -> bool:
+        with self.lock:
+            self.apply_events()
+            return bot_id in self.assignments
+
+    def rebalance(self) -> List[Move]:
+        """
+        Put every bot on the live worker it prefers most that has room:
+        bots of dead or overloaded workers move, and bots moved away earlier
+        go back once their worker has room again. Lock held. Bots of dead
+        workers are started elsewhere right away; moves of running bots are
+        returned for move_bots(), which stops them first without the lock.
+        """
+        alive = self.alive_workers()
+        moves: List[Move] = []
+        if not alive:
+            return moves
+        capacity = worker_capacity(len(self.assignments), len(alive))
+        loads = Counter(index for index in self.assignments.values() if index in alive)
+        for bot_id in sorted(self.assignments):
+            current = self.assignments[bot_id]
+            if current in alive:
+                loads[current] -= 1
+            target = pick_worker(bot_id, alive, loads, capacity)
+            if target is None:
+                target = current if current in alive else rank_workers(bot_id, alive)[0]
+            loads[target] += 1
+            if target == current:
+                continue
+            if current in alive:
+                moves.append((bot_id, current, target))
+                continue
+            self.assignments[bot_id] = target
+            self.send(target, {'action': 'start', 'bot_id': bot_id})
+            logger.info(f"Moved bot {bot_id} from dead worker {current} to {target}")
+        return moves
+
+    def move_bots(self, moves: List[Move]):
+        """Carry out moves planned by rebalance(), lock not held"""
+        for bot_id, current, target in moves:
+            with self.bot_lock(bot_id):
+                with self.lock:
+                    # Stopped, or moved by a later rebalance, meanwhile
+                    if self.assignments.get(bot_id) != current:
+                        continue
+                # The old instance has to be gone before another process polls the same token
+                self.call(current, {'action': 'stop', 'bot_id': bot_id, 'mark_inactive': False})
+                with self.lock:
+                    self.assignments[bot_id] = target
+                    self.send(target, {'action': 'start', 'bot_id': bot_id})
+                logger.info(f"Moved bot {bot_id} from worker {current} to {target}")
+
+    def monitor(self, interval: float = 1.0):
+        """Apply bot events, move bots away from dead workers, then respawn them"""
+        while not self.stopping.wait(interval):
+            with self.lock:
+                self.apply_events()
+            dead = [i for i, w in self.workers.items() if not w['process'].is_alive()]
+            if not dead:
+                continue
+            for index in dead:
+                logger.warning(f"Bot worker {index} died (exit code {self.workers[index]['process'].exitcode})")
+            with self.lock:
+                moves = self.rebalance()
+            self.move_bots(moves)
+            for index in dead:
+                self.spawn_worker(index)
+            # All workers were down: nothing could take the bots over before respawn
+            with self.lock:
+                moves = self.rebalance()
+            self.move_bots(moves)
+
+    def status(self) -> dict:
+        with self.lock:
+            self.apply_events()
+            return {
+                'workers': {
+                    i: {'pid': w['process'].pid, 'alive': w['process'].is_alive()}
+                    for i, w in self.workers.items()
+                },
+                'assignments': dict(self.assignments)
+            }
+
+    def handle(self, message: dict) -> dict:
+        action = message.get('action')
+        bot_id = message.get('bot_id')
+        if action == 'start':
+            index = self.start_bot(bot_id)
+            return {'ok': index is not None, 'worker': index}
+        if action == 'stop':
+            return {'ok': self.stop_bot(bot_id, message.get('mark_inactive', True))}
+        if action == 'reload':
+            return self.reload_bot(bot_id)
+        if action == 'is_running':
+            return {'ok': True, 'running': self.is_running(bot_id)}
+        if action == 'status':
+            return {'ok': True, **self.status()}
+        return {'ok': False, 'error': f'Unknown action {action}'}
+
+    def restore_active_bots(self):
+        """Start bots which were active before supervisor (re)start"""
+        from ..models import TelegramBot
+        for bot_id in TelegramBot.objects.filter(is_active=True).values_list('id', flat=True):
+            self.start_bot(bot_id)
+
+    def serve_forever(self):
+        self.start_workers()
+        self.restore_active_bots()
+
+        # Clients are authenticated on their own thread, not while others wait for accept()
+        with Listener(self.address) as listener:
+            logger.info(f"Bot supervisor listening on {self.address} with {self.worker_count} workers")
+            try:
+                self.serve(listener)
+            finally:
+                self.shutdown()
+
+    def serve(self, listener: Listener):
+        """Accept control connections, each answered on a thread of its own: a stop waiting
+        for its worker does not hold up status requests or commands for other bots"""
+        while not self.stopping.is_set():
+            conn = listener.accept()
+            threading.Thread(
+                target=self.serve_connection, args=(conn,), name='bot-supervisor-client', daemon=True
+            ).start()
+
+    def serve_connection(self, conn):
+        with conn:
+            try:
+                deliver_challenge(conn, self.authkey)
+                answer_challenge(conn, self.authkey)
+                conn.send(self.handle(conn.recv()))
+            except AuthenticationError as e:
+                logger.warning(f"Supervisor client rejected: {str(e)}")
+            except (EOFError, OSError) as e:
+                logger.warning(f"Supervisor connection error: {str(e)}")
+            except Exception as e:
+                logger.error(f"Supervisor request failed: {str(e)}", exc_info=True)
+
+    def shutdown(self):
+        self.stopping.set()
+        for index, worker in self.workers.items():
+            try:
+                worker['queue'].put({'action': 'shutdown'})
+            except (OSError, ValueError):
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT + 5
+        for worker in self.workers.values():
+            worker['process'].join(max(0, deadline - time.monotonic()))
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+
+
+class SupervisorClient:
+    """Sends start/stop commands from the web process to the supervisor"""
+
+    def __init__(self, address=None, authkey: bytes = None, timeout: float = STOP_TIMEOUT + 10):
+        self.address = address or get_supervisor_address()
+        self.authkey = authkey or get_supervisor_authkey()
+        self.timeout = timeout
+
+    def request(self, action: str, bot_id: int = None, **params) -> dict:
+        with Client(self.address, authkey=self.authkey) as conn:
+            conn.send({'action': action, 'bot_id': bot_id, **params})
+            if not conn.poll(self.timeout):
+                raise TimeoutError('Bot supervisor did not respond')
+            return conn.recv()
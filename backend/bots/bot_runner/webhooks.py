@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+from typing import Dict, Optional, Tuple
+from django.conf import settings
+from .loop_pool import get_loop_pool
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+# Боты, принимающие обновления через webhook: секрет пути -> bot/dispatcher/loop
+webhook_bots: Dict[str, Dict] = {}
+
+# Keep references to update tasks until they finish
+_update_tasks = set()
+
+
+def webhook_enabled() -> bool:
+    return bool(getattr(settings, 'TELEGRAM_WEBHOOK_URL', ''))
+
+
+def get_webhook_path() -> str:
+    return getattr(settings, 'TELEGRAM_WEBHOOK_PATH', '/telegram/webhook/')
+
+
+def get_webhook_secrets(token: str) -> Tuple[str, str]:
+    """Derive per-bot (path key, secret token header) from the bot token"""
+    key = (getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '') or 'telegram-webhook').encode()
+    path_key = hmac.new(key, f"path:{token}".encode(), hashlib.sha256).hexdigest()[:32]
+    secret_token = hmac.new(key, f"header:{token}".encode(), hashlib.sha256).hexdigest()
+    return path_key, secret_token
+
+
+def get_webhook_url(token: str) -> Optional[str]:
+    """Public URL Telegram should post updates of this bot to"""
+    if not webhook_enabled():
+        return None
+    path_key, _ = get_webhook_secrets(token)
+    return f"{settings.TELEGRAM_WEBHOOK_URL.rstrip('/')}{get_webhook_path()}{path_key}/"
+
+
+def register_bot(token: str, bot, dp, loop: asyncio.AbstractEventLoop = None):
+    path_key, secret_token = get_webhook_secrets(token)
+    webhook_bots[path_key] = {
+        'bot': bot,
+        'dp': dp,
+        'secret_token': secret_token,
+        'loop': loop or asyncio.get_running_loop()
+    }
+    return path_key
+
+
+def unregister_bot(token: str):
+    path_key, _ = get_webhook_secrets(token)
+    webhook_bots.pop(path_key, None)
+
+
+async def feed_update(path_key: str, secret_token: Optional[str], update: dict) -> int:
+    """Hand an update to the bot's dispatcher, returns HTTP status for Telegram"""
+    entry = webhook_bots.get(path_key)
+    if entry is None:
+        return 404
+    if not secret_token or not hmac.compare_digest(secret_token, entry['secret_token']):
+        return 403
+
+    coro = entry['dp'].feed_raw_update(entry['bot'], update)
+    loop = entry['loop']
+    if loop is asyncio.get_running_loop():
+        # Bot lives on the server loop: no thread hop
+        task = loop.create_task(coro)
+        _update_tasks.add(task)
+        task.add_done_callback(_update_tasks.discard)
+    else:
+        asyncio.run_coroutine_threadsafe(coro, loop)
+    return 200
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _respond(send, status: int, payload: dict):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')]
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(payload).encode()})
+
+
+class TelegramWebhookApp:
+    """
+    ASGI wrapper serving Telegram updates for all bots on one route
+    and passing everything else to the Django application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.path = get_webhook_path()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        # Bots started from now on are hosted on the server loop
+        get_loop_pool().adopt(asyncio.get_running_loop())
+
+        if (scope['type'] == 'http' and scope['method'] == 'POST'
+                and scope['path'].startswith(self.path)):
+            await self.handle_update(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                get_loop_pool().adopt(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_update(self, scope, receive, send):
+        path_key = scope['path'][len(self.path):].strip('/')
+        headers = dict(scope.get('headers', []))
+        secret_token = headers.get(SECRET_HEADER, b'').decode()
+
+        try:
+            update = json.loads(await _read_body(receive))
+        except ValueError:
+            await _respond(send, 400, {'ok': False, 'error': 'Invalid JSON'})
+            return
+
+        status = await feed_update(path_key, secret_token, update)
+        if status != 200:
+            logger.warning(f"Rejected webhook update for {path_key[:8]}...: {status}")
+        await _respond(send, status, {'ok': status == 200})
@@ -0,0 +1,89 @@
+import logging
+import os
+import queue
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long a worker waits for a command before checking that its bots still run
+SWEEP_INTERVAL = 1.0
+# How long stopping a bot waits for its shutdown (state flush, DB writer, session) to finish
+STOP_TIMEOUT = 10.0
+
+
+def worker_main(index: int, commands, events):
+    """
+    Entry point of a supervisor worker process: hosts assigned bots on a shared loop.
+
+    Spawned processes import this module to unpickle the target, before
+    Django is set up. It lives outside bots.bot_runner, whose package imports
+    models, and imports nothing from bots.* until django.setup() ran.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    # Bots of this worker run on its own loop pool, not through the supervisor again
+    os.environ['TELEGRAM_BOT_RUNNER_MODE'] = 'shared'
+    import django
+    django.setup()
+
+    from .models import TelegramBot
+    from .bot_runner import BotRunner, running_bots, get_build_cache
+
+    logger.info(f"Bot worker {index} started")
+    runners = {}
+
+    def reply(command: dict, **result):
+        if command.get('request') is not None:
+            events.put({'event': 'reply', 'request': command['request'], 'result': result})
+
+    while True:
+        # Bots whose task ended on their own (bad token, crash) are no longer hosted here
+        for bot_id, runner in list(runners.items()):
+            if runner.bot.token not in running_bots:
+                del runners[bot_id]
+                events.put({'event': 'stopped', 'worker': index, 'bot_id': bot_id})
+                logger.warning(f"Worker {index}: bot {bot_id} stopped")
+
+        try:
+            command = commands.get(timeout=SWEEP_INTERVAL)
+        except queue.Empty:
+            continue
+        action = command.get('action')
+        bot_id = command.get('bot_id')
+
+        if action == 'shutdown':
+            deadline = time.monotonic() + STOP_TIMEOUT
+            for runner in runners.values():
+                runner.stop_bot(mark_inactive=False, timeout=max(0.0, deadline - time.monotonic()))
+            break
+
+        try:
+            if action == 'start':
+                runner = runners.get(bot_id)
+                if runner is None or runner.bot.token not in running_bots:
+                    bot = TelegramBot.objects.get(id=bot_id)
+                    runner = BotRunner(bot)
+                    get_build_cache().ensure(bot)
+                    runner.run_bot_shared()
+                    runners[bot_id] = runner
+                    logger.info(f"Worker {index} started bot {bot_id}")
+                reply(command, ok=True)
+            elif action == 'reload':
+                runner = runners.get(bot_id)
+                if runner is None:
+                    reply(command, ok=False, error=f"Bot {bot_id} is not running on worker {index}")
+                    continue
+                runner.bot.refresh_from_db()
+                # None: the change needs a restart, which the caller does with stop and start
+                reply(command, ok=True, stats=runner.reload_flow())
+            elif action == 'stop':
+                runner = runners.pop(bot_id, None)
+                if runner:
+                    runner.stop_bot(mark_inactive=command.get('mark_inactive', True), timeout=STOP_TIMEOUT)
+                    logger.info(f"Worker {index} stopped bot {bot_id}")
+                reply(command, ok=True)
+        except Exception as e:
+            logger.error(f"Worker {index} failed to {action} bot {bot_id}: {str(e)}", exc_info=True)
+            if action == 'start':
+                runners.pop(bot_id, None)
+            events.put({'event': 'failed', 'worker': index, 'bot_id': bot_id, 'action': action, 'error': str(e)})
+            reply(command, ok=False, error=str(e))
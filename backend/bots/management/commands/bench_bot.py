@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bots.bot_runner.bench import DEMO_FLOW, BENCH_BOT_ID, BenchBot, callback_update, message_update, percentile
+from bots.bot_runner.fake_api import FakeBotAPI
+from bots.models import TelegramBot
+
+FREE_TEXT = ('hello', 'yes', 'no', 'something else')
+
+
+class Command(BaseCommand):
+    help = 'Run a generated bot against a local fake Bot API with synthetic users and report throughput'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument('--bot', type=int, help='Use the flow config of this TelegramBot')
+        source.add_argument('--config', help='Use the flow config from this JSON file')
+        parser.add_argument('--users', type=int, default=50, help='Synthetic users talking at once')
+        parser.add_argument('--steps', type=int, default=20, help='Updates sent by each user')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed of user choices')
+        parser.add_argument('--api-rate', type=float, default=None,
+                            help='Sends per second the fake API accepts before answering 429')
+        parser.add_argument('--keep-rate-limits', action='store_true',
+                            help='Keep the outbound scheduler limits (measures Telegram pacing, not the runtime)')
+        parser.add_argument('--db-latency', type=float, default=0,
+                            help='Simulated storage latency in ms added to every statement and commit')
+        parser.add_argument('--bench-id', type=int, default=BENCH_BOT_ID,
+                            help='Id of the generated bench bot, built in a temporary directory')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['bot']:
+            try:
+                config = TelegramBot.objects.get(id=options['bot']).config
+            except TelegramBot.DoesNotExist:
+                raise CommandError(f"Bot {options['bot']} does not exist")
+        elif options['config']:
+            with open(options['config'], encoding='utf-8') as f:
+                config = json.load(f)
+        else:
+            config = DEMO_FLOW
+
+        if options['verbosity'] < 2:
+            # Per-update logging of the bot would dominate the measurement
+            logging.disable(logging.WARNING)
+        try:
+            report = asyncio.run(self.run(config, options))
+        finally:
+            logging.disable(logging.NOTSET)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+            return
+        for key, value in report.items():
+            self.stdout.write(f"{key:>20}: {value}")
+
+    async def run(self, config, options):
+        api = FakeBotAPI(rate_limit=options['api_rate'])
+        await api.start()
+        bench = BenchBot(api, config, bot_id=options['bench_id'], keep_rate_limits=options['keep_rate_limits'],
+                         db_latency=options['db_latency'] / 1000)
+        latencies = []
+
+        async def user(user_id: int, rng: random.Random):
+            update = message_update(user_id, '/start')
+            for _ in range(options['steps']):
+                started = time.perf_counter()
+                await asyncio.wait_for(bench.send(update), 60)
+                latencies.append(time.perf_counter() - started)
+                update = self.next_update(api, bench.token, user_id, rng)
+
+        try:
+            await asyncio.to_thread(bench.build)
+            await bench.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                user(100000 + i, random.Random(options['seed'] * 100003 + i)) for i in range(options['users'])
+            ))
+            elapsed = time.perf_counter() - started
+            runtime_stats = bench.flow_bot.stats()
+        finally:
+            await bench.stop()
+            await api.stop()
+
+        stats = bench.stats()
+        return {
+            'updates': stats['updates'],
+            'seconds': round(elapsed, 2),
+            'updates_per_sec': round(stats['updates'] / elapsed, 1) if elapsed else 0.0,
+            'handler_p50_ms': stats['handler_p50_ms'],
+            'handler_p99_ms': stats['handler_p99_ms'],
+            'e2e_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'e2e_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'db_ms_per_update': stats['db_ms_per_update'],
+            'db_p99_ms': stats['db_p99_ms'],
+            'loop_lag_p50_ms': stats['loop_lag_p50_ms'],
+            'loop_lag_p99_ms': stats['loop_lag_p99_ms'],
+            'loop_lag_max_ms': stats['loop_lag_max_ms'],
+            'api': api.stats(),
+            'routes': runtime_stats['routes'],
+        }
+
+    @staticmethod
+    def next_update(api: FakeBotAPI, token: str, user_id: int, rng: random.Random):
+        """React to the bot's last message like a user would: press a button or type something"""
+        fake = api.get_bot(token)
+        last = fake.last_message.get(user_id) or {}
+        markup = last.get('reply_markup') or {}
+        if rng.random() < 0.05:
+            return message_update(user_id, '/start')
+        if markup.get('inline_keyboard'):
+            buttons = [b for row in markup['inline_keyboard'] for b in row if b.get('callback_data')]
+            if buttons:
+                return callback_update(user_id, rng.choice(buttons)['callback_data'], fake.bot_id)
+        if markup.get('keyboard'):
+            buttons = [b['text'] for row in markup['keyboard'] for b in row]
+            return message_update(user_id, rng.choice(buttons))
+        return message_update(user_id, rng.choice(FREE_TEXT))
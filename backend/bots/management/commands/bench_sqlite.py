@@ -0,0 +1,157 @@
+import asyncio
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from bots.bot_runner import sqlite_db
+from bots.bot_runner.bench import percentile
+from bots.bot_runner.async_db import AsyncDatabase
+from bots.bot_runner.runtime import USERS_UPSERT
+
+USERS_TABLE = '''CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    language_code TEXT,
+    is_bot INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)'''
+MESSAGES_TABLE = '''CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    text TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)'''
+# What the admin users page runs per request
+ADMIN_QUERIES = (
+    'SELECT COUNT(*) FROM users',
+    'SELECT user_id, username, first_name, last_name, language_code, first_seen, last_active '
+    'FROM users ORDER BY last_active DESC LIMIT 20 OFFSET ?',
+)
+
+
+def legacy_connect(db_path, check_same_thread=True):
+    """How bot and admin connections were opened before: library defaults"""
+    return sqlite3.connect(str(db_path), check_same_thread=check_same_thread)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent bot writes against admin reads on one bot database, default vs tuned pragmas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5, help='Duration of each run')
+        parser.add_argument('--writers', type=int, default=1, help='Bot writer threads (a bot has one connection)')
+        parser.add_argument('--readers', type=int, default=4, help='Admin reader threads')
+        parser.add_argument('--users', type=int, default=20000, help='Rows in the users table')
+        parser.add_argument('--batches', default='1,10,100',
+                            help='Group commit batch sizes to measure bot writes with')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, connect in (('default', legacy_connect), ('tuned', sqlite_db.connect)):
+                result = self.run(Path(tmp) / f"{name}.db", connect, options)
+                self.stdout.write(f"{name:>8}: " + ', '.join(f"{key} {value}" for key, value in result.items()))
+
+            for batch in (int(size) for size in options['batches'].split(',')):
+                rate = asyncio.run(self.group_commit(Path(tmp) / f"batch_{batch}.db", batch, options))
+                self.stdout.write(f"group commit, batch {batch:>4}: {rate} writes/s")
+
+    async def group_commit(self, db_path, batch, options):
+        """Concurrent handlers each writing through the bot's database writer and waiting for the commit"""
+        conn = sqlite_db.connect(db_path, check_same_thread=False)
+        conn.execute(MESSAGES_TABLE)
+        conn.commit()
+        database = AsyncDatabase(SimpleNamespace(conn=conn), readers=False, interval=0.005, max_batch=batch)
+        written = 0
+        deadline = time.perf_counter() + options['seconds']
+
+        async def handler(user_id):
+            nonlocal written
+            while time.perf_counter() < deadline:
+                await database.run(conn.execute, 'INSERT INTO messages (user_id, text) VALUES (?, ?)', (user_id, 'hello'))
+                await database.durable()
+                written += 1
+
+        await asyncio.gather(*(handler(i) for i in range(batch)))
+        await database.close()
+        conn.close()
+        return round(written / options['seconds'])
+
+    def run(self, db_path, connect, options):
+        conn = connect(db_path)
+        conn.execute(USERS_TABLE)
+        conn.execute(MESSAGES_TABLE)
+        conn.executemany(
+            'INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+            ((i, f"user{i}", f"User {i}") for i in range(1, options['users'] + 1))
+        )
+        conn.commit()
+        conn.close()
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        write_times, read_times, errors = [], [], []
+
+        def writer(seed):
+            rng = random.Random(seed)
+            conn = connect(db_path, check_same_thread=False)
+            while not stop.is_set():
+                user_id = rng.randint(1, options['users'] * 2)
+                started = time.perf_counter()
+                try:
+                    # save_user_info: one upsert of the user, then log the message
+                    conn.execute(USERS_UPSERT, (user_id, f"user{user_id}", f"User {user_id}", None, 'en', 0))
+                    conn.execute('INSERT INTO messages (user_id, text) VALUES (?, ?)', (user_id, 'hello'))
+                    conn.commit()
+                except sqlite3.OperationalError as e:
+                    conn.rollback()
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    write_times.append(time.perf_counter() - started)
+            conn.close()
+
+        def reader(seed):
+            rng = random.Random(seed)
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    # The admin API opens a connection per request
+                    conn = connect(db_path)
+                    conn.execute(ADMIN_QUERIES[0]).fetchone()
+                    conn.execute(ADMIN_QUERIES[1], (rng.randint(0, options['users'] // 20) * 20,)).fetchall()
+                    conn.close()
+                except sqlite3.OperationalError as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    read_times.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(options['writers'])]
+        threads += [threading.Thread(target=reader, args=(1000 + i,)) for i in range(options['readers'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        seconds = options['seconds']
+        return {
+            'writes/s': round(len(write_times) / seconds),
+            'write p99 ms': round(percentile(write_times, 0.99) * 1000, 2),
+            'reads/s': round(len(read_times) / seconds),
+            'read p99 ms': round(percentile(read_times, 0.99) * 1000, 2),
+            'locked errors': len(errors),
+        }
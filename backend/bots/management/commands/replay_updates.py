@@ -0,0 +1,177 @@
+import asyncio
+import difflib
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bots.bot_runner.bench import BENCH_BOT_ID, BenchBot, percentile
+from bots.bot_runner.fake_api import FakeBotAPI
+from bots.bot_runner.recorder import read_recording
+from bots.models import TelegramBot
+
+
+def update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    """Chat whose updates must stay in order: the sender of the update"""
+    for event in update.values():
+        if isinstance(event, dict):
+            sender = event.get('from') or event.get('chat') or {}
+            if 'id' in sender:
+                return sender['id']
+    return None
+
+
+def render_sent(record: Dict[str, Any]) -> str:
+    """One comparable line per outgoing message"""
+    if 'photo' in record:
+        line = f"[photo {record['photo'][-1]['file_id']}] {record.get('caption', '')}"
+    else:
+        line = record.get('text', '')
+    markup = record.get('reply_markup') or {}
+    rows = markup.get('keyboard') or markup.get('inline_keyboard')
+    if rows:
+        line += ' [' + ' | '.join(button.get('text', '') for row in rows for button in row) + ']'
+    return line
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        'p50_ms': round(percentile(values, 0.5), 2),
+        'p99_ms': round(percentile(values, 0.99), 2),
+        'mean_ms': round(sum(values) / len(values), 2) if values else 0.0,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Replay a recorded update stream against a bot on a local fake Bot API and compare runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('recording', help='Recording file written with TELEGRAM_UPDATE_RECORDING_DIR')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--bot', type=int, help='Replay against the flow config of this TelegramBot')
+        source.add_argument('--config', help='Replay against the flow config from this JSON file')
+        parser.add_argument('--speed', type=float, default=0,
+                            help='1 for real time, N for N times faster, 0 (default) as fast as possible')
+        parser.add_argument('--limit', type=int, default=None, help='Replay only the first N updates')
+        parser.add_argument('--output', help='Write the run report (messages and latencies) to this JSON file')
+        parser.add_argument('--baseline', help='Run report of an earlier replay to compare with')
+        parser.add_argument('--bench-id', type=int, default=BENCH_BOT_ID,
+                            help='Id of the generated replay bot, built in a temporary directory')
+
+    def handle(self, *args, **options):
+        if options['bot']:
+            try:
+                config = TelegramBot.objects.get(id=options['bot']).config
+            except TelegramBot.DoesNotExist:
+                raise CommandError(f"Bot {options['bot']} does not exist")
+        else:
+            with open(options['config'], encoding='utf-8') as f:
+                config = json.load(f)
+
+        records = list(read_recording(options['recording']))[:options['limit']]
+        if not records:
+            raise CommandError(f"No updates in {options['recording']}")
+
+        if options['verbosity'] < 2:
+            logging.disable(logging.WARNING)
+        try:
+            report = asyncio.run(self.replay(config, records, options))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        recorded = [record['ms'] for record in records if 'ms' in record]
+        self.stdout.write(f"Replayed {report['updates']} updates in {report['seconds']}s")
+        self.stdout.write(f"  recorded: {latency_summary(recorded)}")
+        self.stdout.write(f"  replayed: {report['latency']}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                self.compare(json.load(f), report)
+
+    async def replay(self, config, records, options) -> Dict[str, Any]:
+        api = FakeBotAPI()
+        await api.start()
+        bench = BenchBot(api, config, bot_id=options['bench_id'])
+        handler_ms: List[Optional[float]] = [None] * len(records)
+        speed = options['speed']
+
+        async def push(index: int, update: Dict[str, Any]):
+            try:
+                handler_ms[index] = round(await asyncio.wait_for(bench.send(update), 60) * 1000, 2)
+            except asyncio.TimeoutError:
+                self.stderr.write(f"Update #{index} was not handled")
+
+        async def chat_chain(indexes: List[int]):
+            # Updates of one chat are sent one after another, like a user would
+            for index in indexes:
+                if speed > 0:
+                    delay = (records[index]['ts'] - first_ts) / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await push(index, records[index]['update'])
+
+        chats = defaultdict(list)
+        for index, record in enumerate(records):
+            chats[update_chat_id(record['update'])].append(index)
+        first_ts = records[0]['ts']
+
+        try:
+            await asyncio.to_thread(bench.build)
+            await bench.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(chat_chain(indexes) for indexes in chats.values()))
+            elapsed = time.perf_counter() - started
+        finally:
+            await bench.stop()
+            await api.stop()
+
+        messages = defaultdict(list)
+        for sent in api.get_bot(bench.token).sent:
+            messages[str(sent['chat_id'])].append(render_sent(sent))
+
+        return {
+            'updates': len(records),
+            'seconds': round(elapsed, 2),
+            'latency': latency_summary([ms for ms in handler_ms if ms is not None]),
+            'handler_ms': handler_ms,
+            'messages': dict(messages),
+        }
+
+    def compare(self, baseline: Dict[str, Any], report: Dict[str, Any]):
+        self.stdout.write('Latency, baseline -> this run:')
+        for key, value in report['latency'].items():
+            before = baseline['latency'].get(key, 0.0)
+            change = f" ({(value - before) / before * 100:+.0f}%)" if before else ''
+            self.stdout.write(f"  {key}: {before} -> {value}{change}")
+
+        pairs = [
+            (index, before, after)
+            for index, (before, after) in enumerate(zip(baseline['handler_ms'], report['handler_ms']))
+            if before is not None and after is not None
+        ]
+        slower = sorted(pairs, key=lambda pair: pair[2] - pair[1], reverse=True)[:5]
+        if slower and slower[0][2] > slower[0][1]:
+            self.stdout.write('Largest slowdowns (update #: baseline -> this run, ms):')
+            for index, before, after in slower:
+                if after > before:
+                    self.stdout.write(f"  #{index}: {before} -> {after}")
+
+        changed = 0
+        for chat_id in sorted(set(baseline['messages']) | set(report['messages'])):
+            diff = list(difflib.unified_diff(
+                baseline['messages'].get(chat_id, []), report['messages'].get(chat_id, []),
+                fromfile=f"baseline chat {chat_id}", tofile=f"this run chat {chat_id}", lineterm=''
+            ))
+            if diff:
+                changed += 1
+                self.stdout.write('\n'.join(diff))
+        if changed:
+            self.stdout.write(self.style.WARNING(f"Outgoing messages differ in {changed} chats"))
+        else:
+            self.stdout.write(self.style.SUCCESS('Outgoing messages are identical'))
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bots.bot_runner.supervisor import BotSupervisor
+
+
+class Command(BaseCommand):
+    help = 'Run bots in a pool of worker processes sharded by bot id'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=getattr(settings, 'BOT_SUPERVISOR_WORKERS', 1),
+            help='Number of worker processes'
+        )
+        parser.add_argument('--port', type=int, default=None, help='Control socket port')
+
+    def handle(self, *args, **options):
+        address = None
+        if options['port']:
+            address = ('127.0.0.1', options['port'])
+
+        supervisor = BotSupervisor(options['workers'], address=address)
+        self.stdout.write(f"Starting bot supervisor with {supervisor.worker_count} workers")
+        try:
+            supervisor.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping bot supervisor')
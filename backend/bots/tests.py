@@ -1,3 +1,1376 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import runpy
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from io import StringIO
+from contextvars import ContextVar
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from aiogram import Bot, Dispatcher, types
+from aiogram.types import FSInputFile, InlineKeyboardMarkup
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import SendMessage, SendPhoto
+from django.core.management import call_command
+from django.db import connections
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from backend.asgi import application
+from .models import TelegramBot, UserBotState, UserInteraction
+from .views import TelegramBotViewSet
+from .bot_runner import BotRunner, DBGenerator, get_build_cache, http_session, running_bots, webhooks
+from .bot_runner import sqlite_db
+from .bot_runner.async_db import AsyncDatabase, DatabaseThreads
+from .bot_runner.bench import BENCH_BOT_ID, DEMO_FLOW, BenchBot, callback_update, message_update
+from .bot_runner.broadcasts import BroadcastEngine
+from .bot_runner.conditions import CompiledCondition, ConditionError
+from .bot_runner.fake_api import FakeBotAPI
+from .bot_runner.flow_graph import FlowGraph
+from .bot_runner.http_session import SharedAiohttpSession
+from .bot_runner.index_advisor import advise_flow
+from .bot_runner.loop_pool import LoopPool
+from .bot_runner.media_cache import MediaCache
+from .bot_runner.outbound import GROUP_CHAT_RATE, OutboundScheduler, outbound_lane
+from .bot_runner.recorder import read_recording
+from .bot_runner.schema_catalog import SchemaCatalog
+from .bot_runner.state_store import DjangoStateBackend, UserStateStore
+from .bot_runner.supervisor import BotSupervisor, SupervisorClient, worker_capacity
+
+TOKEN = '42:TEST-token'
+
+WORKER_SETTINGS = '''from pathlib import Path
+from backend.settings import *
+BASE_DIR = Path({base!r})
+DATABASES = {{'default': {{'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'}}}}
+TELEGRAM_BOT_API_SERVER = {api!r}
+'''
+
+
+def wait_for(predicate, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Condition not met in time')
+        time.sleep(0.05)
+
+
+async def wait_until(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Condition not met in time')
+        await asyncio.sleep(0.01)
+
+
+class FakeTelegramSession(BaseSession):
+    """Stand-in for the Telegram Bot API: records requests and returns canned results"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self.sent = asyncio.Event()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if isinstance(method, SendMessage):
+            self.sent.set()
+            return types.Message(
+                message_id=len(self.requests),
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type='private'),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+def make_update(text='hello'):
+    return {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': 7, 'type': 'private'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'User'},
+            'text': text
+        }
+    }
+
+
+async def post(path, payload, headers=()):
+    """Call the ASGI application the way Telegram would"""
+    messages = [{'type': 'http.request', 'body': json.dumps(payload).encode(), 'more_body': False}]
+    responses = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        responses.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'headers': list(headers)}
+    await application(scope, receive, send)
+    return responses[0]['status']
+
+
+class LoopPoolTests(SimpleTestCase):
+    def acquire(self, pool, **kwargs):
+        loop_thread = pool.acquire(**kwargs)
+        if loop_thread.thread is not None:
+            self.addCleanup(loop_thread.loop.call_soon_threadsafe, loop_thread.loop.stop)
+        return loop_thread
+
+    def test_bots_placed_on_least_loaded_loop(self):
+        pool = LoopPool(2)
+        first, second, third = (self.acquire(pool) for _ in range(3))
+        self.assertIsNot(first, second)
+        self.assertIs(third, first)
+
+        async def loop_name():
+            return threading.current_thread().name
+
+        # Bots of one loop run on its thread
+        self.assertEqual(first.submit(loop_name()).result(5), 'bot-loop-0')
+        self.assertEqual(second.submit(loop_name()).result(5), 'bot-loop-1')
+
+        pool.release(first)
+        pool.release(third)
+        self.assertEqual(pool.stats(), [{'name': 'bot-loop-0', 'bots': 0}, {'name': 'bot-loop-1', 'bots': 1}])
+        self.assertIs(self.acquire(pool), first)
+
+    async def test_running_loop_adopted(self):
+        pool = LoopPool(1)
+        adopted = pool.adopt(asyncio.get_running_loop())
+        self.assertIs(pool.adopt(asyncio.get_running_loop()), adopted)
+        self.assertIsNone(adopted.thread)
+
+        self.assertIs(self.acquire(pool, prefer_adopted=True), adopted)
+        self.assertIsNot(self.acquire(pool), adopted)
+        self.assertEqual(pool.stats(), [{'name': 'bot-loop-0', 'bots': 1}, {'name': 'asgi', 'bots': 1}])
+
+    def test_stopped_adopted_loop_not_used(self):
+        pool = LoopPool(1)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        adopted = pool.adopt(loop)
+        self.assertIsNot(self.acquire(pool, prefer_adopted=True), adopted)
+        self.assertEqual(adopted.bot_count, 0)
+
+
+class WebhookTests(SimpleTestCase):
+    def setUp(self):
+        self.session = FakeTelegramSession()
+        self.bot = Bot(token=TOKEN, session=self.session)
+        self.dp = Dispatcher()
+
+        @self.dp.message()
+        async def echo(message: types.Message):
+            await message.answer(message.text)
+
+        self.path_key, self.secret_token = webhooks.get_webhook_secrets(TOKEN)
+        self.path = f"{webhooks.get_webhook_path()}{self.path_key}/"
+
+    def tearDown(self):
+        webhooks.unregister_bot(TOKEN)
+
+    async def test_update_is_fed_to_dispatcher(self):
+        webhooks.register_bot(TOKEN, self.bot, self.dp)
+        status = await post(
+            self.path,
+            make_update('ping'),
+            [(webhooks.SECRET_HEADER, self.secret_token.encode())]
+        )
+        self.assertEqual(status, 200)
+        await asyncio.wait_for(self.session.sent.wait(), 1)
+        self.assertEqual(self.session.requests[0].text, 'ping')
+        self.assertEqual(self.session.requests[0].chat_id, 7)
+
+    async def test_wrong_secret_is_rejected(self):
+        webhooks.register_bot(TOKEN, self.bot, self.dp)
+        status = await post(self.path, make_update(), [(webhooks.SECRET_HEADER, b'wrong')])
+        self.assertEqual(status, 403)
+        self.assertEqual(self.session.requests, [])
+
+    async def test_unknown_bot_returns_404(self):
+        status = await post(self.path, make_update(), [(webhooks.SECRET_HEADER, self.secret_token.encode())])
+        self.assertEqual(status, 404)
+
+    @override_settings(TELEGRAM_WEBHOOK_URL='https://example.com/')
+    def test_webhook_url_uses_path_secret(self):
+        self.assertEqual(
+            webhooks.get_webhook_url(TOKEN),
+            f"https://example.com/telegram/webhook/{self.path_key}/"
+        )
+
+    def test_webhook_disabled_by_default(self):
+        self.assertIsNone(webhooks.get_webhook_url(TOKEN))
+
+
+class SharedSessionTests(SimpleTestCase):
+    """Bots of one loop share its HTTP client against a fake Bot API"""
+
+    async def open_bots(self, api, count, **settings):
+        override = override_settings(TELEGRAM_BOT_API_SERVER=api.base_url, **settings)
+        override.enable()
+        self.addCleanup(override.disable)
+        return [Bot(f'{index}:SHARED', session=SharedAiohttpSession()) for index in range(1, count + 1)]
+
+    async def test_long_polls_do_not_hold_reply_connections(self):
+        api = FakeBotAPI()
+        await api.start()
+        bots = await self.open_bots(api, 5, TELEGRAM_HTTP_POOL_LIMIT=2)
+        try:
+            # More bots than pooled connections, each with a long poll in flight
+            polls = [asyncio.create_task(bot.get_updates(timeout=10)) for bot in bots]
+            await wait_until(lambda: all(api.get_bot(bot.token).calls['getupdates'] for bot in bots), 5)
+
+            started = time.monotonic()
+            await asyncio.gather(*(bot.send_message(chat_id=1, text='reply') for bot in bots))
+            self.assertLess(time.monotonic() - started, 1)
+
+            for bot in bots:
+                api.push_update(bot.token, message_update(1, 'hello'))
+            self.assertEqual([len(updates) for updates in await asyncio.gather(*polls)], [1] * 5)
+        finally:
+            for bot in bots:
+                await bot.session.close()
+            await api.stop()
+
+    async def test_bots_starting_together_share_one_client(self):
+        api = FakeBotAPI()
+        await api.start()
+        bots = await self.open_bots(api, 5)
+        try:
+            sessions = await asyncio.gather(*(bot.session.create_session() for bot in bots))
+            self.assertEqual(len(set(map(id, sessions))), 1)
+            client = http_session._clients[asyncio.get_running_loop()]
+            self.assertEqual(client.users, 5)
+
+            for bot in bots[1:]:
+                await bot.session.close()
+            self.assertEqual(client.users, 1)
+            self.assertFalse(client.closed)
+        finally:
+            await bots[0].session.close()
+            await api.stop()
+        self.assertTrue(client.closed)
+        self.assertNotIn(asyncio.get_running_loop(), http_session._clients)
+
+    async def test_requests_and_errors_counted_per_bot(self):
+        api = FakeBotAPI(rate_limit=1)
+        await api.start()
+        first, second = await self.open_bots(api, 2)
+        try:
+            await first.get_me()
+            await first.send_message(chat_id=1, text='one')
+            with self.assertRaises(TelegramRetryAfter):
+                await first.send_message(chat_id=1, text='two')
+            await second.send_message(chat_id=1, text='three')
+        finally:
+            await first.session.close()
+            await second.session.close()
+            await api.stop()
+
+        self.assertEqual(first.session.stats()['requests'], {'getMe': 1, 'sendMessage': 2})
+        self.assertEqual(first.session.stats()['errors'], 1)
+        self.assertEqual(second.session.stats()['requests'], {'sendMessage': 1})
+        self.assertEqual(second.session.stats()['errors'], 0)
+
+
+class BuildCacheTests(SimpleTestCase):
+    def test_files_rebuilt_only_when_content_changes(self):
+        with tempfile.TemporaryDirectory() as base, override_settings(BASE_DIR=base):
+            cache = get_build_cache()
+            bot = TelegramBot(id=990101, token='990101:BUILD', name='build', config=json.loads(json.dumps(DEMO_FLOW)))
+            bot_file = os.path.join(base, 'telegram_bots', 'bot_990101', 'bot.py')
+            before = cache.stats()
+
+            build_hash, hit = cache.ensure(bot)
+            self.assertFalse(hit)
+            mtime = os.stat(bot_file).st_mtime_ns
+
+            self.assertEqual(cache.ensure(bot), (build_hash, True))
+            self.assertEqual(os.stat(bot_file).st_mtime_ns, mtime)
+
+            bot.config['nodes'][1]['data']['text'] = 'Hello again'
+            new_hash, hit = cache.ensure(bot)
+            self.assertFalse(hit)
+            self.assertNotEqual(new_hash, build_hash)
+            self.assertEqual(cache.current_hash(bot), new_hash)
+            with open(bot_file, encoding='utf-8') as f:
+                self.assertIn('Hello again', f.read())
+
+            # A generated file gone: rebuilt even though the config did not change
+            os.remove(os.path.join(base, 'telegram_bots', 'bot_990101', 'bot.db'))
+            self.assertEqual(cache.ensure(bot), (new_hash, False))
+
+            after = cache.stats()
+            self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 3))
+
+
+class SeedDataTests(SimpleTestCase):
+    def load_database(self, bot):
+        """Generate bot_database.py and open it like a starting bot does"""
+        db = runpy.run_path(str(DBGenerator(bot).create_db_file()))['db']
+        self.addCleanup(db.close)
+        return db.conn
+
+    @staticmethod
+    def rows(conn, sql):
+        return [tuple(row) for row in conn.execute(sql)]
+
+    def test_seed_rows_deduplicated_on_their_key(self):
+        with tempfile.TemporaryDirectory() as base, override_settings(BASE_DIR=base):
+            config = {'dbConfig': {
+                'tables': [{'name': 'answers', 'columns': [{'name': 'answer', 'type': 'TEXT'}]}],
+                'schema': {
+                    'users': [{'user_id': 1, 'username': 'alice'}],
+                    'answers': [{'user_id': 1, 'answer': 'yes'}],
+                },
+            }}
+            bot = TelegramBot(id=990201, token='990201:SEED', name='seed', config=config)
+            conn = self.load_database(bot)
+            self.assertEqual(self.rows(conn, 'SELECT inserted FROM bot_seed'), [(2,)])
+
+            # The seeded user was renamed in the config, a user and an answer were added
+            config['dbConfig']['schema']['users'] = [{'user_id': 1, 'username': 'alicia'},
+                                                     {'user_id': 2, 'username': 'bob'}]
+            config['dbConfig']['schema']['answers'].append({'user_id': 2, 'answer': 'no'})
+            conn = self.load_database(bot)
+            self.assertEqual(self.rows(conn, 'SELECT COUNT(*), SUM(inserted) FROM bot_seed'), [(2, 4)])
+            self.assertEqual(self.rows(conn, 'SELECT user_id, username FROM users ORDER BY user_id'),
+                             [(1, 'alice'), (2, 'bob')])
+            self.assertEqual(self.rows(conn, 'SELECT answer FROM answers ORDER BY id'), [('yes',), ('no',)])
+
+    def test_per_user_reads_use_indexes(self):
+        with tempfile.TemporaryDirectory() as base, override_settings(BASE_DIR=base):
+            config = {'dbConfig': {'tables': [{'name': 'answers', 'columns': [{'name': 'answer', 'type': 'TEXT'}]}]}}
+            bot = TelegramBot(id=990202, token='990202:INDEX', name='index', config=config)
+            conn = self.load_database(bot)
+
+            for sql in ('SELECT id FROM answers WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                        'SELECT * FROM answers WHERE user_id = ? ORDER BY created_at DESC'):
+                plan = ' / '.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", (1,)))
+                self.assertIn('USING', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+
+class UserStateStoreTests(SimpleTestCase):
+    async def test_missing_state_is_remembered(self):
+        backend = mock.Mock()
+        backend.load.return_value = None
+        store = UserStateStore(backend, miss_ttl=60)
+
+        self.assertIsNone(await store.get(1))
+        self.assertIsNone(await store.get(1))
+        self.assertEqual(backend.load.call_count, 1)
+
+        store.set(1, {'node': 'start'})
+        self.assertEqual(await store.get(1), {'node': 'start'})
+        store.delete(1)
+        self.assertIsNone(await store.get(1))
+        self.assertEqual(backend.load.call_count, 1)
+        self.assertEqual(list(store.items()), [])
+
+    async def test_remembered_miss_expires(self):
+        backend = mock.Mock()
+        backend.load.return_value = None
+        store = UserStateStore(backend, miss_ttl=0)
+
+        await store.get(1)
+        backend.load.return_value = ({'node': 'ask'}, time.time() + 60)
+        self.assertEqual(await store.get(1), {'node': 'ask'})
+        self.assertEqual(backend.load.call_count, 2)
+
+    async def test_failed_writes_are_capped(self):
+        backend = mock.Mock()
+        backend.write_many.side_effect = OSError('disk full')
+        store = UserStateStore(backend, max_pending=3)
+
+        for user_id in range(1, 5):
+            store.set(user_id, {'node': 'start'})
+        with self.assertLogs('bots.bot_runner.state_store', logging.WARNING):
+            await store.flush()
+        self.assertEqual(list(store._dirty), [2, 3, 4])
+
+        store.set(2, {'node': 'ask'})
+        store.set(5, {'node': 'start'})
+        with self.assertLogs('bots.bot_runner.state_store', logging.WARNING):
+            await store.flush()
+        self.assertEqual(list(store._dirty), [4, 2, 5])
+        self.assertEqual(store._dirty[2][0], {'node': 'ask'})
+        self.assertEqual(store.stats()['dropped_writes'], 2)
+
+
+class DjangoStateBackendTests(TransactionTestCase):
+    def test_write_many_upserts_in_bulk(self):
+        bot = TelegramBot.objects.create(token=TOKEN, name='Test')
+        UserInteraction.objects.create(bot=bot, user_id=1, username='known')
+        backend = DjangoStateBackend(bot.id)
+        expires_at = time.time() + 60
+
+        backend.write_many({1: ({'node': 'start', 'x': 1}, expires_at), 2: ({'node': 'ask'}, expires_at)})
+        with self.assertNumQueries(5):
+            # BEGIN, delete, known users, one upsert for all states, COMMIT
+            backend.write_many({1: ({'node': 'ask', 'x': 2}, expires_at), 2: None})
+
+        self.assertEqual(UserInteraction.objects.filter(bot=bot).count(), 2)
+        self.assertEqual(UserInteraction.objects.get(bot=bot, user_id=1).username, 'known')
+        self.assertEqual(backend.load(1, time.time()), ({'node': 'ask', 'x': 2}, mock.ANY))
+        self.assertIsNone(backend.load(2, time.time()))
+        self.assertEqual(UserBotState.objects.count(), 1)
+
+
+class TableViewTests(TransactionTestCase):
+    def test_internal_and_missing_tables_not_found(self):
+        bot = TelegramBot.objects.create(token=TOKEN, name='Test')
+        with tempfile.TemporaryDirectory() as base, override_settings(BASE_DIR=base):
+            db_dir = os.path.join(base, 'telegram_bots', f"bot_{bot.id}")
+            os.makedirs(db_dir)
+            conn = sqlite3.connect(os.path.join(db_dir, 'bot.db'))
+            conn.executescript('''
+                CREATE TABLE answers (user_id INTEGER, answer TEXT);
+                CREATE TABLE bot_seed (version INTEGER PRIMARY KEY, inserted INTEGER);
+                CREATE TABLE bot_user_states (user_id INTEGER PRIMARY KEY, state TEXT, expires_at REAL);
+            ''')
+            conn.close()
+
+            request = APIRequestFactory().get('/')
+            response = TelegramBotViewSet.as_view({'get': 'get_bot_tables'})(request, pk=bot.id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([table['name'] for table in response.data['tables']], ['answers'])
+
+            table_data = TelegramBotViewSet.as_view({'get': 'get_table_data'})
+            self.assertEqual(table_data(request, pk=bot.id, table_name='answers').status_code, 200)
+            for name in ('bot_seed', 'missing'):
+                self.assertEqual(table_data(request, pk=bot.id, table_name=name).status_code, 404)
+
+
+class FlowBotTests(SimpleTestCase):
+    """Generated bots on the shared runtime, against a fake Bot API"""
+
+    async def build_bot(self, config=DEMO_FLOW):
+        bench = BenchBot(FakeBotAPI(), config)
+        bench.build()
+        self.addCleanup(lambda: asyncio.run(bench.stop()))
+        return bench.flow_bot
+
+    @contextlib.asynccontextmanager
+    async def running_bot(self, config=DEMO_FLOW):
+        api = FakeBotAPI()
+        await api.start()
+        bench = BenchBot(api, config)
+        try:
+            await bench.start()
+            yield bench
+        finally:
+            await bench.stop()
+            await api.stop()
+
+    async def talk(self, bench, update):
+        """Texts (or captions) the bot replied to the update with"""
+        sent = bench.api.get_bot(bench.token).sent
+        start = len(sent)
+        await bench.send(update)
+        return [message.get('text', message.get('caption')) for message in sent[start:]]
+
+    async def test_flow_driven_through_bot_api(self):
+        async with self.running_bot() as bench:
+            flow_bot = bench.flow_bot
+            self.assertEqual(await self.talk(bench, message_update(4, '/start')), ['Welcome', 'Choose'])
+            self.assertEqual((await flow_bot.states.get(4))['node'], 'choose')
+            sent = bench.api.get_bot(bench.token).sent
+            self.assertEqual(sent[-1]['reply_markup'], flow_bot.graph.keyboards['choose'].model_dump(exclude_none=True))
+
+            self.assertEqual(await self.talk(bench, message_update(4, 'Answer')), ['Вы выбрали: Answer', 'Your answer?'])
+            self.assertTrue((await flow_bot.get_user_state(4))['awaiting_input'])
+            # The flag is per user, the prebuilt state is shared
+            await flow_bot.finish_input(4)
+            self.assertFalse((await flow_bot.get_user_state(4))['awaiting_input'])
+            self.assertTrue(flow_bot.graph.node_states['ask']['awaiting_input'])
+            await flow_bot.set_user_node(4, flow_bot.graph.get_node('ask'))
+
+            # Even user: the condition leads to the answers table, then the inline keyboard
+            self.assertEqual(await self.talk(bench, message_update(4, 'forty-two')),
+                             ['Saved', 'Your answers:\n\nforty-two', 'Inline'])
+            self.assertEqual(await self.talk(bench, callback_update(4, 'y', bench.bot.id)), ['Вы выбрали: Y', 'Picture'])
+
+            await self.talk(bench, message_update(5, '/start'))
+            await self.talk(bench, message_update(5, 'Answer'))
+            self.assertEqual(await self.talk(bench, message_update(5, 'forty-three')), ['Saved', 'Odd user'])
+
+            await flow_bot.database.durable()
+            answers = flow_bot.db.conn.execute('SELECT user_id, answer FROM answers ORDER BY id')
+            self.assertEqual([tuple(row) for row in answers], [(4, 'forty-two'), (5, 'forty-three')])
+            self.assertIn((5, 'user5'), self.users(flow_bot))
+
+    def users(self, flow_bot):
+        rows = flow_bot.db.conn.execute('SELECT user_id, username FROM users ORDER BY user_id')
+        return [tuple(row) for row in rows]
+
+    async def test_users_upserted(self):
+        flow_bot = await self.build_bot()
+        flow_bot.track_user(1, ('old', 'User', None, 'en', False))
+        flow_bot.track_user(1, ('new', 'User', None, 'en', False))
+        self.assertEqual(self.users(flow_bot), [(1, 'new')])
+        self.assertTrue(flow_bot._users_upsert)
+
+    async def test_users_without_unique_key_fall_back(self):
+        flow_bot = await self.build_bot()
+        flow_bot.db.conn.executescript('''
+            DROP TABLE users;
+            CREATE TABLE users (id INTEGER PRIMARY KEY, user_id INTEGER, username TEXT, first_name TEXT,
+                                last_name TEXT, language_code TEXT, is_bot INTEGER, first_seen TEXT, last_active TEXT);
+        ''')
+        with self.assertLogs(flow_bot.logger, logging.WARNING):
+            flow_bot.track_user(1, ('old', 'User', None, 'en', False))
+        flow_bot.track_user(1, ('new', 'User', None, 'en', False))
+        self.assertEqual(self.users(flow_bot), [(1, 'new')])
+        self.assertFalse(flow_bot._users_upsert)
+
+    async def test_other_upsert_errors_raised(self):
+        flow_bot = await self.build_bot()
+        conn = flow_bot.db.conn
+        flow_bot.db.conn = mock.Mock(execute=mock.Mock(side_effect=sqlite3.OperationalError('database is locked')))
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                flow_bot.track_user(1, ('user', 'User', None, 'en', False))
+        finally:
+            flow_bot.db.conn = conn
+        self.assertTrue(flow_bot._users_upsert)
+
+    async def test_messages_routed_by_user_state(self):
+        async with self.running_bot() as bench:
+            # No state: plain text
+            self.assertEqual(await self.talk(bench, message_update(6, 'hello')), ['Вы сказали: hello'])
+            await self.talk(bench, message_update(6, '/start'))
+            # Reply keyboard of a button node, then of a menu node
+            self.assertEqual(await self.talk(bench, message_update(6, 'Menu')), ['Вы выбрали: Menu', 'Menu'])
+            self.assertEqual(await self.talk(bench, message_update(6, 'One')), ['Вы выбрали: One', 'Inline'])
+            # Waiting at the inline keyboard: typed text matches none of its buttons
+            self.assertEqual(await self.talk(bench, message_update(6, 'Nope')), [])
+
+            await self.talk(bench, message_update(7, '/start'))
+            await self.talk(bench, message_update(7, 'Answer'))
+            self.assertEqual(await self.talk(bench, message_update(7, 'yes')), ['Saved', 'Odd user'])
+
+            self.assertEqual(bench.flow_bot.stats()['routes'], {
+                'text': 1, 'command': 2, 'button': 3, 'menu': 1, 'button_unmatched': 1, 'input': 1
+            })
+
+    async def test_commands_matched_with_one_lookup(self):
+        flow_bot = await self.build_bot()
+        bot = mock.Mock(me=mock.AsyncMock(return_value=SimpleNamespace(username='DemoBot')))
+        start_node = flow_bot.graph.get_node('start')
+
+        async def match(text):
+            message = types.Message.model_validate(message_update(1, text)['message'])
+            return await flow_bot.match_command(message, bot)
+
+        self.assertEqual(await match('/start'), {'start_node': start_node})
+        self.assertEqual(await match('/START please'), {'start_node': start_node})
+        self.assertFalse(await match('/help'))
+        self.assertFalse(await match('start'))
+        bot.me.assert_not_called()
+
+        # Addressed to a bot: only this one answers
+        self.assertEqual(await match('/start@demobot'), {'start_node': start_node})
+        self.assertFalse(await match('/start@OtherBot'))
+
+    async def test_states_on_disk_checked_against_reloaded_flow(self):
+        flow_bot = await self.build_bot()
+        flow_bot.advise_indexes = mock.Mock()
+        self.addCleanup(lambda: asyncio.run(flow_bot.database.close()))
+        expires_at = time.time() + 60
+        # Not in memory: written before a restart
+        flow_bot.states.backend.write_many({
+            5: ({'node': 'welcome', 'type': 'text', 'input': False}, expires_at),
+            6: ({'node': 'odd', 'type': 'text', 'input': False}, expires_at),
+        })
+        flow_bot.states.set(7, {'node': 'welcome', 'input': False})
+
+        flow = json.loads(json.dumps(DEMO_FLOW))
+        flow['nodes'][1] = {'id': 'welcome', 'type': 'input', 'data': {'prompt': 'Name?'}}
+        flow['nodes'] = [node for node in flow['nodes'] if node['id'] != 'odd']
+        flow['edges'] = [edge for edge in flow['edges'] if edge['target'] != 'odd']
+        self.assertEqual(flow_bot.reload_config(flow), {'nodes': len(flow['nodes']), 'kept_users': 1, 'reset_users': 0})
+
+        for user_id in (5, 7):
+            self.assertTrue((await flow_bot.get_user_state(user_id))['awaiting_input'])
+        self.assertEqual(await flow_bot.get_user_state(6), {})
+        self.assertEqual((await flow_bot.states.get(6))['node'], None)
+        await wait_until(lambda: flow_bot.advise_indexes.called)
+
+
+class SharedRuntimeTests(TransactionTestCase):
+    """Bots of the shared runtime started through BotRunner, against a fake Bot API"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.api = FakeBotAPI()
+        self.run_on = lambda fn, *args: loop.call_soon_threadsafe(fn, *args)
+        base_url = asyncio.run_coroutine_threadsafe(self.api.start(), loop).result(5)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(self.api.stop(), loop).result(5))
+        # Answer long polls left by stopped bots instead of waiting for their timeout
+        self.addCleanup(lambda: [self.run_on(bot.new_updates.set) for bot in self.api.bots.values()])
+
+        override = override_settings(BASE_DIR=tmp.name, TELEGRAM_BOT_API_SERVER=base_url,
+                                     TELEGRAM_BOT_RUNNER_MODE='shared')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def send(self, token, user_id, text):
+        fake = self.api.get_bot(token)
+        sent = len(fake.sent)
+        self.run_on(self.api.push_update, token, message_update(user_id, text))
+        wait_for(lambda: len(fake.sent) > sent, 10)
+        return fake.sent[sent]['text']
+
+    def test_flow_reloaded_without_restart(self):
+        bot = TelegramBot.objects.create(token='990301:SHARED', name='shared', config=DEMO_FLOW)
+        runner = BotRunner(bot)
+        get_build_cache().ensure(bot)
+        runner.start()
+        self.addCleanup(runner.stop_bot, mark_inactive=False, timeout=10)
+        wait_for(lambda: self.api.get_bot(bot.token).calls['getupdates'], 10)
+        self.assertEqual(self.send(bot.token, 5, '/start'), 'Welcome')
+        flow_bot = running_bots[bot.token]['module'].flow_bot
+
+        bot.config = json.loads(json.dumps(DEMO_FLOW))
+        bot.config['nodes'][1]['data']['text'] = 'Welcome back'
+        stats = runner.reload_flow()
+        self.assertEqual(stats['nodes'], len(DEMO_FLOW['nodes']))
+        self.assertEqual(stats['kept_users'], 1)
+
+        self.assertEqual(self.send(bot.token, 5, '/start'), 'Welcome back')
+        self.assertIs(running_bots[bot.token]['module'].flow_bot, flow_bot)
+
+
+class RecordReplayTests(SimpleTestCase):
+    """Updates recorded from a running bot, replayed against two flows and compared"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    async def record(self, updates):
+        api = FakeBotAPI()
+        await api.start()
+        with override_settings(TELEGRAM_UPDATE_RECORDING_DIR=self.tmp):
+            bench = BenchBot(api, DEMO_FLOW)
+            bench.build()
+        try:
+            await bench.start()
+            for update in updates:
+                await bench.send(update)
+        finally:
+            await bench.stop()
+            await api.stop()
+
+    def replay(self, recording, flow, **options):
+        config = os.path.join(self.tmp, 'flow.json')
+        with open(config, 'w', encoding='utf-8') as f:
+            json.dump(flow, f)
+        out = StringIO()
+        call_command('replay_updates', recording, config=config, stdout=out, **options)
+        return out.getvalue()
+
+    def test_recorded_updates_replayed_and_compared(self):
+        asyncio.run(self.record([message_update(4, '/start'), message_update(4, 'Answer'), message_update(5, '/start')]))
+        recording = os.path.join(self.tmp, f"bot_{BENCH_BOT_ID}.jsonl")
+        with open(recording, 'a', encoding='utf-8') as f:
+            # Torn by a crash while writing
+            f.write('{"ts": 1')
+
+        records = list(read_recording(recording))
+        self.assertEqual([record['update']['message']['text'] for record in records], ['/start', 'Answer', '/start'])
+        self.assertNotIn('update_id', records[0]['update'])
+        self.assertTrue(all(record['ms'] >= 0 for record in records))
+
+        baseline = os.path.join(self.tmp, 'baseline.json')
+        self.replay(recording, DEMO_FLOW, output=baseline)
+        with open(baseline, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report['updates'], 3)
+        self.assertEqual(report['messages']['4'], ['Welcome', 'Choose [Answer | Menu]', 'Вы выбрали: Answer',
+                                                   'Your answer?'])
+        self.assertIn('Outgoing messages are identical', self.replay(recording, DEMO_FLOW, baseline=baseline))
+
+        flow = json.loads(json.dumps(DEMO_FLOW))
+        flow['nodes'][1]['data']['text'] = 'Hello'
+        output = self.replay(recording, flow, baseline=baseline)
+        self.assertIn('-Welcome\n+Hello', output)
+        self.assertIn('Outgoing messages differ in 2 chats', output)
+
+
+class MediaCacheTests(SimpleTestCase):
+    """Local photos are uploaded once, later sends use the Telegram file_id"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'bot.db')
+        self.photo = os.path.join(directory.name, 'photo.jpg')
+        with open(self.photo, 'wb') as f:
+            f.write(b'first image')
+        self.sent = []
+        self.rejected = set()
+
+    async def send(self, photo):
+        self.sent.append(photo)
+        if isinstance(photo, str) and photo in self.rejected:
+            raise TelegramBadRequest(SendPhoto(chat_id=1, photo=photo), 'wrong file identifier')
+        return types.Message(
+            message_id=len(self.sent), date=datetime.now(), chat=types.Chat(id=1, type='private'),
+            photo=[types.PhotoSize(file_id=f'file-{len(self.sent)}', file_unique_id='unique', width=1, height=1)]
+        )
+
+    async def open_cache(self):
+        conn = sqlite_db.connect(self.db_path, check_same_thread=False)
+        self.addCleanup(conn.close)
+        database = AsyncDatabase(SimpleNamespace(conn=conn), readers=False)
+        # Closing again after the test closed it is a no-op
+        self.addCleanup(lambda: asyncio.run(database.close()))
+        return MediaCache(database)
+
+    def stored_file_ids(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return [row[0] for row in conn.execute('SELECT file_id FROM bot_media_cache')]
+        finally:
+            conn.close()
+
+    async def test_file_id_reused_after_upload(self):
+        cache = await self.open_cache()
+        await cache.send_photo(self.send, self.photo)
+        await cache.send_photo(self.send, self.photo)
+        await cache.database.close()
+
+        self.assertIsInstance(self.sent[0], FSInputFile)
+        self.assertEqual(self.sent[1], 'file-1')
+        self.assertEqual(cache.stats(), {'file_ids': 1, 'uploads': 1, 'reused': 1})
+        self.assertEqual(self.stored_file_ids(), ['file-1'])
+
+        # A restarted bot loads the file_id instead of uploading again
+        cache = await self.open_cache()
+        await cache.send_photo(self.send, self.photo)
+        self.assertEqual(self.sent[2], 'file-1')
+        self.assertEqual(cache.uploads, 0)
+
+    async def test_rejected_or_changed_file_uploaded_again(self):
+        cache = await self.open_cache()
+        await cache.send_photo(self.send, self.photo)
+
+        self.rejected.add('file-1')
+        await cache.send_photo(self.send, self.photo)
+        self.assertEqual(self.sent[1], 'file-1')
+        self.assertIsInstance(self.sent[2], FSInputFile)
+        await cache.send_photo(self.send, self.photo)
+        self.assertEqual(self.sent[3], 'file-3')
+
+        # New content under the same path gets its own upload
+        with open(self.photo, 'wb') as f:
+            f.write(b'second image, longer')
+        await cache.send_photo(self.send, self.photo)
+        self.assertIsInstance(self.sent[4], FSInputFile)
+
+        await cache.database.close()
+        self.assertEqual(cache.stats(), {'file_ids': 2, 'uploads': 3, 'reused': 1})
+        self.assertEqual(sorted(self.stored_file_ids()), ['file-3', 'file-5'])
+
+
+class AsyncDatabaseTests(SimpleTestCase):
+    """Writes are committed in groups; a write counts as done once its group is committed"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'bot.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE answers (id INTEGER PRIMARY KEY, answer TEXT)')
+        conn.commit()
+        conn.close()
+
+    def open_database(self, **kwargs):
+        conn = sqlite_db.connect(self.db_path, check_same_thread=False)
+        self.addCleanup(conn.close)
+        database = AsyncDatabase(SimpleNamespace(conn=conn), **{'readers': False, **kwargs})
+        self.addCleanup(lambda: asyncio.run(database.close()))
+        return database
+
+    def insert(self, database, answer):
+        database.submit(database.conn.execute, 'INSERT INTO answers (answer) VALUES (?)', (answer,))
+
+    def committed(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return [row[0] for row in conn.execute('SELECT answer FROM answers ORDER BY id')]
+        finally:
+            conn.close()
+
+    async def test_writes_committed_in_groups(self):
+        # The interval never runs out: only full groups are committed
+        database = self.open_database(interval=60, max_batch=3)
+        for i in range(7):
+            self.insert(database, str(i))
+        await wait_until(lambda: database.commits == 2)
+        self.assertEqual(self.committed(), ['0', '1', '2', '3', '4', '5'])
+        self.assertEqual(database.stats()['pending'], 1)
+
+        await database.close()
+        self.assertEqual(len(self.committed()), 7)
+        self.assertEqual(database.stats()['writes_per_commit'], 2.3)
+
+    async def test_durable_only_after_commit(self):
+        database = self.open_database(interval=0.3)
+        result = await database.run(database.conn.execute, 'INSERT INTO answers (answer) VALUES (?)', ('yes',))
+        self.assertEqual(result.rowcount, 1)
+        # Executed, but the group is still open
+        self.assertEqual(self.committed(), [])
+        durable = database.durable()
+        self.assertFalse(durable.done())
+
+        await durable
+        self.assertEqual(self.committed(), ['yes'])
+        # Nothing written since: already durable
+        self.assertTrue(database.durable().done())
+
+    async def test_close_commits_queued_writes(self):
+        database = self.open_database(interval=60)
+        for i in range(5):
+            self.insert(database, str(i))
+        await database.close()
+        self.assertEqual(self.committed(), ['0', '1', '2', '3', '4'])
+        self.assertEqual(database.commits, 1)
+
+    async def test_databases_share_writer_threads(self):
+        threads = DatabaseThreads(writers=2, readers=0)
+        before = threading.active_count()
+        databases = []
+        for _ in range(5):
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self.addCleanup(conn.close)
+            databases.append(AsyncDatabase(SimpleNamespace(conn=conn), readers=False, threads=threads))
+        # A database takes a writer with its first job, not when it is created
+        self.assertEqual((threading.active_count(), threads.stats()), (before, []))
+
+        for database in databases:
+            await database.run(database.conn.execute, 'CREATE TABLE t (x)')
+        self.assertEqual(threading.active_count(), before + 2)
+        self.assertEqual([writer['databases'] for writer in threads.stats()], [3, 2])
+
+        # A second connection to the same file stays on its writer
+        first = self.open_database(threads=threads)
+        second = self.open_database(threads=threads)
+        await first.run(first.conn.execute, 'SELECT 1')
+        await second.run(second.conn.execute, 'SELECT 1')
+        self.assertEqual(first.stats()['writer'], second.stats()['writer'])
+
+        for database in databases + [first, second]:
+            await database.close()
+        self.assertEqual([writer['databases'] for writer in threads.stats()], [0, 0])
+
+    async def test_jobs_run_in_submitter_context(self):
+        database = self.open_database(readers=True)
+        handler = ContextVar('handler')
+        handler.set('update 1')
+
+        self.assertEqual(await database.run(handler.get), 'update 1')
+        await database.durable()
+        self.assertEqual(await database.read(lambda conn: handler.get()), 'update 1')
+        self.assertEqual(database.stats()['pool_reads'], 1)
+
+
+class BroadcastEngineTests(SimpleTestCase):
+    """Recipients are read in user_id pages, progress survives a restart"""
+
+    FLOW = {
+        'nodes': [
+            {'id': 'b', 'type': 'broadcast', 'data': {'target': 'all'}},
+            {'id': 't', 'type': 'text', 'data': {'text': 'News'}},
+        ],
+        'edges': [{'id': 'e', 'source': 'b', 'target': 't'}],
+    }
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'bot.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, last_active TIMESTAMP)')
+        conn.executemany('INSERT INTO users (user_id) VALUES (?)', [(user_id,) for user_id in range(1, 13)])
+        conn.commit()
+        conn.close()
+        self.delivered = []
+        # Sends to these users never complete, as if the bot stopped during them
+        self.hanging = set()
+        self.user_queries = []
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.hanging:
+            await asyncio.Event().wait()
+        self.delivered.append(chat_id)
+
+    def start_engine(self, **kwargs):
+        conn = sqlite_db.connect(self.db_path, check_same_thread=False)
+        self.addCleanup(conn.close)
+        db = SimpleNamespace(conn=conn)
+        database = AsyncDatabase(db, readers=False)
+        self.addCleanup(lambda: asyncio.run(database.close()))
+
+        read = database.read
+
+        async def logged_read(fn, sql, *args):
+            if 'FROM users' in sql:
+                self.user_queries.append(args[0])
+            return await read(fn, sql, *args)
+
+        database.read = logged_read
+        flow_bot = SimpleNamespace(
+            database=database, db=db, graph=FlowGraph(self.FLOW), logger=logging.getLogger(__name__),
+            bot=SimpleNamespace(send_message=self.send_message)
+        )
+        return BroadcastEngine(flow_bot, **kwargs)
+
+    def runs(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(
+                'SELECT status, checkpoint, sent, failed, '
+                '(SELECT COUNT(*) FROM bot_broadcast_deliveries) FROM bot_broadcast_runs'
+            ).fetchall()
+        finally:
+            conn.close()
+
+    async def test_recipients_read_in_pages(self):
+        engine = self.start_engine(batch_size=5)
+        await engine.run('b')
+        await engine.database.close()
+
+        self.assertEqual(sorted(self.delivered), list(range(1, 13)))
+        # Each page starts after the last user_id of the previous one
+        self.assertEqual(self.user_queries, [(0, 5), (5, 5), (10, 5), (12, 5)])
+        self.assertEqual(self.runs(), [('done', 12, 12, 0, 0)])
+
+    async def test_interrupted_run_resumes_after_restart(self):
+        engine = self.start_engine(concurrency=1, batch_size=5)
+        self.hanging.add(8)
+        task = asyncio.create_task(engine.run('b'))
+        await wait_until(lambda: 7 in self.delivered)
+
+        # Bot stops: sends are cancelled, progress is queued before the writer stops
+        await engine.cancel_all()
+        await engine.database.close()
+        self.assertTrue(task.cancelled())
+        self.assertEqual(self.delivered, [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(self.runs(), [('running', 5, 7, 0, 2)])
+
+        self.hanging.clear()
+        self.user_queries.clear()
+        engine = self.start_engine(concurrency=1, batch_size=5)
+        await engine.resume()
+        await wait_until(lambda: self.runs()[0][0] == 'done')
+        await engine.database.close()
+
+        # Users 6 and 7 were handled after the checkpoint: not sent twice
+        self.assertEqual(self.delivered, list(range(1, 13)))
+        self.assertEqual(self.user_queries[0], (5, 5))
+        self.assertEqual(self.runs(), [('done', 12, 12, 0, 0)])
+
+    async def test_unknown_target_cancels_run(self):
+        engine = self.start_engine()
+        run_id = await engine.database.run(engine._start_run, 'b')
+        engine.flow_bot.graph = FlowGraph({**self.FLOW, 'nodes': [
+            {'id': 'b', 'type': 'broadcast', 'data': {'target': 'vip'}}, self.FLOW['nodes'][1]
+        ]})
+        with self.assertLogs(__name__, logging.ERROR):
+            await engine.run('b', run_id)
+        await engine.database.close()
+
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.runs(), [('cancelled', 0, 0, 0, 0)])
+
+    async def test_missing_run_not_resumed(self):
+        engine = self.start_engine()
+        with self.assertLogs(__name__, logging.ERROR):
+            await engine.run('b', 1)
+        await engine.database.close()
+
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.runs(), [])
+
+
+class OutboundSchedulerTests(SimpleTestCase):
+    """Sends wait for their chat's bucket, then for the global one in lane priority"""
+
+    def setUp(self):
+        self.sent = []
+
+    async def make_request(self, bot, method):
+        self.sent.append((method.chat_id, method.text, time.monotonic()))
+        return True
+
+    async def send(self, scheduler, chat_id, text, lane='interactive'):
+        outbound_lane.set(lane)
+        return await scheduler(self.make_request, None, SendMessage(chat_id=chat_id, text=text))
+
+    async def test_interactive_lane_served_before_bulk(self):
+        scheduler = OutboundScheduler(rate=20)
+        scheduler.global_bucket.tokens = 0
+
+        bulk = [asyncio.create_task(self.send(scheduler, chat_id, 'bulk', 'bulk')) for chat_id in (1, 2, 3)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()['queued'], {'interactive': 0, 'bulk': 3})
+        reply = asyncio.create_task(self.send(scheduler, 4, 'reply'))
+        await asyncio.gather(reply, *bulk)
+
+        self.assertEqual([text for _, text, _ in self.sent], ['reply', 'bulk', 'bulk', 'bulk'])
+        self.assertEqual(sum(scheduler.stats()['wait_ms']['bulk'].values()), 3)
+        scheduler.close()
+
+    async def test_chat_bucket_paces_only_its_chat(self):
+        scheduler = OutboundScheduler(rate=1000)
+        started = time.monotonic()
+
+        with mock.patch('bots.bot_runner.outbound.PRIVATE_CHAT_RATE', 10):
+            # A burst of CHAT_BURST (5) goes at once, the 6th waits for a token (1/10 s)
+            chat = asyncio.gather(*(self.send(scheduler, 1, f'm{i}') for i in range(6)))
+            await asyncio.sleep(0.02)
+            await self.send(scheduler, 2, 'other')
+            await chat
+        scheduler.close()
+
+        times = {text: at - started for _, text, at in self.sent}
+        self.assertLess(max(times[f'm{i}'] for i in range(5)), 0.05)
+        self.assertLess(times['other'], times['m5'])
+        self.assertGreaterEqual(times['m5'], 0.09)
+        self.assertEqual(scheduler.chat_buckets[1].rate, 10)
+        self.assertEqual(scheduler._chat_bucket(-100).rate, GROUP_CHAT_RATE)
+
+
+class ReplaceDatabaseTests(SimpleTestCase):
+    def test_imported_file_replaces_database_and_its_wal(self):
+        with tempfile.TemporaryDirectory() as base:
+            db_path = os.path.join(base, 'bot.db')
+            imported = os.path.join(base, 'imported.db')
+            conn = sqlite3.connect(imported)
+            conn.execute('CREATE TABLE answers (answer TEXT)')
+            conn.execute("INSERT INTO answers VALUES ('imported')")
+            conn.commit()
+            conn.close()
+
+            # WAL of the old database left behind, as by a bot still running during the import
+            old = sqlite_db.connect(db_path, pragmas={'journal_mode': 'WAL', 'wal_autocheckpoint': 0})
+            old.execute('CREATE TABLE answers (answer TEXT)')
+            old.execute("INSERT INTO answers VALUES ('old')")
+            old.commit()
+            wal = shutil.copyfile(db_path + '-wal', os.path.join(base, 'saved-wal'))
+            old.close()
+            shutil.copyfile(wal, db_path + '-wal')
+
+            sqlite_db.replace_database(db_path, imported)
+            self.assertFalse(os.path.exists(db_path + '-wal'))
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute('SELECT answer FROM answers').fetchall(), [('imported',)])
+            conn.close()
+
+
+class FlowGraphTests(SimpleTestCase):
+    FLOW = {
+        'commands': [{'name': '/Start'}, '/help', 'nohelp'],
+        'nodes': [
+            {'id': 'start', 'type': 'startend', 'data': {'isStart': True, 'command': '/Start'}},
+            {'id': 'choose', 'type': 'button', 'data': {'buttons': [{'text': 'A'}, {'text': 'B'}]}},
+            {'id': 'check', 'type': 'condition', 'data': {'condition': 'user_id > 1'}},
+            {'id': 'a', 'type': 'text', 'data': {'text': 'A'}},
+            {'id': 'b', 'type': 'text', 'data': {'text': 'B'}},
+            {'id': 'a', 'type': 'text', 'data': {'text': 'Duplicate'}},
+        ],
+        'edges': [
+            {'source': 'start', 'target': 'choose'},
+            {'source': 'start', 'target': 'b'},
+            {'source': 'choose', 'target': 'check', 'data': {'buttonIndex': 0}},
+            {'source': 'choose', 'target': 'b', 'data': {'buttonIndex': 1}},
+            {'source': 'choose', 'target': 'a', 'data': {'buttonIndex': 1}},
+            {'source': 'check', 'target': 'a', 'label': 'True'},
+            {'source': 'check', 'target': 'b', 'label': 'false'},
+        ],
+    }
+
+    def test_lookups_keep_first_match_in_config_order(self):
+        graph = FlowGraph(self.FLOW)
+        self.assertEqual(graph.get_node('a')['data']['text'], 'A')
+        self.assertIsNone(graph.get_node('missing'))
+
+        self.assertEqual(graph.next_edge('start')['target'], 'choose')
+        self.assertEqual(graph.next_edge('choose', 0)['target'], 'check')
+        self.assertEqual(graph.next_edge('choose', 1)['target'], 'b')
+        self.assertIsNone(graph.next_edge('choose', 2))
+        self.assertIsNone(graph.next_edge('a'))
+        self.assertEqual(len(graph.edges_from['choose']), 3)
+
+        # Labels match the outcome whatever their case
+        self.assertEqual(graph.labelled_edge('check', 'True')['target'], 'a')
+        self.assertEqual(graph.labelled_edge('check', 'False')['target'], 'b')
+        self.assertIsNone(graph.labelled_edge('check', 'None'))
+
+    def test_commands_resolved_to_start_nodes(self):
+        graph = FlowGraph(self.FLOW)
+        self.assertEqual(graph.commands, {'start': graph.get_node('start'), 'help': None})
+        self.assertIs(graph.get_start_node('/Start'), graph.get_node('start'))
+        self.assertEqual(graph.button_indexes['choose'], {'A': 0, 'B': 1})
+        self.assertIsInstance(graph.conditions['check'], CompiledCondition)
+
+    def test_keyboards_and_node_states_prebuilt(self):
+        flow = json.loads(json.dumps(DEMO_FLOW))
+        flow['nodes'].append({'id': 'broken', 'type': 'inline', 'data': {'buttons': [{'text': 'X', 'action': 42}]}})
+        graph = FlowGraph(flow)
+
+        self.assertEqual(sorted(graph.keyboards), ['choose', 'inline', 'menu'])
+        self.assertIsInstance(graph.keyboards['inline'], InlineKeyboardMarkup)
+        self.assertIs(graph.get_keyboard(graph.get_node('choose')), graph.keyboards['choose'])
+        self.assertEqual([row[0].text for row in graph.keyboards['menu'].keyboard], ['One', 'Two'])
+        self.assertIsNone(graph.get_keyboard(graph.get_node('welcome')))
+        # Invalid buttons are not cached: the error shows when the node is reached
+        with self.assertRaises(ValueError):
+            graph.get_keyboard(graph.get_node('broken'))
+
+        self.assertEqual(graph.node_states['choose']['button_mapping'], {'Answer': 0, 'Menu': 1})
+        self.assertEqual(set(graph.node_states['menu']['menu_items']), {'One', 'Two'})
+        self.assertTrue(graph.node_states['ask']['awaiting_input'])
+        self.assertEqual(graph.node_states['welcome'], {'current_node': 'welcome'})
+
+
+class ConditionTests(SimpleTestCase):
+    def test_condition_uses_context(self):
+        condition = CompiledCondition("username == 'alice' and user_id > 5")
+        self.assertTrue(condition.evaluate({'user_id': 7, 'username': 'alice'}))
+        self.assertFalse(condition.evaluate({'user_id': 3, 'username': 'alice'}))
+        self.assertTrue(condition.needs_profile)
+
+    def test_unsafe_expressions_are_rejected(self):
+        for expression in ["__import__('os').system('id')", "().__class__", "open('bot.db')", "lambda: 1"]:
+            with self.assertRaises(ConditionError):
+                CompiledCondition(expression)
+
+    def test_safe_functions_can_be_called(self):
+        condition = CompiledCondition("len(str(user_id)) == 2")
+        self.assertTrue(condition.evaluate({'user_id': 42}))
+        self.assertFalse(condition.needs_profile)
+
+    def test_sequences_cannot_be_multiplied(self):
+        for expression in ["len('a' * 1000000000) > 0", "len([0] * user_id) > 0", "len(str(user_id) * user_id) > 0"]:
+            with self.assertRaises(ConditionError):
+                CompiledCondition(expression)
+
+        condition = CompiledCondition("len(username * user_id) > 0")
+        with self.assertRaises(ConditionError):
+            condition.evaluate({'user_id': 10 ** 9, 'username': 'alice'})
+        self.assertTrue(CompiledCondition("user_id * 2 % 3 == 1").evaluate({'user_id': 5}))
+
+
+class SchemaCatalogTests(SimpleTestCase):
+    def test_schema_change_reloads_tables(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE answers (id INTEGER PRIMARY KEY, user_id INTEGER, text TEXT)')
+        catalog = SchemaCatalog()
+
+        table = catalog.table(conn, 'answers')
+        self.assertEqual(table.names, ['id', 'user_id', 'text'])
+        self.assertIs(catalog.table(conn, 'answers'), table)
+        self.assertEqual(table.insert_sql(('user_id', 'text')), 'INSERT INTO answers (user_id, text) VALUES (?, ?)')
+        self.assertIsNone(catalog.table(conn, 'missing'))
+
+        conn.execute('ALTER TABLE answers ADD COLUMN score REAL')
+        self.assertEqual(catalog.table(conn, 'answers').types['score'], 'REAL')
+        conn.close()
+
+
+class IndexAdvisorTests(SimpleTestCase):
+    def test_full_scan_gets_index_the_planner_uses(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE orders (id INTEGER PRIMARY KEY, user_id INTEGER, status TEXT, created_at TIMESTAMP)')
+        nodes = [
+            {'id': '1', 'type': 'dboutput', 'data': {
+                'customQuery': "SELECT id FROM orders WHERE status = {button_value} ORDER BY created_at"}},
+            {'id': '2', 'type': 'dboutput', 'data': {'table': 'orders', 'columns': ['status']}},
+            {'id': '3', 'type': 'message', 'data': {}},
+        ]
+
+        advice = advise_flow(conn, nodes, 'propose')
+        self.assertEqual(sorted(item.columns for item in advice), [('status', 'created_at'), ('user_id',)])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index'").fetchone()[0], 0)
+
+        advise_flow(conn, nodes, 'create')
+        self.assertEqual(advise_flow(conn, nodes, 'propose'), [])
+        conn.close()
+
+
+class BotPlacementTests(SimpleTestCase):
+    def make_supervisor(self, alive, **kwargs):
+        supervisor = BotSupervisor(len(alive), **kwargs)
+        supervisor.workers = {
+            index: {'process': mock.Mock(is_alive=lambda index=index: alive[index], pid=index), 'queue': mock.Mock()}
+            for index in alive
+        }
+        return supervisor
+
+    def test_rebalance_on_worker_loss_and_bot_stop(self):
+        alive = {0: True, 1: True, 2: True}
+        supervisor = self.make_supervisor(alive)
+
+        def call(index, command):
+            # Waiting for a worker never blocks placement of other bots
+            self.assertFalse(supervisor.lock.locked())
+            return {'ok': True}
+
+        supervisor.call = mock.Mock(side_effect=call)
+
+        for bot_id in range(1, 31):
+            supervisor.start_bot(bot_id)
+        self.assertLessEqual(max(Counter(supervisor.assignments.values()).values()), worker_capacity(30, 3))
+
+        alive[1] = False
+        with supervisor.lock:
+            self.assertEqual(supervisor.rebalance(), [])
+        self.assertNotIn(1, supervisor.assignments.values())
+        self.assertEqual(len(supervisor.assignments), 30)
+
+        # Worker 1 is back: stopping a bot rebalances and its bots return
+        alive[1] = True
+        supervisor.stop_bot(30)
+        loads = Counter(supervisor.assignments.values())
+        self.assertGreater(loads[1], 0)
+        self.assertLessEqual(max(loads.values()), worker_capacity(29, 3))
+
+    def test_control_connections_served_concurrently(self):
+        supervisor = self.make_supervisor({0: True}, address=('127.0.0.1', 0), authkey=b'test')
+        supervisor.start_bot(1)
+        released = threading.Event()
+        supervisor.call = mock.Mock(side_effect=lambda index, command: released.wait(10) and {'ok': True})
+
+        listener = Listener(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        threading.Thread(target=supervisor.serve, args=(listener,), daemon=True).start()
+        client = SupervisorClient(listener.address, b'test', timeout=5)
+
+        # The stop waits for its worker, status and other bots are answered meanwhile
+        replies = []
+        stopping = threading.Thread(target=lambda: replies.append(client.request('stop', 1)))
+        stopping.start()
+        wait_for(lambda: supervisor.call.called, 5)
+        self.assertEqual(client.request('start', 2), {'ok': True, 'worker': 0})
+        self.assertEqual(client.request('status')['assignments'], {2: 0})
+        with self.assertRaises(AuthenticationError):
+            SupervisorClient(listener.address, b'wrong').request('status')
+
+        released.set()
+        stopping.join(5)
+        self.assertEqual(replies, [{'ok': True}])
+        supervisor.stopping.set()
+
+
+class SupervisorTests(SimpleTestCase):
+    """Spawned worker processes run bots from the database, against a fake Bot API"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.loop = asyncio.new_event_loop()
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+        cls.api = FakeBotAPI()
+        base_url = asyncio.run_coroutine_threadsafe(cls.api.start(), cls.loop).result(5)
+
+        # Workers set Django up from scratch: point them at a database and bot directory of the test
+        with open(os.path.join(cls.tmp.name, 'worker_test_settings.py'), 'w') as f:
+            f.write(WORKER_SETTINGS.format(base=cls.tmp.name, api=base_url))
+        database = DatabaseWrapper(
+            {**connections['default'].settings_dict, 'NAME': os.path.join(cls.tmp.name, 'db.sqlite3')}, 'worker_test'
+        )
+        with database.schema_editor(atomic=False) as editor:
+            editor.create_model(TelegramBot)
+        database.close()
+        conn = sqlite3.connect(os.path.join(cls.tmp.name, 'db.sqlite3'))
+        conn.execute(
+            "INSERT INTO bots_telegrambot (id, token, name, is_active, config, created_at, updated_at) "
+            "VALUES (1, '777001:WORKER', 'worker', 1, ?, datetime('now'), datetime('now'))",
+            (json.dumps(DEMO_FLOW),)
+        )
+        conn.commit()
+        conn.close()
+
+        cls.supervisor = BotSupervisor(1)
+        sys.path.insert(0, cls.tmp.name)
+        with mock.patch.dict(os.environ, {'DJANGO_SETTINGS_MODULE': 'worker_test_settings'}):
+            cls.supervisor.start_workers()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.supervisor.shutdown()
+        sys.path.remove(cls.tmp.name)
+        # Answer pending long polls instead of waiting for their timeout
+        for bot in cls.api.bots.values():
+            cls.loop.call_soon_threadsafe(bot.new_updates.set)
+        asyncio.run_coroutine_threadsafe(cls.api.stop(), cls.loop).result(5)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def test_worker_runs_bot(self):
+        self.assertEqual(self.supervisor.start_bot(1), 0)
+        wait_for(lambda: self.api.bots.get('777001:WORKER') and self.api.bots['777001:WORKER'].calls['getupdates'])
+
+        self.loop.call_soon_threadsafe(self.api.push_update, '777001:WORKER', message_update(5, '/start'))
+        fake = self.api.bots['777001:WORKER']
+        wait_for(lambda: fake.sent)
+        self.assertEqual(fake.sent[0]['text'], 'Welcome')
+        self.assertTrue(self.supervisor.is_running(1))
+
+        # Flow edit: swapped in the worker, the reply carries its real stats
+        flow = json.loads(json.dumps(DEMO_FLOW))
+        flow['nodes'][1]['data']['text'] = 'Welcome back'
+        conn = sqlite3.connect(os.path.join(self.tmp.name, 'db.sqlite3'))
+        conn.execute('UPDATE bots_telegrambot SET config = ? WHERE id = 1', (json.dumps(flow),))
+        conn.commit()
+        conn.close()
+        reply = self.supervisor.reload_bot(1)
+        self.assertTrue(reply['ok'])
+        self.assertEqual(reply['stats']['nodes'], len(flow['nodes']))
+        sent = len(fake.sent)
+        self.loop.call_soon_threadsafe(self.api.push_update, '777001:WORKER', message_update(5, '/start'))
+        wait_for(lambda: len(fake.sent) > sent)
+        self.assertEqual(fake.sent[sent]['text'], 'Welcome back')
+
+        self.assertTrue(self.supervisor.stop_bot(1, mark_inactive=False))
+        self.assertFalse(self.supervisor.is_running(1))
+
+    def test_failed_start_drops_assignment(self):
+        # No such bot in the database: the worker reports the failure
+        self.assertEqual(self.supervisor.start_bot(404), 0)
+        wait_for(lambda: not self.supervisor.is_running(404))
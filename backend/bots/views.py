@@ -1,6 +1,5 @@
 import tempfile
 import os
-import shutil
 import sqlite3
 import logging
 from pathlib import Path
@@ -9,11 +8,13 @@ from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-import threading
 import logging
 from .models import TelegramBot
 from .serializers import  TelegramBotSerializer
-from .bot_runner import BotRunner, BotGenerator, DBGenerator, running_bots
+from .bot_runner import BotRunner, DBGenerator, get_build_cache
+from .bot_runner import sqlite_db
+from .bot_runner.schema_catalog import get_catalog
+from .bot_worker import STOP_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -59,7 +60,8 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
 
     def get_db_connection(self, db_path):
         """Helper method to get database connection with proper settings"""
-        conn = sqlite3.connect(str(db_path))
+        # Same pragmas as the bot: reads do not block on its writes (WAL)
+        conn = sqlite_db.connect(db_path)
         conn.row_factory = sqlite3.Row
         return conn
 
@@ -173,31 +175,29 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
         """Start the bot with the given ID"""
         bot = self.get_object()
         
-        if bot.token in running_bots:
+        if BotRunner(bot).is_running():
             return Response(
                 {'status': 'Bot already running'},
                 status=status.HTTP_200_OK
             )
         
         try:
-            # Generate required files
-            BotGenerator(bot).create_bot_file()
-            DBGenerator(bot).create_db_file()
+            # Generate required files (skipped when config hash matches the last build)
+            build_hash, cache_hit = get_build_cache().ensure(bot)
             
-            # Start bot in a separate thread
+            # Start bot on the shared loop pool (or in its own thread, see TELEGRAM_BOT_RUNNER_MODE)
             runner = BotRunner(bot)
-            thread = threading.Thread(
-                target=runner.run_bot,
-                daemon=True
-            )
-            thread.start()
+            runner.start()
             
             # Update bot status
             bot.is_active = True
             bot.save()
             
             return Response(
-                {'status': 'Bot started successfully'},
+                {
+                    'status': 'Bot started successfully',
+                    'build': {'hash': build_hash, 'cache_hit': cache_hit}
+                },
                 status=status.HTTP_200_OK
             )
         except Exception as e:
@@ -211,15 +211,15 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
     def stop(self, request, pk=None):
         """Stop the running bot"""
         bot = self.get_object()
+        runner = BotRunner(bot)
         
-        if bot.token not in running_bots:
+        if not runner.is_running():
             return Response(
                 {'status': 'Bot is not running'},
                 status=status.HTTP_200_OK
             )
         
         try:
-            runner = BotRunner(bot)
             if runner.stop_bot():
                 bot.is_active = False
                 bot.save()
@@ -235,6 +235,74 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def perform_update(self, serializer):
+        config_changed = 'config' in serializer.validated_data
+        bot = serializer.save()
+        
+        # Apply new flow to the running bot right away when possible
+        if config_changed and bot.is_active:
+            try:
+                runner = BotRunner(bot)
+                if runner.is_running() and runner.reload_flow() is None:
+                    logger.info(f"Bot {bot.id} config saved, restart required to apply it")
+            except Exception as e:
+                logger.error(f"Error hot reloading bot {bot.id}: {str(e)}", exc_info=True)
+
+    @action(detail=True, methods=['post'])
+    def reload(self, request, pk=None):
+        """Apply current config to the running bot (hot swap, restart if needed)"""
+        bot = self.get_object()
+        runner = BotRunner(bot)
+        
+        if not runner.is_running():
+            return Response(
+                {'status': 'Bot is not running'},
+                status=status.HTTP_200_OK
+            )
+        
+        try:
+            stats = runner.reload_flow()
+            if stats is not None:
+                return Response({'status': 'Flow reloaded', 'mode': 'hot', 'stats': stats})
+            
+            # DB schema changed: full restart once the old instance has shut down
+            runner.restart()
+            return Response({'status': 'Bot restarted', 'mode': 'restart'})
+        except Exception as e:
+            logger.error(f"Error reloading bot {bot.id}: {str(e)}", exc_info=True)
+            return Response(
+                {'error': f"Failed to reload bot: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    @action(detail=True, methods=['get'], url_path='build')
+    def build_info(self, request, pk=None):
+        """Config hash of the bot and generated files cache statistics"""
+        bot = self.get_object()
+        cache = get_build_cache()
+        config_hash = cache.config_hash(bot)
+        built_hash = cache.current_hash(bot)
+        
+        return Response({
+            'config_hash': config_hash,
+            'built_hash': built_hash,
+            'up_to_date': config_hash == built_hash,
+            'cache': cache.stats()
+        })
+
+    @action(detail=True, methods=['get'], url_path='stats')
+    def runtime_stats(self, request, pk=None):
+        """Message routing counters of the running bot"""
+        bot = self.get_object()
+        stats = BotRunner(bot).get_runtime_stats()
+        
+        if stats is None:
+            return Response(
+                {'error': 'Bot is not running in this process'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(stats)
+
     @action(detail=True, methods=['get'], url_path='tables')
     def get_bot_tables(self, request, pk=None):
         """Get list of all tables in bot's database"""
@@ -258,22 +326,21 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                     WHERE type='table' AND name NOT LIKE 'sqlite_%'
                     ORDER BY name
                 """)
-                tables = [row[0] for row in cursor.fetchall()]
+                # Служебные таблицы рантайма (состояния, рассылки, кэш) не показываем
+                tables = [row[0] for row in cursor.fetchall() if row[0] not in sqlite_db.INTERNAL_TABLES]
                 
                 # Get detailed schema for each table
                 tables_with_schema = []
+                catalog = get_catalog(db_path)
                 for table in tables:
-                    cursor.execute(f"PRAGMA table_info({table})")
-                    columns = [{
-                        'name': col[1], 
-                        'type': col[2],
-                        'notnull': bool(col[3]),
-                        'pk': bool(col[5])
-                    } for col in cursor.fetchall()]
+                    schema = catalog.table(conn, table)
+                    if schema is None:
+                        # Удалена, пока мы читали список
+                        continue
                     
                     tables_with_schema.append({
                         'name': table,
-                        'columns': columns,
+                        'columns': [column._asdict() for column in schema.columns],
                         'row_count': self._get_table_row_count(cursor, table)
                     })
                 
@@ -316,12 +383,8 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                 cursor = conn.cursor()
                 
                 # Verify table exists
-                cursor.execute("""
-                    SELECT name FROM sqlite_master 
-                    WHERE type='table' AND name=?
-                """, (table_name,))
-                
-                if not cursor.fetchone():
+                table = get_catalog(db_path).table(conn, table_name)
+                if table is None or table_name in sqlite_db.INTERNAL_TABLES:
                     return Response(
                         {'error': f'Table {table_name} not found'},
                         status=status.HTTP_404_NOT_FOUND
@@ -341,13 +404,7 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                 total_count = cursor.fetchone()[0]
                 
                 # Get column info
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = [{
-                    'name': col[1], 
-                    'type': col[2],
-                    'notnull': bool(col[3]),
-                    'pk': bool(col[5])
-                } for col in cursor.fetchall()]
+                columns = [column._asdict() for column in table.columns]
                 
                 return Response({
                     'data': data,
@@ -393,9 +450,13 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                 cursor = conn.cursor()
                 
                 # Get table structure
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns_info = {col[1]: col for col in cursor.fetchall()}
-                column_names = columns_info.keys()
+                table = get_catalog(db_path).table(conn, table_name)
+                if table is None:
+                    return Response(
+                        {'error': f'Table {table_name} not found'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                column_names = set(table.names)
                 
                 # Process each row operation
                 operations = {'insert': 0, 'update': 0, 'delete': 0}
@@ -418,13 +479,10 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                             }
                             
                             if valid_cols:
-                                set_clause = ', '.join([
-                                    f"{k}=?" for k in valid_cols.keys()
-                                ])
                                 values = list(valid_cols.values()) + [rowid]
                                 
                                 cursor.execute(
-                                    f"UPDATE {table_name} SET {set_clause} WHERE rowid=?",
+                                    table.update_sql(tuple(valid_cols), key='rowid'),
                                     values
                                 )
                                 operations['update'] += 1
@@ -436,11 +494,8 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
                             }
                             
                             if valid_cols:
-                                cols = ', '.join(valid_cols.keys())
-                                placeholders = ', '.join(['?'] * len(valid_cols))
-                                
                                 cursor.execute(
-                                    f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})",
+                                    table.insert_sql(tuple(valid_cols)),
                                     list(valid_cols.values())
                                 )
                                 operations['insert'] += 1
@@ -656,6 +711,12 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
             db_generator = DBGenerator(bot)
             db_analysis = db_generator.import_database(tmp_path)
             
+            # Работающий бот держит соединения и WAL старой базы: останавливаем его до замены файла
+            runner = BotRunner(bot)
+            was_running = runner.is_running()
+            if was_running:
+                runner.stop_bot(mark_inactive=False, timeout=STOP_TIMEOUT)
+            
             # Обновляем конфигурацию бота
             if 'dbConfig' not in bot.config:
                 bot.config['dbConfig'] = {}
@@ -666,17 +727,13 @@ class TelegramBotViewSet(viewsets.ModelViewSet):
             })
             bot.save()
             
-            # Создаем директорию для бота, если не существует
-            bot_dir = Path(settings.BASE_DIR) / 'telegram_bots' / f'bot_{bot.id}'
-            bot_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Копируем импортированную базу данных
-            destination_db = bot_dir / 'bot.db'
-            shutil.copy2(tmp_path, destination_db)
-            
-            # Генерируем файл для работы с БД
+            # Заменяем bot.db импортированной базой и генерируем файл для работы с БД
             db_generator.create_db_file(tmp_path)
             
+            if was_running:
+                get_build_cache().ensure(bot)
+                runner.start()
+            
             return Response({
                 'message': 'База данных успешно импортирована',
                 'tables': db_analysis['tables'],